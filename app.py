@@ -1,211 +1,129 @@
+import tempfile
+import time
+from pathlib import Path
+# Start of the script run, for the time-to-interactive caption (taken before the heavy imports)
+SCRIPT_START = time.perf_counter()
 import pandas as pd
-import numpy as np
-import geopandas as gpd
 import streamlit as st
-import os
-from scipy.spatial.distance import cdist
-import folium
-from streamlit_folium import st_folium
-
-from src.utils import find_project_root
+import warnings
+
+from src.utils import find_project_root, file_version
+from src.config import metric_groups_for
+from src.analytics import ReferenceOutsideUniverseWarning, group_sim_col
+from src.data_loader import DATASETS, DEFAULT_DATASET, available_datasets, load_national_percentiles
+from src.shared_store import load_shared_dataset
+from src.cache import SimilarityCache
+from src.lookup import PlaceLookup
+from src.export import EXPORT_FORMATS, export_file_name, write_export
+from src.spatial_filter import SpatialFilter
+from src.sensitivity import SAMPLING_METHODS, SENSITIVITY_SAMPLES, TRACK_TOP_K, rank_stability
+from src.tracing import trace_stage, tracing, write_trace
+# Geometry and map libraries (geopandas, shapely, folium, streamlit_folium, scipy) are imported lazily:
+# only when Tab 3 renders a map or an indexed search runs, never on the path to the Tab 1 selectors
 
 
 # CONSTANTS
-# TODO: Move this to a configuration.py file
-TABLE = 'acs_5yr_place_features_v1.parquet'
+# Feature tables (one per geography level / ACS vintage) are listed in src.data_loader.DATASETS
 DATA_DIR = find_project_root() / "data" / "intermediate" / "features"
-PARQUET_PATH = DATA_DIR / TABLE
-
-# Define Metric Groups for Tab: Descriptive Analysis and Tab: Comparison
-METRIC_GROUPS = {
-    "ACS Base": ["pop_2024", "households_2024"],
-    "ACS Income": ["median_income_2024", "median_home_value_2024"],
-    "Property": ["unq_clips", "unq_addr_count", "condo_address_counts", "median_assessed_value", "median_tax_amount"],
-    "Parcel": ["unq_parcel_count", "median_parcel_area_sq_mtr", "parcel_density"],
-    "Growth": ["unq_growth_clips", "growth_clip_share", "business_count"]
-}
-
-@st.cache_data
-def get_master_data():
-    # 1. Check if the local Geoparquet exists
-    if os.path.exists(PARQUET_PATH):
-        #st.info("Loading data from local Geoparquet...")
-        gdf = gpd.read_parquet(PARQUET_PATH)
-
-        # Check if percentiles exist; if don't then add
-        pct_cols = ['f{m}_pct' for group in METRIC_GROUPS.values() for m in group]
-        if not all(col in gdf.columns for col in pct_cols):
-            # st.info("Calculating national percentiles and updating local cache...")
-            for group, metrics in METRIC_GROUPS.items():
-                for m in metrics:
-                    # rank True for 0-100 scale
-                    gdf[f'{m}_pct'] = round(gdf[m].rank(pct=True)*100,2)
-            gdf.to_parquet(PARQUET_PATH)
-        return gdf
-    else:
-        st.error("Parquet file not found!")
-        st.stop()
-
-# Execute the cached loader
-gdf = get_master_data()
-
-# Function to calculate similarity: main engine of the script 
-def run_similarity_logic(gdf, ref_geoids, target_states, pop_min, weights):
-    """
-    Computes similarity scores using DYNAMIC local percentiles based on user filters.
-    Includes Relative Scaling (Min-Max) to ensure a 0-100 range based on the sample.
-    """
-    # Define the universe for which percentiles should be calculated
-    # This is our specific sample for this calculation run
-    universe = gdf[
-        (gdf['state_name'].isin(target_states)) & 
-        (gdf['pop_2024'] >= pop_min)
-    ].copy()
-
-    # universe without reference vectors
-    
-    if universe.empty:
-        return universe
-
-    # 2. Dynamic calculation of percentiles
-    # Percentiles are calculated only in the subset
-    # This is the main component of the engine and is calculated only for the session
-    # local_pct_cols disappears once the session is refreshed
-    local_pct_cols = []
-    for group, metrics in METRIC_GROUPS.items():
-        for m in metrics:
-            local_col = f"{m}_local_pct"
-            # We use rank(pct=True) to get a 0.0 to 1.0 range
-            universe[local_col] = universe[m].rank(pct=True)
-            local_pct_cols.append(local_col)
-
-    # 3. CAPTURE THE LOCAL TARGET VECTOR
-    # Look up how our reference cities rank WITHIN this new local context
-    ref_mask = universe['geoidfq'].isin(ref_geoids)
-    
-    # Check if any reference cities actually exist in the current search universe
-    if not ref_mask.any():
-        st.warning("Note: Reference cities are outside the selected Search Universe. "
-                   "Their scores are being benchmarked against the local market's distribution.")
-        # Fallback: Get their values from the master GDF and project them into the local percentile distribution
-        ref_df = gdf[gdf['geoidfq'].isin(ref_geoids)]
-        target_v = []
-        for m in [m for group in METRIC_GROUPS.values() for m in group]:
-            # This 'projects' the reference raw value into the universe distribution
-            raw_vals = ref_df[m].mean()
-            local_pct = (universe[m] <= raw_vals).mean() # Percentile rank in current universe
-            target_v.append(local_pct)
-        target_v = np.array(target_v).reshape(1, -1)
-    else:
-        # Standard: Reference cities are part of the subset, just average their local ranks
-        target_v = universe[ref_mask][local_pct_cols].mean().values.reshape(1, -1)
-
-    # 4. COMPUTE WEIGHTED SIMILARITY
-    # Pre-calculate the total weights for normalization
-    total_weight = sum(weights.values())
-    
-    # We'll calculate the Euclidean distance for each group separately to apply weights
-    weighted_distances_sq = 0
-    
-    # NEW: Store raw distances per group to apply local scaling later
-    group_raw_dists = {}
-    
-    for group, metrics in METRIC_GROUPS.items():
-        group_cols = [f"{m}_local_pct" for m in metrics]
-        group_weight = weights.get(group, 0.5)
-        
-        # Pick relevant columns for one metric group (e.g. ACS Basic) at a time
-        group_target = target_v[:, [local_pct_cols.index(c) for c in group_cols]]
-        # For this metric group, create matrix with geographies (rows) * relevant columns (columns)
-        group_candidates = universe[group_cols].fillna(0).values
-        
-        # Calculate squared Euclidean distance within this metric group
-        # group_target has shape [1*number of columns] - and group_candidates has shape [places*number of columns]
-        # Docs: https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.cdist.html
-        # Distance metric has a bunch of options. We've used squared euclidean to prioritize balanced candidates
-        # Square the distance and taking square roots penalizes outliers (same concept as standard deviation)
-        # TODO: https://stats.stackexchange.com/questions/118/why-square-the-difference-instead-of-taking-the-absolute-value-in-standard-devia
-        # We had to use flatten because dists returns list of lists 
-        dists = cdist(group_candidates, group_target, metric='sqeuclidean').flatten()
-        
-        # Accumulate the weighted squared distance
-        weighted_distances_sq += dists * group_weight
-        
-        # NEW: Capture the root distance for group-level scaling
-        group_raw_dists[group] = np.sqrt(dists)
-
-    # 5. FINAL OVERALL SCORE (RELATIVE SCALING)
-    # Methodology: We use Root Mean Square Error (RMSE) across weighted groups.
-    # To ensure a 0-100 similarity score, we scale the distances relative to the best/worst in the sample.
-    
-    # Step A: Calculate final weighted root distance
-    final_rmse = np.sqrt(weighted_distances_sq / total_weight)
-    
-    # Step B: Apply Min-Max scaling to overall similarity
-    # Similarity = 100 * (1 - (dist - min_dist) / (max_dist - min_dist))
-    d_min, d_max = final_rmse.min(), final_rmse.max()
-    
-    if d_max > d_min:
-        universe['overall_similarity'] = 100 * (1 - (final_rmse - d_min) / (d_max - d_min))
-    else:
-        universe['overall_similarity'] = 100.0
-
-    # Step C: Scale Group Similarities individually for tooltips/display
-    for group, dists in group_raw_dists.items():
-        g_min, g_max = dists.min(), dists.max()
-        sim_col = f"{group.lower().replace(' ', '_')}_sim"
-        if g_max > g_min:
-            universe[sim_col] = 100 * (1 - (dists - g_min) / (g_max - g_min))
-        else:
-            universe[sim_col] = 100.0
-    
-    # 6. Rank and Clean Up (Excluding References)
-    # We remove the "seeds" before assigning ranks so the best look-alike is #1
-    candidates_only = universe[~universe['geoidfq'].isin(ref_geoids)].copy()
-    
-    candidates_only = candidates_only.sort_values('overall_similarity', ascending=False)
-    candidates_only['rank'] = range(1, len(candidates_only) + 1)
-    
-    # Cleanup temporary local columns
-    candidates_only = candidates_only.drop(columns=local_pct_cols)
-    
-    return candidates_only
-
-# Helper for the legend colors
-def get_color(rank_bucket):
-    colors = {
-        "Top 10":"#1a9850",   # Dark Green
-        "11-25": "#91cf60",    # Light Green
-        "26-50": "#fee08b",    # Yellow/Tan
-        "50+": "#d73027"       # Red
-    }
-    # Return hex color or black if not found to highlight the error
-    return colors.get(rank_bucket, "#000000")
-
-# Add legend to the rendered map
-def add_map_legend(m):
-    legend_html = """
-     <div style="
-     position: fixed; 
-     bottom: 50px; left: 50px; width: 150px; height: 160px; 
-     background-color: white; border:2px solid grey; z-index:9999; font-size:14px;
-     padding: 10px;
-     border-radius: 5px;
-     box-shadow: 2px 2px 5px rgba(0,0,0,0.3);
-     ">
-     <b>Market Rank</b><br>
-     <i style="background: #00BFFF; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> Reference<br>
-     <i style="background: #1a9850; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> Top 10<br>
-     <i style="background: #91cf60; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 11-25<br>
-     <i style="background: #fee08b; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 26-50<br>
-     <i style="background: #d73027; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 50+<br>
-     </div>
-     """
-    m.get_root().html.add_child(folium.Element(legend_html))
-
-# --- CONFIG & SESSION STATE ---
+# Number of ranked candidates kept for the map and table; exports stream the full ordering in chunks (src.export)
+# The map is a single GeoJSON layer, so thousands of shapes stay responsive
+MAP_TOP_K = 2000
+
+# Every per-level resource below is keyed on the level and keeps max_entries=1,
+# so switching levels drops the previous level and RAM only holds the active one
+# Leading underscores tell streamlit not to hash the argument
+
+# Attributes + feature matrix + presorted rank index of one level, without geometry
+# Mapped from the shared sidecar (src.shared_store), so every server process reads the same pages
+# and cache_resource hands out the mapped objects themselves (no pickling or copies per rerun)
+@st.cache_resource(max_entries=1)
+def get_shared_dataset(level):
+    return load_shared_dataset(level, DATA_DIR)
+
+def get_feature_store(level):
+    return get_shared_dataset(level)[0]
+
+# State -> names and (state, name) -> geoidfq lookups plus name search for the reference picker
+@st.cache_resource(max_entries=1)
+def get_place_lookup(level, _store):
+    return PlaceLookup(_store.attrs)
+
+# Every metric presorted once per level (stored in the shared sidecar)
+def get_rank_index(level, _store):
+    return get_shared_dataset(level)[1]
+
+# National percentiles (0-100) for the descriptive stats
+# Read from the derived-feature sidecar next to the source file; only missing or stale metrics are recomputed
+@st.cache_resource(max_entries=1)
+def get_national_percentiles(level, _store):
+    return load_national_percentiles(_store, DATASETS[level].path(DATA_DIR), source_version=get_dataset_version(level))
+
+# Size + modification time of the level's parquet (one stat, no read); keys the result cache and the sidecars
+@st.cache_resource(max_entries=1)
+def get_dataset_version(level):
+    return file_version(DATASETS[level].path(DATA_DIR))
+
+# Pre-simplified polygons per zoom tier, cached in a sidecar parquet next to the source file
+# The polygons themselves are only read when the sidecar has to be (re)built
+@st.cache_resource(max_entries=1)
+def get_geometry_tiers(level, _store):
+    from src.visualizer import load_geometry_tiers
+    return load_geometry_tiers(DATASETS[level].path(DATA_DIR), _store.geoidfq, _store.load_geometry,
+                               source_version=get_dataset_version(level))
+
+# Projected centroids (+ polygons on demand) for the geographic constraints, cached in a sidecar parquet
+@st.cache_resource(max_entries=1)
+def get_spatial_index(level, _store):
+    from src.spatial import load_spatial_index
+    return load_spatial_index(_store, DATASETS[level].path(DATA_DIR), source_version=get_dataset_version(level))
+
+# Result + universe LRU cache shared by every session on this server
+# The spatial index is only loaded once a search uses a geographic constraint
+@st.cache_resource(max_entries=1)
+def get_similarity_cache(level, _store, _rank_index, dataset_version):
+    return SimilarityCache(_store, _rank_index, dataset_version,
+                           spatial_index=lambda: get_spatial_index(level, _store))
+
+# --- CONFIG & DATASET SELECTION ---
 st.set_page_config(layout="wide", page_title="Site Similarity Hub")
 
+levels = available_datasets(DATA_DIR)
+if not levels:
+    st.error("Parquet file not found!")
+    st.stop()
+level = st.sidebar.selectbox(
+    "Geography Level", levels,
+    index=levels.index(DEFAULT_DATASET) if DEFAULT_DATASET in levels else 0,
+    format_func=lambda key: DATASETS[key].label,
+)
+spec = DATASETS[level]
+# Per-stage timings of the comparison run (search, re-ranking, map, export) in a sidebar expander;
+# also appended to the SIMILARITY_TRACE_LOG file when that variable is set. Off by default (no overhead).
+debug_timings = st.sidebar.toggle("Debug timings", value=False)
+debug_memory = debug_timings and st.sidebar.checkbox("Track memory (slower)", value=False)
+
+# Execute the cached loaders for the selected level only
+store = get_feature_store(level)
+attrs = store.attrs
+lookup = get_place_lookup(level, store)
+rank_index = get_rank_index(level, store)
+similarity_cache = get_similarity_cache(level, store, rank_index, get_dataset_version(level))
+# Metric groups available at this level (the 1-yr places lack some metrics)
+metric_groups = metric_groups_for(store.metrics)
+
+# Streamlit wrapper around the headless engine: surface engine warnings in the UI
+# Identical searches (from any session) are served from similarity_cache
+def score_similarity(ref_geoids, target_states, pop_min, weights, top_k=MAP_TOP_K, use_index=False, exact=True,
+                     spatial=None):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ReferenceOutsideUniverseWarning)
+        res = similarity_cache.score(ref_geoids, target_states, pop_min, weights, top_k, use_index=use_index,
+                                     exact=exact, spatial=spatial)
+    for w in caught:
+        st.warning(str(w.message))
+    return res
+
+# --- SESSION STATE ---
 # Initialize state to carry data between tabs
 # Initialize list to save geoids for data lookup
 if 'ref_geoids' not in st.session_state:
@@ -215,6 +133,17 @@ if 'ref_geoids' not in st.session_state:
 if 'customer_name' not in st.session_state:
     st.session_state.customer_name = ""
 
+# References picked through the name search (geoidfq)
+if 'search_refs' not in st.session_state:
+    st.session_state.search_refs = []
+
+# References and results belong to one level; start over when the level changes
+if st.session_state.get('level') != level:
+    st.session_state.level = level
+    st.session_state.ref_geoids = []
+    st.session_state.search_refs = []
+    st.session_state.analysis_results = None
+
 
 # UI TABS ---
 st.title("🌐 Market Similarity Discovery")
@@ -229,47 +158,68 @@ with tab1:
     # TODO: validate that this works 
     st.text_input("Customer Name", key="customer_name")
     
+    # Type-ahead search over every name of the level (prefix, word and fuzzy matches)
+    search_cols = st.columns([4, 1])
+    query = search_cols[0].text_input(f"Search {spec.geography} names", key="ref_search")
+    if query:
+        matches = lookup.search(query, limit=20)
+        labels = dict(zip(matches['geoidfq'], matches['namelsad'] + ', ' + matches['stusps']))
+        picked = search_cols[0].selectbox("Matches", list(labels), format_func=labels.get, key="ref_search_pick")
+        search_cols[1].write("")
+        if search_cols[1].button("Add", disabled=picked is None) and picked not in st.session_state.search_refs:
+            st.session_state.search_refs.append(picked)
+    if st.session_state.search_refs:
+        search_rows = store.rows_for_geoids(st.session_state.search_refs)
+        added = attrs.iloc[search_rows]
+        st.caption("Added from search: " + "; ".join(added['namelsad'] + ', ' + added['stusps']))
+        if st.button("Clear search picks"):
+            st.session_state.search_refs = []
+            st.rerun()
+
     selected_refs = []
     with st.container():
-        # Get unique states as a Series to use .sort_values()
-        unique_states = pd.Series(gdf['state_name'].unique()).sort_values()
+        unique_states = lookup.states
         
         for i in range(1, 11):
             cols = st.columns([0.5, 2, 2])
             cols[0].write(f"#{i}")
-            st_val = cols[1].selectbox(f"State", [""] + unique_states.tolist(), key=f"s{i}", label_visibility="collapsed")
+            st_val = cols[1].selectbox(f"State", [""] + unique_states, key=f"s{i}", label_visibility="collapsed")
             
             if st_val:
-                # Filter and sort places using Pandas
-                place_opts = gdf[gdf['state_name'] == st_val]['namelsad'].drop_duplicates().sort_values()
-                pl_val = cols[2].selectbox(f"Place", [""] + place_opts.tolist(), key=f"p{i}", label_visibility="collapsed")
+                # Sorted names come from the prebuilt lookup (no scan of the table)
+                place_opts = lookup.names(st_val)
+                pl_val = cols[2].selectbox(spec.geography.title(), [""] + place_opts, key=f"p{i}", label_visibility="collapsed")
                 
                 if pl_val:
                     selected_refs.append((st_val, pl_val))
             else:
-                cols[2].selectbox("Place", ["Select State"], disabled=True, key=f"p{i}", label_visibility="collapsed")
+                cols[2].selectbox(spec.geography.title(), ["Select State"], disabled=True, key=f"p{i}", label_visibility="collapsed")
 
     if st.button("Generate Reference Profile"):
-        if selected_refs:
-            # Extract GEOIDs
-            st.session_state.ref_geoids = [
-                gdf[(gdf['state_name'] == s) & (gdf['namelsad'] == p)]['geoidfq'].iloc[0]
-                for s, p in selected_refs
-            ]
+        if selected_refs or st.session_state.search_refs:
+            # Extract GEOIDs (selector rows first, then search picks; duplicates dropped)
+            ref_geoids = [lookup.geoid(s, p) for s, p in selected_refs] + st.session_state.search_refs
+            st.session_state.ref_geoids = list(dict.fromkeys(ref_geoids))
             st.success(f"Locked in {len(st.session_state.ref_geoids)} places. Move to Tab 2.")
         else:
             st.error("Please select at least one place.")
 
+# Time to interactive: data loaded and the reference pickers populated
+st.sidebar.caption(f"Ready in {(time.perf_counter() - SCRIPT_START) * 1000:.0f} ms")
+
 # --- TAB 2: DESCRIPTIVE STATS ---
 with tab2:
     if not st.session_state.ref_geoids:
         st.info("Waiting for Reference Selection in Tab 1...")
     else:
         st.header(f"Reference Profile Benchmarks: {st.session_state.customer_name}")
-        ref_df = gdf[gdf['geoidfq'].isin(st.session_state.ref_geoids)]
+        # Raw values and national percentiles of the reference rows (both frames are row-aligned with the store)
+        ref_rows = store.rows_for_geoids(st.session_state.ref_geoids)
+        national_pct = get_national_percentiles(level, store)
+        ref_df = pd.concat([attrs.iloc[ref_rows], national_pct.iloc[ref_rows]], axis=1)
         
         summary_rows = []
-        for group, metrics in METRIC_GROUPS.items():
+        for group, metrics in metric_groups.items():
             for m in metrics:
                 # 1. Round off raw values (using .round(0))
                 raw_vals = ref_df[m].astype(float)
@@ -330,7 +280,7 @@ with tab2:
         )
 
 # --- TAB 3: COMPARISON ---
-with tab3:
+with tab3, tracing('comparison', memory=debug_memory, enabled=debug_timings, level=level) as trace:
     if not st.session_state.ref_geoids:
         st.info("Waiting for Reference Selection in Tab 1...")
     else:
@@ -342,100 +292,103 @@ with tab3:
         # SIDEBAR PARAMETERS
         with st.sidebar:
             st.header("Search Parameters")
-            all_states = pd.Series(gdf['state_name'].unique()).sort_values()
+            all_states = pd.Series(store.state_names)
             target_states = st.multiselect("Comparison States", all_states.tolist(), default=all_states.tolist())
             pop_min = st.number_input("Min Population", value=5000, step=1000)
-            
+
+            # Geographic constraints around the references, applied to the universe before scoring
+            with st.expander("Geographic constraint"):
+                use_radius = st.checkbox("Only places near the references", value=False)
+                radius_km = st.number_input("Radius (km)", min_value=1.0, value=150.0, step=25.0, disabled=not use_radius)
+                use_bbox = st.checkbox("Only places inside a bounding box", value=False)
+                bbox_cols = st.columns(2)
+                min_lon = bbox_cols[0].number_input("West (lon)", value=-125.0, disabled=not use_bbox)
+                max_lon = bbox_cols[1].number_input("East (lon)", value=-66.0, disabled=not use_bbox)
+                min_lat = bbox_cols[0].number_input("South (lat)", value=24.0, disabled=not use_bbox)
+                max_lat = bbox_cols[1].number_input("North (lat)", value=50.0, disabled=not use_bbox)
+                exclude_adjacent = st.checkbox("Exclude places adjacent to the references", value=False)
+            spatial = SpatialFilter(
+                anchor_geoids=tuple(st.session_state.ref_geoids),
+                radius_km=radius_km if use_radius else None,
+                bbox=(min_lon, min_lat, max_lon, max_lat) if use_bbox else None,
+                exclude_adjacent=exclude_adjacent,
+            )
+
             st.divider()
             st.header("Metric Group Weights")
             weights = {}
-            for group in METRIC_GROUPS.keys():
+            for group in metric_groups.keys():
                 # Let's keep default weight = 1
                 weights[group] = st.slider(f"{group}", 0.0, 1.0, 0.5)
 
+            # Approximate KD-tree retrieval of the top results only; meant for large (tract / block group) tables.
+            # Off by default: the tree is built once per universe (about twice a full search) and only pays off
+            # over repeated searches in the same universe
+            use_index = st.toggle("Approximate indexed search (top results only)", value=False,
+                                  help="Candidates come from a KD-tree built once per state / population filter. "
+                                       "Exact for equal weights; with uneven weights a few look-alikes may be missed "
+                                       "and scores are only comparable within one search.")
+
             if st.button("🚀 Find Look-alike Markets", width="stretch"):
-                with st.spinner("Analyzing market similarity..."):
-                    res = run_similarity_logic(gdf, st.session_state.ref_geoids, target_states, pop_min, weights)
+                with st.spinner("Analyzing market similarity..."), trace_stage('app.search'):
+                    res = score_similarity(st.session_state.ref_geoids, target_states, pop_min, weights,
+                                           use_index=use_index, exact=not use_index, spatial=spatial)
                     if not res.empty:
-                        # 1. Bucket the ranks based on integer thresholds
-                        def assign_rank_bucket(r):
-                            if r <= 10:
-                                return "Top 10"
-                            elif r <= 25:
-                                return "11-25"
-                            elif r <= 50:
-                                return "26-50"
-                            else:
-                                return "50+"
-
-                        res['rank_bucket'] = res['rank'].apply(assign_rank_bucket)
                         st.session_state.analysis_results = res
+                        st.session_state.analysis_weights = weights
+
+            # Live weight tuning: after a search, moving a slider re-ranks the current results
+            # from their stored per-group distances (no filtering, percentiles or distances are redone)
+            if (st.session_state.analysis_results is not None
+                    and st.session_state.analysis_results.group_dists is not None
+                    and weights != st.session_state.get('analysis_weights')):
+                with trace_stage('app.reweight'):
+                    st.session_state.analysis_results = st.session_state.analysis_results.reweight(weights)
+                st.session_state.analysis_weights = weights
+            cache_stats = similarity_cache.stats()
+            st.caption(
+                f"Result cache: {cache_stats['results']['hits']} hits / {cache_stats['results']['misses']} misses | "
+                f"Universe cache: {cache_stats['universes']['hits']} hits / {cache_stats['universes']['misses']} misses"
+            )
                     
         # 3. DISPLAY RESULTS
         if st.session_state.analysis_results is not None:
             results = st.session_state.analysis_results
             
             # --- MAP SECTION ---
+            import geopandas as gpd
+            from streamlit_folium import st_folium
+            from src.visualizer import zoom_to_tier, build_similarity_map
             st.subheader(f"Strategic Market Map: {st.session_state.customer_name}")
             
-            # Create Map
+            # Shapes come pre-simplified for the map's zoom level; nothing is simplified on rerun
             # Zoom level 5 is usually the "sweet spot" for US-wide but focused views
-            m = folium.Map(location=[39.8283, -98.5795], zoom_start=5, tiles='cartodbpositron')
-
-            # A. PLOT REFERENCE CITIES (The Anchors)
-            ref_gdf = gdf[gdf['geoidfq'].isin(st.session_state.ref_geoids)].copy()
-            ref_gdf['geometry'] = ref_gdf.simplify(tolerance=0.01)
-            
-            for _, row in ref_gdf.iterrows():
-                folium.GeoJson(
-                    row['geometry'],
-                    style_function=lambda x: {
-                        'fillColor': '#00BFFF', # Deep Sky Blue
-                        'color': '#00008B',     # Dark Blue Border
-                        'weight': 3,            # Thicker border for references
-                        'fillOpacity': 0.8,
-                    },
-                    tooltip=f"<b>REFERENCE:</b> {row['namelsad']}"
-                ).add_to(m)
-
-            # B. PLOT CANDIDATES (Top 500)
-            map_gdf = results.head(500).copy()
-            map_gdf['geometry'] = map_gdf.simplify(tolerance=0.01)
-
-            for _, row in map_gdf.iterrows():
-                # Build formatted tooltip
-                tooltip_html = f"""
-                <div style="font-family: sans-serif; font-size: 12px; min-width: 150px;">
-                    <b style="font-size: 14px;">{row['namelsad']}, {row['stusps']}</b><br>
-                    <span style="color: gray;">Rank: #{row['rank']}</span><br>
-                    <hr style="margin: 5px 0;">
-                    <b>Overall Sim: {row['overall_similarity']:.1f}%</b><br>
-                    ACS: {row['acs_base_sim']:.1f}%<br>
-                    Income: {row['acs_income_sim']:.1f}%<br>
-                    Property: {row['property_sim']:.1f}%<br>
-                    Growth: {row['growth_sim']:.1f}%
-                </div>
-                """
-
-                # Inside your for _, row in map_gdf.iterrows(): loop
-                current_color = get_color(row['rank_bucket']) # Pre-calculate color for this specific row
-                
-                folium.GeoJson(
-                    row['geometry'],
-                    style_function=lambda x, fillColor=current_color: { # Capture color here
-                        'fillColor': fillColor,
-                        'color': 'black',
-                        'weight': 1.5,
-                        'fillOpacity': 0.7,
-                        },
-                        tooltip=tooltip_html
-                        ).add_to(m)
-
-            # Add legend
-            add_map_legend(m)
+            zoom_start = 5
+            with trace_stage('app.map'):
+                geometry_tiers = get_geometry_tiers(level, store)
+                tier = zoom_to_tier(zoom_start)
+
+                # A. REFERENCE CITIES (The Anchors)
+                ref_gdf = attrs.iloc[store.rows_for_geoids(st.session_state.ref_geoids)][['geoidfq', 'namelsad']].copy()
+                ref_gdf = gpd.GeoDataFrame(ref_gdf, geometry=geometry_tiers.get(ref_gdf['geoidfq'], tier).values)
+
+                # B. CANDIDATES (Top MAP_TOP_K)
+                # Results carry no geometry; attach the prebuilt shapes by geoidfq
+                top_results = results.top()
+                map_gdf = gpd.GeoDataFrame(top_results, geometry=geometry_tiers.get(top_results['geoidfq'], tier).values)
+
+                # One FeatureCollection layer per group, styled from the rank_bucket property
+                # Rendering the HTML to measure it costs as much as st_folium's own render, so only when debugging
+                m, map_stats = build_similarity_map(ref_gdf, map_gdf, zoom_start=zoom_start, measure=debug_timings)
+            map_caption = f"{map_stats['n_features']:,} shapes | map built in {map_stats['build_seconds'] * 1000:.0f} ms"
+            if 'html_bytes' in map_stats:
+                map_caption += (f" | HTML {map_stats['html_bytes'] / 1e6:.1f} MB rendered in "
+                                f"{map_stats['render_seconds'] * 1000:.0f} ms")
+            st.caption(map_caption)
 
             # Render the map
-            st_folium(m, width=1400, height=650, key="discovery_map")
+            with trace_stage('app.map_component'):
+                st_folium(m, width=1400, height=650, key="discovery_map")
 
             st.divider()
 
@@ -443,11 +396,11 @@ with tab3:
             st.subheader("Market Comparison Data (Top 50)")
 
             # Define group sim columns dynamically
-            group_sim_cols = [f"{g.lower().replace(' ', '_')}_sim" for g in METRIC_GROUPS.keys()]
+            group_sim_cols = [group_sim_col(g) for g in metric_groups.keys()]
             display_cols = ['rank', 'namelsad', 'state_name', 'pop_2024', 'overall_similarity'] + group_sim_cols
 
             # Clean display selection
-            final_table = results[display_cols].head(50)
+            final_table = results.top()[display_cols].head(50)
 
             # Build formatter more explicitly to satisfy type checkers
             # Instead of using | to merge, we'll initialize and update
@@ -461,11 +414,94 @@ with tab3:
                 height=450
             )
 
-            # CSV Export
-            csv = results[display_cols].to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📥 Download Full Search Results",
-                data=csv,
-                file_name=f"{st.session_state.customer_name}_market_discovery.csv",
-                mime='text/csv',
-            )
\ No newline at end of file
+            # Where each reference sits in the search universe (projected when it is outside the universe)
+            if results.references is not None and not results.references.empty:
+                with st.expander("Reference positions in the Search Universe (local percentile)"):
+                    st.dataframe(results.references.set_index('geoidfq'), width="stretch")
+
+            # Weight sensitivity: rescore the results under many sampled weightings (one matrix product per batch,
+            # see src.sensitivity) and show how stable each candidate's rank is
+            if results.group_dists is not None:
+                with st.expander("🎯 Weight Sensitivity (rank stability)"):
+                    sens_cols = st.columns(3)
+                    sens_method = sens_cols[0].radio("Sampling", SAMPLING_METHODS,
+                                                     format_func=lambda key: key.replace('_', ' ').title())
+                    sens_samples = sens_cols[1].number_input("Weightings", min_value=10, max_value=10_000,
+                                                             value=SENSITIVITY_SAMPLES, step=100,
+                                                             disabled=sens_method == 'grid')
+                    sens_spread = sens_cols[2].slider("Spread around the chosen weights", 0.01, 0.5, 0.15,
+                                                      disabled=sens_method == 'grid')
+                    sens_request = {'method': sens_method, 'n_samples': sens_samples, 'spread': sens_spread}
+
+                    # A report is only shown for the current results and settings
+                    sensitivity = st.session_state.get('sensitivity')
+                    if sensitivity is not None and (sensitivity['results'] is not results
+                                                    or sensitivity['request'] != sens_request):
+                        sensitivity = st.session_state.sensitivity = None
+
+                    if st.button("Run sensitivity analysis"):
+                        with st.spinner("Scoring sampled weightings..."), trace_stage('app.sensitivity'):
+                            report = rank_stability(results, weights, **sens_request)
+                        sensitivity = st.session_state.sensitivity = {'results': results, 'request': sens_request,
+                                                                      'report': report}
+
+                    if sensitivity is not None:
+                        report = sensitivity['report']
+                        st.caption(f"{len(report.samples):,} weightings scored in {report.seconds:.1f} s "
+                                   f"({report.workers} process{'es' if report.workers > 1 else ''}); "
+                                   f"candidates that reached the top {TRACK_TOP_K} under any weighting")
+                        share_col = f'top{report.top_n}_share'
+                        st.dataframe(
+                            report.frame.drop(columns=['geoidfq']).style.format(
+                                {share_col: "{:.0%}", 'median_rank': "{:.1f}", 'pop_2024': "{:,}",
+                                 **{col: "{:.1f}" for col in report.frame.columns if col.startswith('rank_p')}}),
+                            width="stretch", height=400)
+
+            # Export: nothing is generated on reruns; "Prepare file" streams the export chunk by chunk
+            # into a temporary file (bounded memory, see src.export) and the download button serves that file.
+            # The files live in one temporary directory per session, removed with the session state
+            # (TemporaryDirectory cleans up when it is garbage collected, and at exit)
+            with st.expander("📥 Download Search Results"):
+                export_cols = st.columns(3)
+                export_format = export_cols[0].selectbox(
+                    "Format", list(EXPORT_FORMATS), format_func=lambda key: EXPORT_FORMATS[key].label)
+                export_top_n = export_cols[1].number_input("Top N (0 = all)", min_value=0, value=0, step=100)
+                export_columns = export_cols[2].multiselect("Columns", results.columns(), default=display_cols)
+                export_request = {'format': export_format, 'top_n': export_top_n, 'columns': export_columns}
+
+                # A prepared file is only offered for the current results and export settings
+                export = st.session_state.get('export')
+                if export is not None and (export['results'] is not results or export['request'] != export_request):
+                    Path(export['path']).unlink(missing_ok=True)
+                    export = st.session_state.export = None
+
+                if st.button("Prepare file", disabled=not export_columns):
+                    fmt = EXPORT_FORMATS[export_format]
+                    if 'export_dir' not in st.session_state:
+                        st.session_state.export_dir = tempfile.TemporaryDirectory(prefix='market_discovery_')
+                    export_path = Path(st.session_state.export_dir.name) / export_file_name('market_discovery', export_format)
+                    with st.spinner(f"Writing {fmt.label} export..."), trace_stage('app.export'):
+                        write_export(results, export_path, export_format, columns=export_columns,
+                                     top_n=export_top_n or None,
+                                     geometry_tiers=get_geometry_tiers(level, store) if fmt.geometry else None)
+                    export = st.session_state.export = {'results': results, 'request': export_request, 'path': export_path}
+
+                if export is not None:
+                    with open(export['path'], 'rb') as f:
+                        st.download_button(
+                            label=f"📥 Download {EXPORT_FORMATS[export_format].label} "
+                                  f"({Path(export['path']).stat().st_size / 1e6:.1f} MB)",
+                            data=f,
+                            file_name=export_file_name(f"{st.session_state.customer_name}_market_discovery", export_format),
+                            mime=EXPORT_FORMATS[export_format].mime,
+                        )
+
+# Stage timings of this comparison run; only collected when "Debug timings" is on
+if trace is not None and trace.spans:
+    write_trace(trace)
+    with st.sidebar.expander("Debug: stage timings", expanded=True):
+        st.caption(f"Run total {trace.seconds * 1000:.0f} ms")
+        timings = trace.to_frame()
+        timings['ms'] = timings['seconds'] * 1000
+        cols = ['stage', 'ms', 'rows'] + (['alloc_bytes', 'peak_bytes'] if trace.memory else []) + ['info']
+        st.dataframe(timings[cols].assign(info=timings['info'].astype(str)), hide_index=True, width="stretch")
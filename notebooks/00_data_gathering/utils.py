@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import sys
 from datetime import datetime, timedelta
 import subprocess
 import time
@@ -16,6 +17,14 @@ def find_project_root(start:Path | None=None)-> Path:
             return p
     raise FileNotFoundError("Project root not found")
 
+# Helper to make the project's src package importable from the notebooks
+# The ACS download code lives in src/acs_download.py; notebooks import it instead of keeping a copy
+def add_project_root_to_path() -> Path:
+    root = find_project_root()
+    if str(root) not in sys.path:
+        sys.path.insert(0, str(root))
+    return root
+
 # Function to authenticate gcs credentials
 def check_and_authenticate(json_path):
     '''
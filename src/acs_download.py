@@ -0,0 +1,265 @@
+import dataclasses
+import json
+import os
+import ssl
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+import pandas as pd
+
+from src.utils import find_project_root
+
+
+# Downloader for the ACS table-based summary files (promoted from the 01_downloading_acs_* notebooks)
+# Every national .dat file is streamed once, in chunks, and filtered to the wanted sumlevels/states while reading,
+# so peak memory is one chunk. Tables are fetched in parallel and unchanged tables are skipped on reruns.
+
+# ACS DOWNLOAD URL (a format string with {year} and {dataset}; pass base_url to point the downloader elsewhere, e.g. a mirror)
+ACS_BASE_URL = "https://www2.census.gov/programs-surveys/acs/summary_file/{year}/table-based-SF/data/{dataset}YRData/acsdt{dataset}y{year}"
+
+# Summary level dictionary for reference
+SUM_LEVEL_DICT = {
+    '010': 'nation',
+    '040': 'state',
+    '050': 'county',
+    '060': 'county_subdivision',
+    '140': 'census_tract',
+    '150': 'block_group',
+    '160': 'place',
+    '310': 'cbsa',
+    '860': 'zcta',
+    '950': 'el_sch_dist',
+    '960': 'sec_sch_dist',
+    '970': 'uni_sch_dist'
+}
+
+# Geography name used in the output file names
+GEO_NAMES = {'060': 'subdivision', '140': 'tract', '150': 'block_group', '160': 'place'}
+
+# Downloaded ACS data should be stored in root folder / data / raw / ACS
+RAW_ACS_DIR = find_project_root() / "data" / "raw" / "ACS"
+CHUNK_SIZE = 200_000
+MAX_WORKERS = 4
+
+
+# Helper function to build URL for an ACS table
+def build_file_url(year:int, dataset:int, table_id:str, base_url:str=ACS_BASE_URL) -> str:
+    return base_url.format(year=year, dataset=dataset) + f"-{table_id.lower()}.dat"
+
+
+# Helper to convert columns from ACS data dictionary to actual columns in dat files
+def get_acs_downloadable_columns(table_id:str, uids:list[str]) -> list[str]:
+    cols = []
+    for uid in uids:
+        num = uid.split("_")[1] # "001"
+        cols.append(f"{table_id}_E{num}")
+        cols.append(f"{table_id}_M{num}")
+    return cols
+
+
+# One output file: the rows of one table for one sumlevel and state
+@dataclass
+class AcsExtract:
+    '''
+    - uids: table cells to keep (as in ACS_TABLE_DOC); None keeps every column of the table
+    - state: "all" or a two-digit state code (e.g., "06" for California)
+    - outdir: defaults to data/raw/ACS/<dataset>yr/sumlevel_<name>, the layout used by the notebooks
+    - base_url: URL format of the summary files (see ACS_BASE_URL)
+    '''
+    table_id: str
+    year: int
+    dataset: int
+    sumlevel: str
+    state: str = 'all'
+    uids: list[str] | None = None
+    outdir: Path | None = None
+    base_url: str = ACS_BASE_URL
+
+    def __post_init__(self):
+        # Normalize state just in case
+        self.state = self.state.lower()
+        if self.outdir is None:
+            self.outdir = RAW_ACS_DIR / f"{self.dataset}yr" / f"sumlevel_{SUM_LEVEL_DICT[self.sumlevel]}"
+        self.outdir = Path(self.outdir)
+
+    @property
+    def url(self) -> str:
+        return build_file_url(self.year, self.dataset, self.table_id, self.base_url)
+
+    @property
+    def usecols(self) -> list[str] | None:
+        if self.uids is None:
+            return None
+        return ["GEO_ID"] + get_acs_downloadable_columns(self.table_id, self.uids)
+
+    @property
+    def geo_prefix(self) -> str:
+        # GEO_ID looks like: {sumlevel}0000US{state}-{county}-{tract}
+        if self.state == 'all':
+            return self.sumlevel
+        return f"{self.sumlevel}0000US{self.state.zfill(2)}"
+
+    @property
+    def outpath(self) -> Path:
+        geo_name = GEO_NAMES.get(self.sumlevel, "unknown_geo")
+        return self.outdir / f"{self.table_id}_{geo_name}_state_{self.state}_{self.year}.csv"
+
+
+# Function to build the extracts of a batch download from an ACS_TABLE_DOC style dictionary
+def build_extracts(table_doc:dict, years:list[int], dataset:int, sumlevels:list[str],
+                   states:list[str] | None=None, outdir:dict[str, Path] | None=None,
+                   base_url:str=ACS_BASE_URL) -> list[AcsExtract]:
+    '''
+    Crosses tables * years * sumlevels * states.
+    A table whose doc entry has "years" is only requested for those years (1-yr tables).
+    outdir optionally maps sumlevel -> output directory.
+    '''
+    states = states or ['all']
+    outdir = outdir or {}
+    extracts = []
+    for year in years:
+        for table_id, meta in table_doc.items():
+            if 'years' in meta and year not in meta['years']:
+                continue
+            for sumlevel in sumlevels:
+                for state in states:
+                    extracts.append(AcsExtract(table_id, year, dataset, sumlevel, state, meta.get('uids'),
+                                               outdir.get(sumlevel), base_url))
+    return extracts
+
+
+# On-disk record of what has been downloaded, keyed by output file
+class DownloadCache:
+    '''
+    Stores, per output file, the source URL, the remote validators (ETag, size, Last-Modified) and the kept columns.
+    An output is current when the file exists and the remote file still has the same validators.
+    The manifest is rewritten after every table, so an interrupted run resumes where it stopped.
+    '''
+    def __init__(self, manifest_path:Path | str | None=None):
+        self.manifest_path = Path(manifest_path or RAW_ACS_DIR / "download_manifest.json")
+        self.entries = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+        self._lock = threading.Lock()
+
+    def is_current(self, extract:AcsExtract, validators:dict) -> bool:
+        # Without any validator the remote file cannot be compared, so it is always downloaded
+        if not any(validators.values()) or not extract.outpath.exists():
+            return False
+        entry = self.entries.get(str(extract.outpath))
+        return entry == self._entry(extract, validators)
+
+    def record(self, extract:AcsExtract, validators:dict) -> None:
+        with self._lock:
+            self.entries[str(extract.outpath)] = self._entry(extract, validators)
+            os.makedirs(self.manifest_path.parent, exist_ok=True)
+            tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+            tmp_path.write_text(json.dumps(self.entries, indent=2))
+            os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _entry(extract:AcsExtract, validators:dict) -> dict:
+        return {'url': extract.url, 'usecols': extract.usecols, **validators}
+
+
+# Helper for the https context; certifi is used when installed (same as the notebooks)
+def _ssl_context() -> ssl.SSLContext:
+    try:
+        import certifi
+        return ssl.create_default_context(cafile=certifi.where())
+    except ImportError:
+        return ssl.create_default_context()
+
+
+# Function to read the validators of a remote file without downloading it
+def remote_validators(url:str, timeout:float=60) -> dict:
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=timeout, context=_ssl_context()) as response:
+        return {
+            'etag': response.headers.get('ETag'),
+            'size': response.headers.get('Content-Length'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+
+# Function to stream one national file and write every extract of it
+def stream_extracts(url:str, extracts:list[AcsExtract], chunk_size:int=CHUNK_SIZE, timeout:float=60) -> None:
+    '''
+    Reads the pipe-delimited file in chunks and appends the matching rows of each chunk to every extract.
+    Outputs are written to a temporary file and renamed when complete, so partial files never look finished.
+    '''
+    all_cols = [extract.usecols for extract in extracts]
+    usecols = None if any(cols is None for cols in all_cols) else sorted(set().union(*all_cols))
+    tmp_paths = {}
+    handles = {}
+    try:
+        for extract in extracts:
+            os.makedirs(extract.outdir, exist_ok=True)
+            tmp_paths[extract.outpath] = extract.outpath.with_name(extract.outpath.name + '.tmp')
+            handles[extract.outpath] = open(tmp_paths[extract.outpath], 'w', newline='')
+
+        with urllib.request.urlopen(url, timeout=timeout, context=_ssl_context()) as response:
+            reader = pd.read_csv(response, sep="|", dtype=str, usecols=usecols, chunksize=chunk_size)
+            for n_chunk, chunk in enumerate(reader):
+                geo_id = chunk["GEO_ID"]
+                for extract in extracts:
+                    rows = chunk.loc[geo_id.str.startswith(extract.geo_prefix), extract.usecols or chunk.columns]
+                    rows.to_csv(handles[extract.outpath], header=n_chunk == 0, index=False)
+
+        for outpath, handle in handles.items():
+            handle.close()
+            os.replace(tmp_paths[outpath], outpath)
+    except BaseException:
+        for outpath, handle in handles.items():
+            handle.close()
+            tmp_paths[outpath].unlink(missing_ok=True)
+        raise
+
+
+# Function to run a batch download
+def download_acs(extracts:list[AcsExtract], cache:DownloadCache | None=None, max_workers:int=MAX_WORKERS,
+                 chunk_size:int=CHUNK_SIZE, force:bool=False, base_url:str | None=None,
+                 timeout:float=60) -> dict[str, list[Path]]:
+    '''
+    Downloads every extract, one national file per worker (at most max_workers at a time).
+    Extracts of the same table/year share one streamed read of the file.
+    Outputs whose source is unchanged since the last run (see DownloadCache) are skipped unless force=True.
+    base_url, when set, replaces the base_url of every extract (e.g. a mirror or a local stand-in for tests).
+    Returns the output paths grouped as downloaded / skipped / failed.
+    '''
+    cache = cache or DownloadCache()
+    if base_url is not None:
+        extracts = [dataclasses.replace(extract, base_url=base_url) for extract in extracts]
+    by_url = {}
+    for extract in extracts:
+        by_url.setdefault(extract.url, []).append(extract)
+
+    def fetch(url:str, url_extracts:list[AcsExtract]) -> tuple[list[AcsExtract], list[AcsExtract]]:
+        validators = remote_validators(url, timeout)
+        pending = [e for e in url_extracts if force or not cache.is_current(e, validators)]
+        if pending:
+            start_time = time.time()
+            stream_extracts(url, pending, chunk_size, timeout)
+            for extract in pending:
+                cache.record(extract, validators)
+            print(f"Saved {len(pending)} file(s) from {url} in {time.time() - start_time:.2f} seconds")
+        return pending, [e for e in url_extracts if e not in pending]
+
+    summary = {'downloaded': [], 'skipped': [], 'failed': []}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fetch, url, url_extracts): url for url, url_extracts in by_url.items()}
+        for job_num, future in enumerate(as_completed(futures), start=1):
+            url = futures[future]
+            try:
+                downloaded, skipped = future.result()
+            except Exception as e:
+                print(f"Error in job {job_num}/{len(futures)}: {url} ({e})")
+                summary['failed'] += [extract.outpath for extract in by_url[url]]
+                continue
+            summary['downloaded'] += [extract.outpath for extract in downloaded]
+            summary['skipped'] += [extract.outpath for extract in skipped]
+
+    print(f"Downloaded {len(summary['downloaded'])}, skipped {len(summary['skipped'])} unchanged, "
+          f"failed {len(summary['failed'])} file(s)")
+    return summary
@@ -1,2 +1,494 @@
+import copy
+import warnings
 import pandas as pd
 import numpy as np
+
+from src.config import METRICS, metric_groups_for
+from src.tracing import trace_stage
+
+
+# Presorted rank index: the main speed-up for local percentiles
+# Each metric is sorted once at load time; a query then only filters the presorted order
+class RankIndex:
+    '''
+    Presorts every metric once so that local percentiles for any subset (universe)
+    can be answered with array work instead of Series.rank() per metric per click.
+
+    Percentiles match pandas' rank(pct=True): ties get their average rank and NaNs stay NaN
+    (the denominator is the number of non-null values in the subset).
+    '''
+    def __init__(self, features:np.ndarray, metrics:list[str]=METRICS):
+        '''
+        features is the [rows * metrics] matrix of the FeatureStore in metrics order; pass store.rank_values()
+        (float64) rather than the float32 store.features so large values do not tie
+        '''
+        self.metrics = list(metrics)
+        self.n_rows = features.shape[0]
+        values = np.asarray(features)
+        # argsort puts NaN last, so the valid values are always a prefix of each column
+        self.order = np.argsort(values, axis=0, kind='stable')
+        self.sorted_values = np.take_along_axis(values, self.order, axis=0)
+
+    @classmethod
+    def from_arrays(cls, order:np.ndarray, sorted_values:np.ndarray, metrics:list[str]=METRICS) -> 'RankIndex':
+        '''
+        Rebuilds an index from saved order / sorted_values arrays (e.g. memory-mapped ones) without sorting again
+        '''
+        index = cls.__new__(cls)
+        index.metrics = list(metrics)
+        index.n_rows = order.shape[0]
+        index.order = order
+        index.sorted_values = sorted_values
+        return index
+
+    def local_percentiles(self, mask:np.ndarray) -> np.ndarray:
+        '''
+        Given a boolean mask over the rows of the indexed frame, return a matrix of
+        local percentiles (0.0 to 1.0) with shape [rows in mask * metrics].
+        Rows are in the same order as features[mask].
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        # Position of each selected row inside the universe (gdf[mask]) ordering
+        universe_pos = np.cumsum(mask) - 1
+        out = np.full((int(mask.sum()), len(self.metrics)), np.nan)
+
+        for j in range(len(self.metrics)):
+            col_order = self.order[:, j]
+            in_universe = mask[col_order]
+            # Universe values for this metric, already sorted
+            sub_vals = self.sorted_values[in_universe, j]
+            sub_rows = col_order[in_universe]
+            valid = ~np.isnan(sub_vals)
+            n_valid = int(valid.sum())
+            if n_valid == 0:
+                continue
+            vals = sub_vals[:n_valid]
+            # Average rank for ties: positions lo+1 .. hi share the rank (lo + 1 + hi) / 2
+            lo = np.searchsorted(vals, vals, side='left')
+            hi = np.searchsorted(vals, vals, side='right')
+            out[universe_pos[sub_rows[:n_valid]], j] = (lo + 1 + hi) / 2 / n_valid
+        return out
+
+    def sorted_subset(self, mask:np.ndarray) -> np.ndarray:
+        '''
+        Features of the rows in mask with every column sorted ascending (NaN last), shape [rows in mask * metrics].
+        Filters the presorted order, so no sort runs per query.
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        out = np.empty((int(mask.sum()), len(self.metrics)), dtype=self.sorted_values.dtype)
+        for j in range(len(self.metrics)):
+            out[:, j] = self.sorted_values[mask[self.order[:, j]], j]
+        return out
+
+
+# Raised (as a warning) when none of the reference places are inside the search universe
+class ReferenceOutsideUniverseWarning(UserWarning):
+    pass
+
+OUTSIDE_UNIVERSE_NOTE = (
+    "Note: Reference cities are outside the selected Search Universe. "
+    "Their scores are being benchmarked against the local market's distribution."
+)
+
+
+# Column name used for the scaled similarity of one metric group, e.g. "ACS Base" -> "acs_base_sim"
+def group_sim_col(group:str) -> str:
+    return f"{group.lower().replace(' ', '_')}_sim"
+
+
+# Function to select the search universe
+def universe_mask(store, target_states:list[str], pop_min:float, extra_mask:np.ndarray | None=None) -> np.ndarray:
+    '''
+    Boolean mask over the rows of store for places in target_states with pop_2024 >= pop_min
+    extra_mask (e.g. a spatial constraint, see src.spatial_filter.SpatialFilter) narrows it further.
+    '''
+    mask = (
+        store.state_mask(target_states) &
+        (store.features[:, store.metric_index('pop_2024')] >= pop_min)
+    )
+    if extra_mask is not None:
+        mask &= extra_mask
+    return mask
+
+
+# Function to project raw values into the distribution of a universe
+def project_percentiles(sorted_values:np.ndarray, raw_values:np.ndarray) -> np.ndarray:
+    '''
+    sorted_values: [universe rows * metrics] with every column sorted ascending (NaN last)
+    raw_values: [references * metrics] raw values of the references
+    Returns the share of universe rows with a value <= the raw value (0.0 to 1.0), shape [references * metrics].
+    One searchsorted per metric covers every reference; NaN raw values stay NaN.
+    '''
+    raw_values = np.asarray(raw_values)
+    out = np.full(raw_values.shape, np.nan)
+    n_rows = sorted_values.shape[0]
+    if n_rows == 0:
+        return out
+    for j in range(raw_values.shape[1]):
+        # This 'projects' the reference raw value into the universe distribution
+        out[:, j] = np.searchsorted(sorted_values[:, j], raw_values[:, j], side='right') / n_rows
+    out[np.isnan(raw_values)] = np.nan
+    return out
+
+
+# Function to build the local target vector of each reference set
+def build_target_vectors(store, universe_rows:np.ndarray, local_pct:np.ndarray, ref_geoid_sets:list[list[str]],
+                         sorted_values=None):
+    '''
+    For each reference set, look up how the reference places rank WITHIN the universe.
+    Returns:
+        - targets: [reference sets * metrics] matrix of local percentiles
+        - ref_masks: [reference sets * universe rows] boolean matrix, True where the row is a reference
+        - outside: list of bools, True where no reference of the set is inside the universe
+        - ref_pcts: per reference set, [references * metrics] local percentiles of each reference
+          (rows in store.rows_for_geoids order): its row of local_pct when inside the universe,
+          its projection into the universe distribution otherwise
+    sorted_values are the universe rank values (store.rank_values) with every column sorted (NaN last), or a callable returning them
+    (e.g. Universe.sorted_values). They are only used when a reference is outside the universe
+    and are sorted here when not given.
+    '''
+    targets = np.empty((len(ref_geoid_sets), local_pct.shape[1]))
+    ref_masks = np.zeros((len(ref_geoid_sets), universe_rows.size), dtype=bool)
+    outside = []
+    ref_pcts = []
+    for k, ref_geoids in enumerate(ref_geoid_sets):
+        # Locate the references by id, then inside the (sorted) universe rows
+        ref_rows = store.rows_for_geoids(ref_geoids)
+        pos = np.searchsorted(universe_rows, ref_rows)
+        in_universe = pos < universe_rows.size
+        in_universe[in_universe] = universe_rows[pos[in_universe]] == ref_rows[in_universe]
+        ref_mask = ref_masks[k]
+        ref_mask[pos[in_universe]] = True
+        outside.append(not ref_mask.any())
+
+        ref_pct = np.empty((ref_rows.size, local_pct.shape[1]))
+        ref_pct[in_universe] = local_pct[pos[in_universe]]
+        if not in_universe.all():
+            if callable(sorted_values):
+                sorted_values = sorted_values()
+            if sorted_values is None:
+                sorted_values = np.sort(store.rank_values(universe_rows), axis=0)
+            ref_pct[~in_universe] = project_percentiles(sorted_values, store.rank_values(ref_rows[~in_universe]))
+        ref_pcts.append(ref_pct)
+
+        if ref_mask.any():
+            # Standard: Reference cities are part of the subset, just average their local ranks
+            targets[k] = np.nanmean(local_pct[ref_mask], axis=0)
+        else:
+            # Fallback: average the projections of the references into the local percentile distribution
+            # A metric without any value among the references counts as the bottom of the distribution
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                targets[k] = np.nan_to_num(np.nanmean(ref_pct, axis=0), nan=0.0)
+    return targets, ref_masks, outside, ref_pcts
+
+
+# Function to lay out the per-reference local percentiles for display
+def reference_frame(store, universe_rows:np.ndarray, ref_geoids, ref_pct:np.ndarray, metrics:list[str]=METRICS) -> pd.DataFrame:
+    '''
+    One row per known reference (indexed by row position in store) with in_universe
+    and the local percentile (0-100) of every metric as <metric>_local_pct.
+    '''
+    ref_rows = store.rows_for_geoids(ref_geoids)
+    frame = store.attrs.iloc[ref_rows][['geoidfq', 'namelsad', 'state_name']].copy()
+    frame['in_universe'] = np.isin(ref_rows, universe_rows)
+    for j, m in enumerate(metrics):
+        frame[f'{m}_local_pct'] = np.round(ref_pct[:, j] * 100, 1)
+    return frame
+
+
+# Function to calculate per-group distances for many targets at once
+def group_sq_distances(local_pct:np.ndarray, targets:np.ndarray, metrics:list[str]=METRICS) -> dict[str, np.ndarray]:
+    '''
+    Squared Euclidean distance between every universe row and every target, per metric group.
+    Returns {group: [universe rows * targets]}.
+    Uses ||x||^2 - 2 x.t + ||t||^2 so K targets cost one matrix product instead of K cdist calls.
+    Distance metric: we've used squared euclidean to prioritize balanced candidates
+    (square the distance and taking square roots penalizes outliers, same concept as standard deviation).
+    Only the groups (and group members) present in metrics are used, so every dataset level shares this engine.
+    '''
+    metric_pos = {m: j for j, m in enumerate(metrics)}
+    dists = {}
+    for group, group_metrics in metric_groups_for(metrics).items():
+        group_idx = [metric_pos[m] for m in group_metrics]
+        # For this metric group, create matrix with geographies (rows) * relevant columns (columns)
+        group_candidates = np.nan_to_num(local_pct[:, group_idx], nan=0.0)
+        group_targets = targets[:, group_idx]
+        d = (
+            np.einsum('ij,ij->i', group_candidates, group_candidates)[:, None]
+            - 2 * group_candidates @ group_targets.T
+            + np.einsum('ij,ij->i', group_targets, group_targets)[None, :]
+        )
+        # Round-off can push exact matches slightly below zero
+        np.maximum(d, 0, out=d)
+        dists[group] = d
+    return dists
+
+
+# Function to turn per-group distances of one target into 0-100 similarity scores
+def scale_similarity(group_dists:dict[str, np.ndarray], weights:dict[str, float]) -> dict[str, np.ndarray]:
+    '''
+    group_dists holds the squared distance vector of each metric group for a single target.
+    Returns {'overall_similarity': ..., '<group>_sim': ...} arrays aligned with the universe rows.
+    '''
+    scores = {'overall_similarity': weighted_similarity(group_dists, weights)}
+
+    # Step C: Scale Group Similarities individually for tooltips/display (on the root distance)
+    # These do not depend on the weights
+    for group, dists in group_dists.items():
+        scores[group_sim_col(group)] = _min_max_similarity(np.sqrt(dists))
+    return scores
+
+
+# Function to combine per-group squared distances into the overall 0-100 similarity
+def weighted_similarity(group_dists:dict[str, np.ndarray], weights:dict[str, float]) -> np.ndarray:
+    # Methodology: We use Root Mean Square Error (RMSE) across weighted groups.
+    # To ensure a 0-100 similarity score, we scale the distances relative to the best/worst in the sample.
+    total_weight = sum(weights.values())
+    weighted_distances_sq = 0
+    for group, dists in group_dists.items():
+        weighted_distances_sq = weighted_distances_sq + dists * weights.get(group, 0.5)
+
+    # Step A: Calculate final weighted root distance
+    final_rmse = np.sqrt(weighted_distances_sq / total_weight)
+
+    # Step B: Apply Min-Max scaling to overall similarity
+    # Similarity = 100 * (1 - (dist - min_dist) / (max_dist - min_dist))
+    return _min_max_similarity(final_rmse)
+
+
+def _min_max_similarity(dists:np.ndarray) -> np.ndarray:
+    d_min, d_max = dists.min(), dists.max()
+    if d_max > d_min:
+        return 100 * (1 - (dists - d_min) / (d_max - d_min))
+    return np.full(dists.shape, 100.0)
+
+
+# Helper to order the best k values (descending) without sorting everything
+def top_k_order(values:np.ndarray, k:int | None=None) -> np.ndarray:
+    '''
+    Positions of the k largest values, best first. NaN sorts last and ties keep their original order,
+    so the first k positions of the full ordering (k=None) are always the same as the top-k ordering.
+    Uses a partition (O(n)) to find the k-th value and only sorts the k selected positions.
+    '''
+    key = np.where(np.isnan(values), -np.inf, values)
+    n = key.size
+    if k is None or k >= n:
+        return np.argsort(-key, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = -np.partition(-key, k - 1)[k - 1]
+    above = np.flatnonzero(key > kth)
+    ties = np.flatnonzero(key == kth)[:k - above.size]
+    selected = np.concatenate([above, ties])
+    return selected[np.argsort(-key[selected], kind='stable')]
+
+
+# Ranked output of one similarity run
+class RankedResults:
+    '''
+    Candidates of one run (references excluded) with their scores kept as arrays.
+    Ranked frames are only built on request:
+        - top(k): the k best candidates, found with a partial selection (no full sort, no large copy)
+        - full(): every candidate in rank order, built once and cached
+        - iter_frames(): the ranking in chunks, for exports (nothing is cached; see src.export)
+        - reweight(weights): new results for other group weights, reusing the per-group distances
+    Frames hold attribute columns only and are indexed by row position in store.
+    references is the reference_frame of the run (local position of every reference), when available.
+    group_dists are the per-group squared distances over the whole universe (references included),
+    since the min-max scaling of the overall score is relative to the whole universe.
+    '''
+    def __init__(self, store, universe_rows:np.ndarray, ref_mask:np.ndarray, scores:dict[str, np.ndarray],
+                 top_k:int | None=None, references_outside:bool=False,
+                 group_dists:dict[str, np.ndarray] | None=None, references:pd.DataFrame | None=None):
+        self.store = store
+        self.references_outside = references_outside
+        self.references = references
+        self.group_dists = group_dists
+        self.ref_mask = ref_mask
+        # We remove the "seeds" before assigning ranks so the best look-alike is #1
+        self.rows = universe_rows[~ref_mask]
+        self.scores = {col: vals[~ref_mask] for col, vals in scores.items()}
+        self.top_k = top_k
+        self._frames = {}
+
+    def __len__(self) -> int:
+        return self.rows.size
+
+    @property
+    def empty(self) -> bool:
+        return self.rows.size == 0
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        Memory held by the score / distance arrays and the ranked frames built so far
+        (arrays shared with reweighted copies are counted in each copy)
+        '''
+        arrays = [self.rows, self.ref_mask, *self.scores.values(), *(self.group_dists or {}).values()]
+        frames = [*self._frames.values()] + ([self.references] if self.references is not None else [])
+        return sum(a.nbytes for a in arrays) + sum(int(f.memory_usage(index=True).sum()) for f in frames)
+
+    def top(self, k:int | None=None) -> pd.DataFrame:
+        k = self.top_k if k is None else k
+        if k is None or k >= len(self):
+            return self.full()
+        if k not in self._frames:
+            with trace_stage('rank.top', rows=len(self), k=k):
+                self._frames[k] = self._frame(top_k_order(self.scores['overall_similarity'], k))
+        return self._frames[k]
+
+    def full(self) -> pd.DataFrame:
+        if 'full' not in self._frames:
+            with trace_stage('rank.full', rows=len(self)):
+                self._frames['full'] = self._frame(top_k_order(self.scores['overall_similarity']))
+        return self._frames['full']
+
+    def columns(self) -> list[str]:
+        '''
+        Columns of the ranked frames: attributes, scores, rank
+        '''
+        return list(self.store.attrs.columns) + list(self.scores) + ['rank']
+
+    def iter_frames(self, columns:list[str] | None=None, top_n:int | None=None, chunk_rows:int=50_000):
+        '''
+        Yields the ranking (best first, or the top_n best) as frames of at most chunk_rows rows.
+        Each chunk only gathers the requested columns of its own rows, so a full export holds one chunk at a time.
+        Columns are checked on the call; the ranking itself is only computed when the first chunk is requested.
+        '''
+        columns = self.columns() if columns is None else list(columns)
+        unknown = [c for c in columns if c not in self.columns()]
+        if unknown:
+            raise ValueError(f"Unknown result columns: {unknown}. Options: {self.columns()}")
+
+        def frames():
+            order = top_k_order(self.scores['overall_similarity'], top_n)
+            for start in range(0, order.size, chunk_rows):
+                yield self._frame(order[start:start + chunk_rows], start + 1, columns)
+        return frames()
+
+    def reweight(self, weights:dict[str, float]) -> 'RankedResults':
+        '''
+        Only the overall similarity and the ranking change with the weights:
+        no filtering, percentiles or distances are recomputed.
+        '''
+        if self.group_dists is None:
+            raise ValueError("These results were built without per-group distances and cannot be reweighted")
+        reweighted = copy.copy(self)
+        with trace_stage('score.reweight', rows=self.ref_mask.size):
+            overall = weighted_similarity(self.group_dists, weights)
+        reweighted.scores = {**self.scores, 'overall_similarity': overall[~self.ref_mask]}
+        reweighted._frames = {}
+        return reweighted
+
+    def _frame(self, order:np.ndarray, first_rank:int=1, columns:list[str] | None=None) -> pd.DataFrame:
+        attrs = self.store.attrs
+        if columns is None:
+            ranked = attrs.iloc[self.rows[order]]
+            scores = self.scores
+        else:
+            # Positional take of the requested attribute columns only
+            ranked = attrs.iloc[self.rows[order], [attrs.columns.get_loc(c) for c in columns if c in attrs.columns]]
+            scores = {col: vals for col, vals in self.scores.items() if col in columns}
+        ranked = ranked.assign(**{col: vals[order] for col, vals in scores.items()})
+        ranked['rank'] = np.arange(first_rank, first_rank + order.size)
+        return ranked if columns is None else ranked[columns]
+
+
+# Search universe of one (states, pop_min) filter with its local percentile matrix
+class Universe:
+    '''
+    - mask: boolean mask over the rows of store
+    - rows: row positions (in store) of the universe
+    - local_pct: [universe rows * metrics] local percentiles (0.0 to 1.0)
+    Does not depend on references or weights, so it can be reused across searches.
+    With a rank_index, sorted_values() gives the presorted universe columns used to project outside references.
+    '''
+    def __init__(self, mask:np.ndarray, local_pct:np.ndarray, rank_index:RankIndex | None=None):
+        self.mask = mask
+        self.rows = np.flatnonzero(mask)
+        self.local_pct = local_pct
+        self.rank_index = rank_index
+        self._sorted_values = None
+
+    def sorted_values(self) -> np.ndarray | None:
+        '''
+        Universe features with every column sorted (NaN last), taken from the rank index on first use
+        '''
+        if self._sorted_values is None and self.rank_index is not None:
+            self._sorted_values = self.rank_index.sorted_subset(self.mask)
+        return self._sorted_values
+
+    @property
+    def empty(self) -> bool:
+        return self.rows.size == 0
+
+    @property
+    def nbytes(self) -> int:
+        sorted_bytes = self._sorted_values.nbytes if self._sorted_values is not None else 0
+        return self.mask.nbytes + self.rows.nbytes + self.local_pct.nbytes + sorted_bytes
+
+
+# Function to build the universe for a set of filters
+def build_universe(store, rank_index:RankIndex, target_states, pop_min, extra_mask:np.ndarray | None=None) -> Universe:
+    # 1. Define the universe for which percentiles should be calculated
+    with trace_stage('universe.filter', rows=len(store)):
+        mask = universe_mask(store, target_states, pop_min, extra_mask)
+    # 2. Dynamic calculation of percentiles, only in the subset
+    if not mask.any():
+        return Universe(mask, np.empty((0, len(rank_index.metrics))), rank_index)
+    with trace_stage('universe.local_percentiles') as span:
+        local_pct = rank_index.local_percentiles(mask)
+        span.rows = local_pct.shape[0]
+    return Universe(mask, local_pct, rank_index)
+
+
+# Function to score one reference set inside an already built universe
+def score_universe(store, universe:Universe, ref_geoids, weights, top_k=None, metrics:list[str]=METRICS) -> RankedResults:
+    if universe.empty:
+        return RankedResults(store, universe.rows, np.zeros(0, dtype=bool), {'overall_similarity': np.zeros(0)}, top_k)
+
+    n_rows = universe.rows.size
+    # 3. Capture the local target vector
+    with trace_stage('score.targets', rows=len(ref_geoids)):
+        targets, ref_masks, outside, ref_pcts = build_target_vectors(
+            store, universe.rows, universe.local_pct, [ref_geoids], universe.sorted_values)
+        references = reference_frame(store, universe.rows, ref_geoids, ref_pcts[0], metrics)
+    if outside[0]:
+        warnings.warn(ReferenceOutsideUniverseWarning(OUTSIDE_UNIVERSE_NOTE))
+
+    # 4. Compute weighted similarity
+    with trace_stage('score.distances', rows=n_rows):
+        dists = group_sq_distances(universe.local_pct, targets, metrics)
+    group_dists = {group: d[:, 0] for group, d in dists.items()}
+    with trace_stage('score.scaling', rows=n_rows):
+        scores = scale_similarity(group_dists, weights)
+
+    # 5. Rank lazily (excluding references)
+    return RankedResults(store, universe.rows, ref_masks[0], scores, top_k,
+                         references_outside=outside[0], group_dists=group_dists, references=references)
+
+
+# Function to score one reference set and return lazily ranked results
+def score_similarity(store, ref_geoids, target_states, pop_min, weights, rank_index=None, top_k=None) -> RankedResults:
+    '''
+    Computes similarity scores using DYNAMIC local percentiles based on user filters.
+    Includes Relative Scaling (Min-Max) to ensure a 0-100 range based on the sample.
+    store is the FeatureStore built from the master data; geometry is never touched here.
+    rank_index is the presorted RankIndex for store; it is built on the fly if not passed.
+    top_k is the default number of rows returned by RankedResults.top().
+    Emits ReferenceOutsideUniverseWarning when the references are not in the universe.
+    '''
+    if rank_index is None:
+        rank_index = RankIndex(store.rank_values(), store.metrics)
+    universe = build_universe(store, rank_index, target_states, pop_min)
+    return score_universe(store, universe, ref_geoids, weights, top_k, rank_index.metrics)
+
+
+# Function to calculate similarity: main engine of the app
+def run_similarity_logic(store, ref_geoids, target_states, pop_min, weights, rank_index=None, top_k=None) -> pd.DataFrame:
+    '''
+    Same as score_similarity, but returns the ranked candidates as a frame:
+    the top_k best when top_k is set, otherwise every candidate.
+    '''
+    return score_similarity(store, ref_geoids, target_states, pop_min, weights, rank_index, top_k).top()
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.config import METRIC_GROUPS, metric_groups_for
+from src.analytics import (
+    RankIndex, build_universe, build_target_vectors, group_sim_col, group_sq_distances, scale_similarity, RankedResults,
+)
+from src.data_loader import ATTRIBUTE_COLS, DATASETS, DEFAULT_DATASET, build_feature_store, load_dataset
+
+
+# Headless batch scoring: many customer profiles in one run, without streamlit
+# Usage: python -m src.batch jobs.json --level place_5yr --out-dir data/output/batch --format parquet
+
+# One customer profile to score
+@dataclass
+class SimilarityJob:
+    '''
+    Inputs of one run_similarity_logic call.
+        - states: empty means every state in the data
+        - weights: missing groups fall back to 0.5 (same default as the app sliders)
+    '''
+    customer_name: str
+    ref_geoids: list[str]
+    states: list[str] = field(default_factory=list)
+    pop_min: float = 5000
+    weights: dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.weights = {group: float(self.weights.get(group, 0.5)) for group in METRIC_GROUPS}
+
+
+# Function to read jobs from a JSON, JSONL or CSV file
+def load_jobs(path:str | Path) -> list[SimilarityJob]:
+    '''
+    Reads the job file. Supported layouts:
+        - .json: a list of job objects
+        - .jsonl: one job object per line
+        - .csv: ref_geoids and states separated by ";" and one optional column per metric group for weights
+    '''
+    path = Path(path)
+    if path.suffix == '.json':
+        records = json.loads(path.read_text())
+    elif path.suffix == '.jsonl':
+        records = [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+    elif path.suffix == '.csv':
+        df = pd.read_csv(path, dtype=str).fillna('')
+        records = []
+        for row in df.to_dict('records'):
+            records.append({
+                'customer_name': row['customer_name'],
+                'ref_geoids': [g for g in row['ref_geoids'].split(';') if g],
+                'states': [s for s in row.get('states', '').split(';') if s],
+                'pop_min': float(row['pop_min']) if row.get('pop_min') else 5000,
+                'weights': {group: float(row[group]) for group in METRIC_GROUPS if row.get(group)},
+            })
+    else:
+        raise ValueError(f"Unsupported job file type: {path.suffix}")
+    return [SimilarityJob(**record) for record in records]
+
+
+# Function to score many jobs, sharing work between jobs with the same universe
+def run_batch(store, jobs:list[SimilarityJob], rank_index:RankIndex | None=None, top_k:int | None=None) -> list[pd.DataFrame]:
+    '''
+    Scores every job and returns the ranked candidates of each job, in job order
+    (only the top_k best per job when top_k is set).
+    Jobs with the same (states, pop_min) share one universe, so the local percentile matrix is built once
+    per universe and all of its target vectors are scored in a single matrix operation.
+    '''
+    if rank_index is None:
+        rank_index = RankIndex(store.rank_values(), store.metrics)
+    all_states = store.state_names.tolist()
+
+    # Group jobs by universe
+    universes = {}
+    for i, job in enumerate(jobs):
+        key = (tuple(sorted(job.states or all_states)), job.pop_min)
+        universes.setdefault(key, []).append(i)
+
+    results = [None] * len(jobs)
+    for (states, pop_min), job_ids in universes.items():
+        universe_jobs = [jobs[i] for i in job_ids]
+        universe = build_universe(store, rank_index, list(states), pop_min)
+        if universe.empty:
+            # No candidates: an empty frame with the columns (and dtypes) of a scored result
+            scores = {'overall_similarity': np.zeros(0)}
+            scores.update({group_sim_col(group): np.zeros(0) for group in metric_groups_for(rank_index.metrics)})
+            for i in job_ids:
+                results[i] = RankedResults(store, universe.rows, np.zeros(0, dtype=bool), scores, top_k).top()
+            continue
+
+        targets, ref_masks, outside, _ = build_target_vectors(
+            store, universe.rows, universe.local_pct, [job.ref_geoids for job in universe_jobs], universe.sorted_values)
+        # [universe rows * jobs] per metric group
+        dists = group_sq_distances(universe.local_pct, targets, rank_index.metrics)
+
+        for k, (i, job) in enumerate(zip(job_ids, universe_jobs)):
+            if outside[k]:
+                print(f"Note: references of {job.customer_name} are outside the selected Search Universe.")
+            scores = scale_similarity({group: d[:, k] for group, d in dists.items()}, job.weights)
+            results[i] = RankedResults(store, universe.rows, ref_masks[k], scores, top_k).top()
+    return results
+
+
+# Helper to build a safe output file name from a customer name
+def _output_path(out_dir:Path, customer_name:str, fmt:str) -> Path:
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', customer_name).strip('_') or 'customer'
+    return out_dir / f"{safe_name}_market_discovery.{fmt}"
+
+
+# Function to write one ranked file per job
+def write_results(jobs:list[SimilarityJob], results:list[pd.DataFrame], out_dir:str | Path, fmt:str='csv') -> list[Path]:
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"Unsupported output format: {fmt}")
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for job, res in zip(jobs, results):
+        file_path = _output_path(out_dir, job.customer_name, fmt)
+        # Keep repeated customer names from overwriting each other
+        n = 1
+        while file_path in paths:
+            n += 1
+            file_path = _output_path(out_dir, f"{job.customer_name}_{n}", fmt)
+        if fmt == 'csv':
+            res.to_csv(file_path, index=False)
+        else:
+            res.to_parquet(file_path, index=False)
+        paths.append(file_path)
+    return paths
+
+
+def main(argv:list[str] | None=None):
+    parser = argparse.ArgumentParser(description="Score many customer reference profiles in one run.")
+    parser.add_argument('jobs', help="Job file (.json, .jsonl or .csv)")
+    parser.add_argument('--level', default=DEFAULT_DATASET, choices=list(DATASETS), help="Geography level / ACS vintage to score")
+    parser.add_argument('--data', default=None, help="Feature GeoParquet to use instead of the level's local file")
+    parser.add_argument('--out-dir', default='batch_results', help="Directory for the ranked files")
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--top-k', type=int, default=None, help="Only write the K best candidates per job")
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.jobs)
+    if args.data:
+        metrics = list(DATASETS[args.level].metrics)
+        store = build_feature_store(pd.read_parquet(args.data, columns=ATTRIBUTE_COLS + metrics), metrics, source_path=args.data)
+    else:
+        store = load_dataset(args.level)
+
+    start_time = time.time()
+    rank_index = RankIndex(store.rank_values(), store.metrics)
+    results = run_batch(store, jobs, rank_index, args.top_k)
+    elapsed = time.time() - start_time
+
+    paths = write_results(jobs, results, args.out_dir, args.format)
+    n_rows = sum(len(res) for res in results)
+    print(f"Scored {len(jobs)} jobs ({n_rows:,} ranked rows) in {elapsed:.2f}s "
+          f"({len(jobs) / max(elapsed, 1e-9):.1f} jobs/s, {n_rows / max(elapsed, 1e-9):,.0f} rows/s)")
+    print(f"Wrote {len(paths)} files to: {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from src.config import METRICS, metric_groups_for
+from src.analytics import RankIndex, build_universe, score_universe
+from src.data_loader import DATASETS, derived_cache_path, load_dataset, load_national_percentiles
+from src.export import iter_export
+from src.sensitivity import rank_stability
+from src.shared_store import load_shared_dataset, shared_store_dir
+from src.tracing import tracing
+from src.utils import find_project_root
+from src.visualizer import build_geometry_tiers, build_similarity_map, zoom_to_tier
+
+
+# Benchmark suite for the similarity engine and the map builder on synthetic national-scale data
+# Usage:
+#   python -m src.benchmark run --levels place tract --repeats 3          (writes benchmarks/<timestamp>.json)
+#   python -m src.benchmark run --scale 0.1                               (quick run on 10% sized tables)
+#   python -m src.benchmark compare benchmarks/old.json benchmarks/new.json --threshold 0.25
+# Every stage is timed `repeats` times (median and min are kept), then run once more under tracemalloc for its peak memory.
+
+BENCHMARK_DIR = find_project_root() / "benchmarks"
+
+# Synthetic table sizes (roughly the national row counts of each geography level)
+SYNTHETIC_LEVELS = {
+    'place': {'dataset': 'place_5yr', 'rows': 32_000, 'pop_min': 5000},
+    'tract': {'dataset': 'tract_5yr', 'rows': 85_000, 'pop_min': 2000},
+    'block_group': {'dataset': 'block_group_5yr', 'rows': 242_000, 'pop_min': 800},
+}
+# Candidates drawn on the map (same as MAP_TOP_K in app.py)
+MAP_TOP_K = 2000
+# Stages whose time grew by more than this share over the baseline are flagged by compare
+REGRESSION_THRESHOLD = 0.25
+# Stages faster than this are too noisy to flag
+MIN_FLAG_SECONDS = 0.01
+
+# (state fips, state name, usps) of the 50 states, DC and Puerto Rico
+STATES = [
+    ('01', 'Alabama', 'AL'), ('02', 'Alaska', 'AK'), ('04', 'Arizona', 'AZ'), ('05', 'Arkansas', 'AR'),
+    ('06', 'California', 'CA'), ('08', 'Colorado', 'CO'), ('09', 'Connecticut', 'CT'), ('10', 'Delaware', 'DE'),
+    ('11', 'District of Columbia', 'DC'), ('12', 'Florida', 'FL'), ('13', 'Georgia', 'GA'), ('15', 'Hawaii', 'HI'),
+    ('16', 'Idaho', 'ID'), ('17', 'Illinois', 'IL'), ('18', 'Indiana', 'IN'), ('19', 'Iowa', 'IA'),
+    ('20', 'Kansas', 'KS'), ('21', 'Kentucky', 'KY'), ('22', 'Louisiana', 'LA'), ('23', 'Maine', 'ME'),
+    ('24', 'Maryland', 'MD'), ('25', 'Massachusetts', 'MA'), ('26', 'Michigan', 'MI'), ('27', 'Minnesota', 'MN'),
+    ('28', 'Mississippi', 'MS'), ('29', 'Missouri', 'MO'), ('30', 'Montana', 'MT'), ('31', 'Nebraska', 'NE'),
+    ('32', 'Nevada', 'NV'), ('33', 'New Hampshire', 'NH'), ('34', 'New Jersey', 'NJ'), ('35', 'New Mexico', 'NM'),
+    ('36', 'New York', 'NY'), ('37', 'North Carolina', 'NC'), ('38', 'North Dakota', 'ND'), ('39', 'Ohio', 'OH'),
+    ('40', 'Oklahoma', 'OK'), ('41', 'Oregon', 'OR'), ('42', 'Pennsylvania', 'PA'), ('44', 'Rhode Island', 'RI'),
+    ('45', 'South Carolina', 'SC'), ('46', 'South Dakota', 'SD'), ('47', 'Tennessee', 'TN'), ('48', 'Texas', 'TX'),
+    ('49', 'Utah', 'UT'), ('50', 'Vermont', 'VT'), ('51', 'Virginia', 'VA'), ('53', 'Washington', 'WA'),
+    ('54', 'West Virginia', 'WV'), ('55', 'Wisconsin', 'WI'), ('56', 'Wyoming', 'WY'), ('72', 'Puerto Rico', 'PR'),
+]
+
+
+# Function to generate a synthetic feature table with the acs_5yr_place_features_v1 schema
+def synthetic_features(level:str='place', n_rows:int | None=None, seed:int=0) -> gpd.GeoDataFrame:
+    '''
+    ATTRIBUTE_COLS + METRICS + geometry, with level-shaped ids and names
+    (place: "1600000US0644000" / "Name city", tract: "1400000US06037101110" / "Census Tract 1011.10",
+    block group: "1500000US060371011101" / "Block Group 1").
+    Metrics are heavy-tailed, partly rounded (ties) and about 2% missing, like the ACS / parcel columns.
+    Polygons are 17-vertex circles scattered over the lower 48 so map payloads have realistic sizes.
+    '''
+    n_rows = n_rows or SYNTHETIC_LEVELS[level]['rows']
+    rng = np.random.default_rng(seed)
+    # Uneven state sizes, as in the real tables
+    state_share = rng.lognormal(0, 1, len(STATES))
+    state_idx = rng.choice(len(STATES), n_rows, p=state_share / state_share.sum())
+    fips, names, usps = (np.array(col)[state_idx] for col in zip(*STATES))
+    seq = np.arange(n_rows)
+
+    if level == 'place':
+        geoidfq = [f"1600000US{s}{i % 100000:05d}" for s, i in zip(fips, seq)]
+        namelsad = [f"Place {i} city" for i in seq]
+        pop = rng.lognormal(8, 1.5, n_rows)
+    else:
+        tract = [f"{i % 1000:03d}{(i // 7) % 1000000:06d}" for i in seq]
+        if level == 'tract':
+            geoidfq = [f"1400000US{s}{t}" for s, t in zip(fips, tract)]
+            namelsad = [f"Census Tract {int(t[3:]) / 100:g}" for t in tract]
+            pop = rng.normal(4000, 1500, n_rows).clip(0)
+        else:
+            geoidfq = [f"1500000US{s}{t}{i % 9 + 1}" for s, t, i in zip(fips, tract, seq)]
+            namelsad = [f"Block Group {i % 9 + 1}" for i in seq]
+            pop = rng.normal(1500, 600, n_rows).clip(0)
+
+    data = {'geoidfq': geoidfq, 'namelsad': namelsad, 'state_name': names, 'stusps': usps}
+    pop = np.round(pop)
+    for m in METRICS:
+        values = pop if m == 'pop_2024' else pop * rng.lognormal(0, 0.5, n_rows) if m in ('households_2024', 'unq_addr_count') \
+            else rng.lognormal(10, 1, n_rows)
+        values = np.round(values, 0 if values.max() > 100 else 3)
+        if m != 'pop_2024':
+            values[rng.random(n_rows) < 0.02] = np.nan
+        data[m] = values
+
+    x = rng.uniform(-124, -67, n_rows)
+    y = rng.uniform(25, 49, n_rows)
+    radius = 0.02 if level == 'place' else 0.005
+    geometry = shapely.buffer(shapely.points(x, y), radius, quad_segs=4)
+    return gpd.GeoDataFrame(data, geometry=geometry, crs='EPSG:4326')
+
+
+# Helper to run a stage function without its progress prints and library warnings
+def _quiet(fn):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return fn()
+
+
+# Helper to run one stage: repeats timings (the last one traced for the engine's own stage breakdown),
+# then one tracemalloc run for the memory peak
+def _run_stage(name:str, fn, repeats:int, setup=None) -> tuple[dict, object]:
+    times = []
+    result = None
+    for repeat in range(repeats):
+        if setup is not None:
+            setup()
+        with tracing(name, enabled=repeat == repeats - 1) as trace:
+            start_time = time.perf_counter()
+            result = _quiet(fn)
+            times.append(time.perf_counter() - start_time)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    _quiet(fn)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = {
+        'seconds': float(np.median(times)),
+        'min_seconds': float(min(times)),
+        'peak_mb': round(peak / 1e6, 2),
+    }
+    if trace is not None and trace.spans:
+        # Seconds per instrumented engine stage (src.tracing), e.g. score.distances inside scoring
+        stats['substages'] = trace.summary()
+    return stats, result
+
+
+# Function to benchmark one level end to end
+def benchmark_level(level:str, data_dir:Path, n_rows:int | None=None, repeats:int=3, seed:int=0) -> dict:
+    '''
+    Stages (seconds are the median over repeats, peak_mb the tracemalloc peak of one extra run,
+    substages the engine's trace_stage timings of the last repeat):
+        - load: column-projected parquet read into a FeatureStore
+        - shared_store_build / shared_store_open: writing and mapping the shared sidecar (src.shared_store)
+        - rank_index: presorting every metric
+        - national_percentiles: computing the derived sidecar from scratch
+        - local_percentiles: building the search universe (state + population filter, local percentiles)
+        - scoring: per-group distances and similarity scores for three references
+        - ranking: re-ranking from the per-group distances (reweight), the top MAP_TOP_K frame and the full ordering
+        - geometry_tiers: simplifying the polygons for every zoom tier
+        - map_html: building the folium map of the top candidates and rendering its HTML
+        - csv_export / geoparquet_export: streaming every candidate through src.export (download button)
+        - sensitivity: rank stability over 1,000 sampled weightings (src.sensitivity), in-process
+    '''
+    if repeats < 1:
+        raise ValueError("repeats must be at least 1")
+    profile = SYNTHETIC_LEVELS[level]
+    spec = DATASETS[profile['dataset']]
+    source_path = spec.path(data_dir)
+    gdf = synthetic_features(level, n_rows, seed)
+    gdf.to_parquet(source_path)
+    rows = len(gdf)
+    print(f"{level}: {rows:,} synthetic rows written to {source_path}")
+
+    rng = np.random.default_rng(seed)
+    ref_geoids = gdf['geoidfq'].iloc[rng.choice(rows, 3, replace=False)].tolist()
+    # The states holding the references plus a few more, like a typical regional search
+    target_states = sorted(set(gdf['state_name'].iloc[rng.choice(rows, 8)]) |
+                           set(gdf.set_index('geoidfq').loc[ref_geoids, 'state_name']))
+    geometry = gdf.geometry
+    del gdf
+
+    stages = {}
+    def stage(name, fn, setup=None):
+        stages[name], result = _run_stage(name, fn, repeats, setup)
+        print(f"  {name:<22} {stages[name]['seconds'] * 1000:9.1f} ms  peak {stages[name]['peak_mb']:8.1f} MB")
+        return result
+
+    store = stage('load', lambda: load_dataset(spec.key, data_dir))
+    store_dir = shared_store_dir(source_path)
+    stage('shared_store_build', lambda: load_shared_dataset(spec.key, data_dir),
+          setup=lambda: shutil.rmtree(store_dir, ignore_errors=True))
+    stage('shared_store_open', lambda: load_shared_dataset(spec.key, data_dir))
+    rank_index = stage('rank_index', lambda: RankIndex(store.rank_values(), store.metrics))
+    stage('national_percentiles', lambda: load_national_percentiles(store, source_path),
+          setup=lambda: derived_cache_path(source_path).unlink(missing_ok=True))
+
+    universe = stage('local_percentiles', lambda: build_universe(store, rank_index, target_states, profile['pop_min']))
+    weights = {group: 0.5 for group in metric_groups_for(store.metrics)}
+    results = stage('scoring', lambda: score_universe(store, universe, ref_geoids, weights, MAP_TOP_K, store.metrics))
+    # reweight gives fresh results (no cached frames) from the stored per-group distances, as the weight sliders do
+    stage('ranking', lambda: (lambda res: (res.top(MAP_TOP_K), res.full()))(results.reweight(weights)))
+
+    tiers = stage('geometry_tiers', lambda: build_geometry_tiers(store.geoidfq, geometry))
+    tier = zoom_to_tier(5)
+    def map_html():
+        top = results.top(MAP_TOP_K)
+        ref_gdf = store.attrs.iloc[store.rows_for_geoids(ref_geoids)][['geoidfq', 'namelsad']]
+        ref_gdf = gpd.GeoDataFrame(ref_gdf, geometry=tiers.get(ref_gdf['geoidfq'], tier).values)
+        map_gdf = gpd.GeoDataFrame(top, geometry=tiers.get(top['geoidfq'], tier).values)
+        _, map_stats = build_similarity_map(ref_gdf, map_gdf, measure=True)
+        return map_stats
+    map_stats = stage('map_html', map_html)
+    stages['map_html']['html_bytes'] = map_stats['html_bytes']
+    stage('csv_export', lambda: sum(len(chunk) for chunk in iter_export(results, 'csv')))
+    stage('geoparquet_export', lambda: sum(len(chunk) for chunk in iter_export(results, 'geoparquet', geometry_tiers=tiers)))
+    stage('sensitivity', lambda: rank_stability(results, weights, n_samples=1000, max_workers=1))
+
+    return {'dataset': spec.key, 'rows': rows, 'candidates': len(results), 'stages': stages}
+
+
+# Helper for the commit the benchmark ran on (None outside a git checkout)
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=find_project_root(),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to run the suite and write the JSON results
+def run_benchmarks(levels:list[str]=list(SYNTHETIC_LEVELS), scale:float=1.0, repeats:int=3, seed:int=0,
+                   out_path:Path | str | None=None) -> dict:
+    '''
+    Generates each level's table in a temporary data directory, runs benchmark_level and writes
+    {"meta": {...}, "levels": {level: {"rows", "stages": {stage: {"seconds", "min_seconds", "peak_mb"}}}}}
+    to out_path (default benchmarks/<UTC timestamp>.json).
+    '''
+    started = datetime.now(timezone.utc)
+    report = {
+        'meta': {
+            'timestamp': started.isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'scale': scale,
+            'repeats': repeats,
+            'seed': seed,
+        },
+        'levels': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='similarity_bench_') as data_dir:
+        for level in levels:
+            n_rows = max(int(SYNTHETIC_LEVELS[level]['rows'] * scale), 100)
+            report['levels'][level] = benchmark_level(level, Path(data_dir), n_rows, repeats, seed)
+    # ru_maxrss is KB on Linux
+    report['meta']['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    out_path = Path(out_path or BENCHMARK_DIR / f"{started.strftime('%Y%m%dT%H%M%SZ')}.json")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(report, indent=2))
+    print(f"Benchmark results saved to: {out_path}")
+    return report
+
+
+# Function to compare two result files; returns one row per (level, stage) present in both
+def compare_benchmarks(baseline:dict, current:dict, threshold:float=REGRESSION_THRESHOLD,
+                       min_seconds:float=MIN_FLAG_SECONDS) -> pd.DataFrame:
+    '''
+    A stage is flagged as a regression when its median time grew by more than threshold (relative)
+    and it takes at least min_seconds; memory growth over threshold is flagged the same way.
+    Runs at different scales are not comparable, so a scale mismatch raises.
+    '''
+    if baseline['meta'].get('scale') != current['meta'].get('scale'):
+        raise ValueError(f"Runs use different scales: {baseline['meta'].get('scale')} vs {current['meta'].get('scale')}")
+    rows = []
+    for level, current_level in current['levels'].items():
+        base_stages = baseline['levels'].get(level, {}).get('stages', {})
+        for stage, now in current_level['stages'].items():
+            if stage not in base_stages:
+                continue
+            before = base_stages[stage]
+            time_ratio = now['seconds'] / before['seconds'] if before['seconds'] > 0 else np.nan
+            mem_ratio = now['peak_mb'] / before['peak_mb'] if before['peak_mb'] > 0 else np.nan
+            rows.append({
+                'level': level,
+                'stage': stage,
+                'base_seconds': before['seconds'],
+                'seconds': now['seconds'],
+                'time_ratio': time_ratio,
+                'base_peak_mb': before['peak_mb'],
+                'peak_mb': now['peak_mb'],
+                'memory_ratio': mem_ratio,
+                'time_regression': bool(time_ratio > 1 + threshold and now['seconds'] >= min_seconds),
+                'memory_regression': bool(mem_ratio > 1 + threshold),
+            })
+    return pd.DataFrame(rows)
+
+
+def main(argv:list[str] | None=None):
+    parser = argparse.ArgumentParser(description="Benchmark the similarity engine on synthetic data.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Run the suite and write a JSON result file")
+    run.add_argument('--levels', nargs='+', default=list(SYNTHETIC_LEVELS), choices=list(SYNTHETIC_LEVELS))
+    run.add_argument('--scale', type=float, default=1.0, help="Fraction of the national row counts")
+    run.add_argument('--repeats', type=int, default=3)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--out', default=None, help="Result file (default: benchmarks/<timestamp>.json)")
+
+    diff = commands.add_parser('compare', help="Flag regressions between two result files")
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        if args.repeats < 1:
+            parser.error("--repeats must be at least 1")
+        run_benchmarks(args.levels, args.scale, args.repeats, args.seed, args.out)
+        return
+
+    baseline = json.loads(Path(args.baseline).read_text())
+    current = json.loads(Path(args.current).read_text())
+    table = compare_benchmarks(baseline, current, args.threshold)
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(table.round(3).to_string(index=False))
+    flagged = table[table['time_regression'] | table['memory_regression']]
+    if flagged.empty:
+        print("No regressions")
+    else:
+        print(f"{len(flagged)} regression(s): " + ", ".join(f"{r.level}/{r.stage}" for r in flagged.itertuples()))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import threading
+import warnings
+from collections import OrderedDict
+
+from src.analytics import (
+    RankIndex, RankedResults, ReferenceOutsideUniverseWarning, OUTSIDE_UNIVERSE_NOTE, build_universe, score_universe,
+)
+from src.tracing import trace_stage
+# src.neighbours (scipy) is imported on first indexed query only, to keep app startup light
+
+
+# Bounded, thread-safe LRU map with hit/miss counters
+class LRUCache:
+    '''
+    Evicts the least recently used entries once there are more than max_items entries,
+    or (when max_bytes is set) once the summed sizeof() of the entries exceeds max_bytes.
+    The most recent entry is always kept, even if it is larger than max_bytes on its own.
+    Sizes are measured again on every put, since entries can grow after insertion (e.g. ranked frames built on request).
+    '''
+    def __init__(self, max_items:int=32, max_bytes:int | None=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return self._nbytes()
+
+    def _nbytes(self) -> int:
+        return sum(self.sizeof(value) for value in self._data.values())
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > 1 and (
+                len(self._data) > self.max_items
+                or (self.max_bytes is not None and self._nbytes() > self.max_bytes)
+            ):
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        # One consistent snapshot of the counters (nbytes would take the lock again, so _nbytes is used)
+        with self._lock:
+            return {'items': len(self._data), 'bytes': self._nbytes(), 'hits': self.hits, 'misses': self.misses}
+
+
+# Helper to build a canonical key from query parameters
+def query_key(**params) -> str:
+    '''
+    Lists are compared as sets (order of references/states does not matter) and
+    numbers are normalized to float, so equivalent queries share one key.
+    '''
+    def canonical(value):
+        if isinstance(value, dict):
+            return {str(k): canonical(v) for k, v in sorted(value.items())}
+        if isinstance(value, (list, tuple, set)):
+            return sorted(canonical(v) for v in value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return value
+    payload = json.dumps(canonical(params), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# Helper for the cache-key part of an optional spatial constraint (None when there is no active constraint)
+def _spatial_key(spatial) -> dict | None:
+    return spatial.key() if spatial is not None and spatial.active else None
+
+
+# Two-level memo around the similarity engine, shared by every session of the server process
+class SimilarityCache:
+    '''
+    Level 1: ranked results keyed on (references, states, pop_min, weights, top_k, dataset version).
+             A miss that only differs in weights from a cached profile is served by reweighting it.
+    Level 2: per-universe local percentile matrices keyed on (states, pop_min, dataset version).
+             This is the expensive part and does not depend on references or weights,
+             so a new reference set or a weight tweak only redoes the cheap scoring step.
+    Level 3 (approximate indexed retrieval only): KD-trees keyed on the universe; weights apply at query time.
+    Results and profiles hold universe-wide arrays (per-group distances, scores), so besides max_results
+    they are bounded by max_result_bytes each (RankedResults.nbytes).
+    A spatial constraint (src.spatial_filter.SpatialFilter) is part of the universe, so it enters every key.
+    spatial_index is a SpatialIndex or a callable returning one; it is only resolved for the first spatial query.
+    '''
+    def __init__(self, store, rank_index:RankIndex | None=None, dataset_version:str='',
+                 max_results:int=64, max_universes:int=16, max_universe_bytes:int | None=512 * 1024 ** 2,
+                 max_result_bytes:int | None=256 * 1024 ** 2, spatial_index=None):
+        self.store = store
+        self.rank_index = rank_index or RankIndex(store.rank_values(), store.metrics)
+        self.dataset_version = dataset_version
+        self._spatial_index = spatial_index
+        self._spatial_lock = threading.Lock()
+        self.results = LRUCache(max_items=max_results, max_bytes=max_result_bytes, sizeof=lambda r: r.nbytes)
+        # Same results keyed without the weights, for the reweight path
+        self.profiles = LRUCache(max_items=max_results, max_bytes=max_result_bytes, sizeof=lambda r: r.nbytes)
+        self.universes = LRUCache(max_items=max_universes, max_bytes=max_universe_bytes, sizeof=lambda u: u.nbytes)
+        self.indexes = LRUCache(max_items=max_universes, max_bytes=max_universe_bytes, sizeof=lambda i: i.nbytes)
+
+    @property
+    def spatial_index(self):
+        with self._spatial_lock:
+            if callable(self._spatial_index):
+                self._spatial_index = self._spatial_index()
+        if self._spatial_index is None:
+            raise ValueError("SimilarityCache has no spatial_index; spatial constraints need one")
+        return self._spatial_index
+
+    def universe(self, target_states, pop_min, spatial=None):
+        key = query_key(states=target_states, pop_min=pop_min, spatial=_spatial_key(spatial), version=self.dataset_version)
+        with trace_stage('cache.universe') as span:
+            universe = self.universes.get(key)
+            span.info['hit'] = universe is not None
+            if universe is None:
+                extra_mask = spatial.mask(self.spatial_index, self.store) if _spatial_key(spatial) else None
+                universe = build_universe(self.store, self.rank_index, target_states, pop_min, extra_mask)
+                self.universes.put(key, universe)
+        return universe
+
+    def neighbour_index(self, target_states, pop_min, spatial=None) -> 'NeighbourIndex':
+        key = query_key(states=target_states, pop_min=pop_min, spatial=_spatial_key(spatial), version=self.dataset_version)
+        index = self.indexes.get(key)
+        if index is None:
+            from src.neighbours import NeighbourIndex
+            universe = self.universe(target_states, pop_min, spatial)
+            with trace_stage('index.build', rows=universe.rows.size):
+                index = NeighbourIndex(universe, self.rank_index.metrics)
+            self.indexes.put(key, index)
+        return index
+
+    def score(self, ref_geoids, target_states, pop_min, weights, top_k=None,
+              use_index:bool=False, exact:bool=True, spatial=None) -> RankedResults:
+        '''
+        Same contract as analytics.score_similarity; repeated queries return the cached RankedResults.
+        use_index=True keeps only the top_k (50 if not set) through neighbours.score_universe_indexed:
+        exact=True ranks from one linear pass, exact=False answers through the universe's KD-tree.
+        spatial: optional SpatialFilter narrowing the universe before scoring.
+        '''
+        with trace_stage('cache.score') as span:
+            res = self._score(ref_geoids, target_states, pop_min, weights, top_k, use_index, exact, spatial, span.info)
+            span.rows = len(res)
+        return res
+
+    def _score(self, ref_geoids, target_states, pop_min, weights, top_k, use_index, exact, spatial,
+               info:dict) -> RankedResults:
+        # info receives the cache level that answered ('result', 'reweight' or 'miss') for the trace
+        spatial_key = _spatial_key(spatial)
+        if use_index:
+            key = query_key(refs=ref_geoids, states=target_states, pop_min=pop_min, weights=weights,
+                            top_k=top_k, exact=exact, spatial=spatial_key, version=self.dataset_version)
+            res = self.results.get(key)
+            info['cache'] = 'miss' if res is None else 'result'
+            if res is None:
+                from src.neighbours import score_universe_indexed
+                universe = self.universe(target_states, pop_min, spatial)
+                # The tree is only used by the approximate mode
+                index = None if universe.empty or exact else self.neighbour_index(target_states, pop_min, spatial)
+                res = score_universe_indexed(self.store, universe, ref_geoids, weights, top_k or 50,
+                                             exact=exact, index=index, metrics=self.rank_index.metrics)
+                self.results.put(key, res)
+            elif res.references_outside:
+                warnings.warn(ReferenceOutsideUniverseWarning(OUTSIDE_UNIVERSE_NOTE))
+            return res
+
+        key = query_key(refs=ref_geoids, states=target_states, pop_min=pop_min, weights=weights,
+                        top_k=top_k, spatial=spatial_key, version=self.dataset_version)
+        res = self.results.get(key)
+        if res is not None:
+            info['cache'] = 'result'
+            # Keep the same warning behaviour on a cache hit
+            if res.references_outside:
+                warnings.warn(ReferenceOutsideUniverseWarning(OUTSIDE_UNIVERSE_NOTE))
+            return res
+
+        profile_key = query_key(refs=ref_geoids, states=target_states, pop_min=pop_min,
+                                top_k=top_k, spatial=spatial_key, version=self.dataset_version)
+        profile = self.profiles.get(profile_key)
+        info['cache'] = 'miss' if profile is None else 'reweight'
+        if profile is not None:
+            res = profile.reweight(weights)
+            if res.references_outside:
+                warnings.warn(ReferenceOutsideUniverseWarning(OUTSIDE_UNIVERSE_NOTE))
+        else:
+            universe = self.universe(target_states, pop_min, spatial)
+            res = score_universe(self.store, universe, ref_geoids, weights, top_k, self.rank_index.metrics)
+            self.profiles.put(profile_key, res)
+        self.results.put(key, res)
+        return res
+
+    def stats(self) -> dict:
+        return {'results': self.results.stats(), 'profiles': self.profiles.stats(),
+                'universes': self.universes.stats(), 'indexes': self.indexes.stats()}
+
+    def clear(self) -> None:
+        self.results.clear()
+        self.profiles.clear()
+        self.indexes.clear()
+        self.universes.clear()
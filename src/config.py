@@ -0,0 +1,26 @@
+# Shared configuration for the app and the src modules
+
+# BigQuery location of the feature tables (TABLE is the default place table)
+PROJECT = 'clgx-gis-app-dev-06e3'
+DATASET = 'teu_site_similarity'
+TABLE = 'acs_5yr_place_features_v1'
+
+# Define Metric Groups for Tab: Descriptive Analysis and Tab: Comparison
+METRIC_GROUPS = {
+    "ACS Base": ["pop_2024", "households_2024"],
+    "ACS Income": ["median_income_2024", "median_home_value_2024"],
+    "Property": ["unq_clips", "unq_addr_count", "condo_address_counts", "median_assessed_value", "median_tax_amount"],
+    "Parcel": ["unq_parcel_count", "median_parcel_area_sq_mtr", "parcel_density"],
+    "Growth": ["unq_growth_clips", "growth_clip_share", "business_count"]
+}
+
+# Flat list of metrics in METRIC_GROUPS order; this is the column order used by the engine
+METRICS = [m for group in METRIC_GROUPS.values() for m in group]
+
+
+# Helper for the metric groups of a table that only has some of the METRICS (e.g. the ACS 1-yr places)
+# Groups keep their METRIC_GROUPS order; groups without any available metric are dropped
+def metric_groups_for(metrics:list[str]) -> dict[str, list[str]]:
+    available = set(metrics)
+    groups = {group: [m for m in group_metrics if m in available] for group, group_metrics in METRIC_GROUPS.items()}
+    return {group: group_metrics for group, group_metrics in groups.items() if group_metrics}
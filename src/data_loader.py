@@ -1,29 +1,107 @@
+from __future__ import annotations
+import hashlib
+import json
+import sys
 from pathlib import Path
+from dataclasses import dataclass
+from functools import cached_property
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely import wkt
-from google.cloud import bigquery
-import pandas_gbq
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-import uuid
-
-# Function to find project root
-
-def find_project_root(start:Path | None=None) -> Path:
-    start = start or Path.cwd()
-    for p in [start, *start.parents]:
-        # print(p)
-        if (p / 'pyproject.toml').exists() or (p / '.git').exists() or (p / 'data').exists():
-            return p
-    raise FileNotFoundError('Could not find root directory')
-
-# Define constants to load data
-# TODO: store these in a separate config.py file and load from there
-PROJECT = 'clgx-gis-app-dev-06e3'
-DATASET = 'teu_site_similarity'
-TABLE = 'acs_5yr_place_features_v1'
+from typing import TYPE_CHECKING
+
+from src.config import DATASET, METRIC_GROUPS, METRICS, PROJECT, TABLE
+from src.utils import file_version, find_project_root
+
+# geopandas / shapely / pyproj are only imported by the functions that touch geometry,
+# so loading the attribute and feature columns (app startup) does not pay for them
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+# Local folder of the feature tables (BigQuery PROJECT / DATASET / TABLE live in src.config)
 DATA_DIR = find_project_root() / "data" / "intermediate" / "features"
 
+# Rows per BigQuery result page; every page is written as one parquet row group
+EXPORT_PAGE_SIZE = 50_000
+
+
+# Helper for the GeoParquet 'geo' metadata of a WKB geometry column
+def _geoparquet_metadata(geometry_col:str, crs:str) -> bytes:
+    from pyproj import CRS
+    meta = {
+        'version': '1.0.0',
+        'primary_column': geometry_col,
+        'columns': {geometry_col: {'encoding': 'WKB', 'geometry_types': [], 'crs': CRS(crs).to_json_dict()}},
+    }
+    return json.dumps(meta).encode('utf-8')
+
+
+# Function to build the export query; the geometry comes back as WKB so it never goes through per-row WKT parsing
+def build_export_query(project:str, dataset:str, table:str, columns:list[str] | None=None,
+                       geometry_col:str='geometry') -> str:
+    '''
+    columns projects the export to the listed attribute columns (None keeps every column).
+    The geometry column is always exported, last.
+    '''
+    if columns is None:
+        select = f"* EXCEPT({geometry_col})"
+    else:
+        select = ", ".join(f"`{c}`" for c in columns if c != geometry_col)
+    return f"SELECT {select}, ST_ASBINARY({geometry_col}) AS {geometry_col} FROM `{project}.{dataset}.{table}`"
+
+
+# Function to iterate a query result as Arrow record batches, one batch per page
+def iter_query_batches(client, query:str, page_size:int=EXPORT_PAGE_SIZE):
+    '''
+    client is a google.cloud.bigquery.Client or any stand-in with the same
+    client.query(query).result(page_size=...).to_arrow_iterable() interface.
+    '''
+    yield from client.query(query).result(page_size=page_size).to_arrow_iterable()
+
+
+# Function to stream record batches into a GeoParquet file
+def write_batches_to_geoparquet(batches, file_path:Path | str, geometry_col:str='geometry', crs:str="EPSG:4326") -> int:
+    '''
+    Writes every batch as it arrives (one row group per batch), so peak memory is one page and not the whole table.
+    The geometry column must hold WKB. The file is written next to file_path and renamed at the end,
+    so a failed export never leaves a truncated file behind. Returns the number of rows written.
+    '''
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(file_path.name + '.tmp')
+    writer = None
+    n_rows = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                if geometry_col not in batch.schema.names:
+                    raise ValueError("Geometry column not found in input dataframe")
+                schema = batch.schema.with_metadata({b'geo': _geoparquet_metadata(geometry_col, crs)})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if writer is None:
+        raise ValueError("Query returned no data")
+    writer.close()
+    os.replace(tmp_path, file_path)
+    return n_rows
+
+
+# Helper to turn Arrow data with a WKB geometry column into a GeoDataFrame (bulk decoding)
+def arrow_to_geodataframe(table:pa.Table, geometry_col:str='geometry', crs:str="EPSG:4326") -> gpd.GeoDataFrame:
+    import geopandas as gpd
+    import shapely
+    geometry = shapely.from_wkb(table.column(geometry_col).to_numpy(zero_copy_only=False))
+    df = table.drop_columns([geometry_col]).to_pandas()
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
+
+
 # Function to import data from a BQ table
 # Function needs authentication to gcloud before function call
 def load_data_from_bq(
@@ -31,31 +109,338 @@ def load_data_from_bq(
     dataset:str,
     table:str,
     save:bool=True,
-    data_dir:Path=DATA_DIR) -> gpd.GeoDataFrame:
-    '''
-    Given a project, dataset and a table, load and return data in a geopandas dataframe
-    '''
-    client = bigquery.Client(project=project)
-    query = f"SELECT * FROM `{project}.{dataset}.{table}`"
-    
-    # Load to pandas
-    df = client.query(query).to_dataframe()
-    
-    # Load geometry object
-    if 'geometry' in df.columns:
-        df['geometry'] = df['geometry'].apply(wkt.loads)
-    else:
-        raise ValueError("Geometry column not found in input dataframe")
-    
-    gdf = gpd.GeoDataFrame(df, geometry='geometry', crs="EPSG:4326")
-    print(f'The crs of the dataframe is {gdf.crs}')
-    print(f'Loaded dataframe has shape: {gdf.shape}')
+    data_dir:Path=DATA_DIR,
+    columns:list[str] | None=None,
+    page_size:int=EXPORT_PAGE_SIZE,
+    client=None) -> gpd.GeoDataFrame:
+    '''
+    Given a project, dataset and a table, load and return data in a geopandas dataframe.
+    The result is streamed page by page as Arrow record batches with the geometry as WKB:
+        - save=True: every page is appended to the GeoParquet as a row group, then the file is read back
+        - save=False: the pages are collected in Arrow and decoded once
+    columns restricts the export to those columns (plus geometry).
+    client can be any stand-in with the BigQuery client interface (see iter_query_batches).
+    '''
+    import geopandas as gpd
+    if client is None:
+        # Imported here so the app can use this module without the BigQuery client installed
+        from google.cloud import bigquery
+        client = bigquery.Client(project=project)
+    query = build_export_query(project, dataset, table, columns)
+    batches = iter_query_batches(client, query, page_size)
+
     if save:
         if not data_dir:
-            raise ValueError("Geometry not found in input dataframe.")
+            raise ValueError("data_dir is required to save the table.")
         # Ensure directory exists
         os.makedirs(data_dir, exist_ok=True)
         file_path = os.path.join(data_dir, f'{table}.parquet')
-        gdf.to_parquet(file_path)
-        print(f'Data saved to: {file_path}!')
-    return gdf
\ No newline at end of file
+        n_rows = write_batches_to_geoparquet(batches, file_path)
+        print(f'Data saved to: {file_path}! ({n_rows:,} rows)')
+        gdf = gpd.read_parquet(file_path)
+    else:
+        batches = list(batches)
+        if not batches:
+            raise ValueError("Query returned no data")
+        gdf = arrow_to_geodataframe(pa.Table.from_batches(batches))
+
+    print(f'The crs of the dataframe is {gdf.crs}')
+    print(f'Loaded dataframe has shape: {gdf.shape}')
+    return gdf
+
+# Columns kept next to the feature matrix for display and lookups (no geometry)
+ATTRIBUTE_COLS = ['geoidfq', 'namelsad', 'state_name', 'stusps']
+
+# Columnar view of the master data used by the similarity engine
+@dataclass
+class FeatureStore:
+    '''
+    Geometry-free, array-first representation of the master GeoDataFrame.
+    Row i of every member refers to the same place (row i of the source frame).
+        - features: contiguous float32 matrix [rows * metrics], columns in METRICS order
+          (used for filtering and distances; ranks come from the float64 attrs, see rank_values)
+        - metrics: column names of features
+        - geoidfq: geoidfq per row
+        - state_codes / stusps_codes: integer codes into state_names / stusps_values
+        - attrs: attribute columns (ATTRIBUTE_COLS + raw metrics) without geometry
+        - geometry: GeoSeries with the polygons, only touched by map rendering
+          (None when the store was loaded without geometry; see load_geometry)
+        - source_path: parquet the store was read from, used to read the geometry on demand
+        - geoid_sorted / geoid_sorted_rows: optional sorted geoidfq and their rows; when set, rows_for_geoids
+          binary-searches them instead of building the geoid_rows dict (see src.shared_store)
+    '''
+    features: np.ndarray
+    metrics: list[str]
+    geoidfq: np.ndarray
+    state_codes: np.ndarray
+    state_names: np.ndarray
+    stusps_codes: np.ndarray
+    stusps_values: np.ndarray
+    attrs: pd.DataFrame
+    geometry: gpd.GeoSeries | None = None
+    source_path: Path | None = None
+    geoid_sorted: np.ndarray | None = None
+    geoid_sorted_rows: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return self.features.shape[0]
+
+    def metric_index(self, metric:str) -> int:
+        return self.metrics.index(metric)
+
+    def rank_values(self, rows:np.ndarray | None=None) -> np.ndarray:
+        '''
+        float64 matrix [rows * metrics] of the raw metrics in attrs (all rows, or the given row positions).
+        Percentiles are ranked on these: float32 only keeps integers exactly up to 2**24, so large counts
+        and dollar values (median_assessed_value, unq_addr_count, ...) would otherwise collapse into ties.
+        '''
+        attrs = self.attrs if rows is None else self.attrs.iloc[rows]
+        return attrs[self.metrics].to_numpy(dtype=np.float64)
+
+    def state_mask(self, states:list[str]) -> np.ndarray:
+        '''
+        Boolean mask of rows whose state_name is in states, computed on integer codes
+        '''
+        codes = np.flatnonzero(np.isin(self.state_names, list(states)))
+        return np.isin(self.state_codes, codes)
+
+    def rows_for_geoids(self, geoids:list[str]) -> np.ndarray:
+        '''
+        Row positions (sorted) of the given geoidfq values (unknown ids are ignored).
+        Hash lookups, so the cost depends on len(geoids) and not on the table size.
+        '''
+        if self.geoid_sorted is not None:
+            geoids = np.asarray(list(geoids), dtype=str)
+            pos = np.clip(np.searchsorted(self.geoid_sorted, geoids), 0, max(len(self.geoid_sorted) - 1, 0))
+            found = self.geoid_sorted[pos] == geoids
+            return np.unique(self.geoid_sorted_rows[pos[found]].astype(np.intp))
+        row_of = self.geoid_rows
+        return np.unique(np.array([row_of[g] for g in geoids if g in row_of], dtype=np.intp))
+
+    @cached_property
+    def geoid_rows(self) -> dict:
+        '''
+        geoidfq -> row position, built on first use
+        '''
+        return {g: i for i, g in enumerate(self.geoidfq.tolist())}
+
+    def load_geometry(self) -> gpd.GeoSeries:
+        '''
+        Returns the polygons, reading only the geometry column from source_path when the store was loaded without them.
+        The result is not kept on the store, so the polygons only stay in memory as long as the caller needs them.
+        '''
+        if self.geometry is not None:
+            return self.geometry
+        if self.source_path is None:
+            raise ValueError("FeatureStore has no geometry and no source_path to read it from")
+        import geopandas as gpd
+        return gpd.read_parquet(self.source_path, columns=['geometry']).geometry
+
+
+# Helper to recognise a GeoDataFrame without importing geopandas (if it is not imported, gdf cannot be one)
+def _is_geodataframe(gdf) -> bool:
+    gpd = sys.modules.get('geopandas')
+    return gpd is not None and isinstance(gdf, gpd.GeoDataFrame)
+
+
+# Function to split the master GeoDataFrame into a FeatureStore
+def build_feature_store(gdf:pd.DataFrame, metrics:list[str]=METRICS, source_path:Path | None=None) -> FeatureStore:
+    '''
+    Given the master GeoDataFrame, build the columnar FeatureStore.
+    The feature matrix is converted from pandas once here, so scoring never slices the frame by column name.
+    A plain DataFrame (no geometry) is accepted too; the polygons are then read from source_path on demand.
+    '''
+    gdf = gdf.reset_index(drop=True)
+    features = np.ascontiguousarray(gdf[metrics].to_numpy(dtype=np.float32))
+    state_codes, state_names = pd.factorize(gdf['state_name'], sort=True)
+    stusps_codes, stusps_values = pd.factorize(gdf['stusps'], sort=True)
+    attr_cols = ATTRIBUTE_COLS + [m for m in metrics if m not in ATTRIBUTE_COLS]
+    return FeatureStore(
+        features=features,
+        metrics=list(metrics),
+        geoidfq=gdf['geoidfq'].to_numpy(),
+        state_codes=state_codes.astype(np.int16),
+        state_names=np.asarray(state_names),
+        stusps_codes=stusps_codes.astype(np.int16),
+        stusps_values=np.asarray(stusps_values),
+        attrs=pd.DataFrame(gdf[attr_cols]),
+        geometry=gdf.geometry if _is_geodataframe(gdf) else None,
+        source_path=Path(source_path) if source_path is not None else None,
+    )
+
+
+# --- DATASET REGISTRY ---
+# Metrics of the ACS 1-yr place table (02_create_input_features_acs_1yr.sql); it has no condo, density,
+# growth share or business columns, and its unq_clips column is aliased to avg_assessed_val
+PLACE_1YR_METRICS = [
+    "pop_2024", "households_2024", "median_income_2024", "median_home_value_2024",
+    "unq_addr_count", "median_assessed_value", "median_tax_amount",
+    "unq_parcel_count", "median_parcel_area_sq_mtr",
+    "unq_growth_clips",
+]
+
+# One feature table (geography level + ACS vintage) the app can score
+@dataclass(frozen=True)
+class DatasetSpec:
+    '''
+    - key: registry key (DATASETS)
+    - label: name shown in the app
+    - table: BigQuery table; the local file is DATA_DIR / f'{table}.parquet'
+    - geography: what one row is ('place', 'tract', 'block group')
+    - metrics: feature columns of the table in METRICS order (a subset of METRICS when the table lacks some)
+    Every table has the ATTRIBUTE_COLS and a geometry column.
+    '''
+    key: str
+    label: str
+    table: str
+    geography: str
+    metrics: tuple[str, ...] = tuple(METRICS)
+
+    def path(self, data_dir:Path=DATA_DIR) -> Path:
+        return Path(data_dir) / f'{self.table}.parquet'
+
+    def available(self, data_dir:Path=DATA_DIR) -> bool:
+        return self.path(data_dir).exists()
+
+
+DATASETS = {
+    spec.key: spec for spec in [
+        DatasetSpec('place_5yr', 'Places (ACS 5-yr)', TABLE, 'place'),
+        DatasetSpec('place_1yr', 'Places (ACS 1-yr)', 'place_all_features_for_pctile_scoring', 'place', tuple(PLACE_1YR_METRICS)),
+        # TODO: tract and block group feature tables are not built yet (only the raw_acs_2023_tract_* / bg tables);
+        # they are expected to follow the schema of the 5-yr place table
+        DatasetSpec('tract_5yr', 'Census Tracts (ACS 5-yr)', 'acs_5yr_tract_features_v1', 'tract'),
+        DatasetSpec('block_group_5yr', 'Block Groups (ACS 5-yr)', 'acs_5yr_bg_features_v1', 'block group'),
+    ]
+}
+DEFAULT_DATASET = 'place_5yr'
+
+
+# Helper for the registry entries whose parquet exists locally
+def available_datasets(data_dir:Path=DATA_DIR) -> list[str]:
+    return [key for key, spec in DATASETS.items() if spec.available(data_dir)]
+
+
+# Function to load one geography level into a FeatureStore
+def load_dataset(key:str, data_dir:Path=DATA_DIR) -> FeatureStore:
+    '''
+    Reads only the attribute and metric columns of the level's parquet (memory-mapped, no geometry),
+    so switching levels never holds the polygons of a level in memory.
+    Metrics listed in the spec but missing from the file are dropped (with a note).
+    The polygons are read later, on demand, through FeatureStore.load_geometry.
+    '''
+    if key not in DATASETS:
+        raise ValueError(f"Unknown dataset: {key}. Options: {list(DATASETS)}")
+    spec = DATASETS[key]
+    path = spec.path(data_dir)
+    if not path.exists():
+        raise FileNotFoundError(f"Feature table for {spec.label} not found: {path}")
+
+    columns = pq.read_schema(path).names
+    metrics = [m for m in spec.metrics if m in columns]
+    missing = [m for m in spec.metrics if m not in columns]
+    if missing:
+        print(f"Note: {spec.label} has no column(s) {missing}; they are left out of scoring.")
+    table = pq.read_table(path, columns=ATTRIBUTE_COLS + metrics, memory_map=True)
+    return build_feature_store(table.to_pandas(), metrics, source_path=path)
+
+
+# --- DERIVED FEATURE CACHE ---
+# National percentiles live in a small sidecar parquet (geoidfq + one column per derived feature) next to the source file,
+# so they are computed once per data version and the large geometry file is never rewritten.
+# Bump when the sidecar layout changes so old files are rebuilt (3: ranked on the float64 source values)
+DERIVED_CACHE_VERSION = 3
+
+
+# Helper for the default sidecar location next to the source parquet
+def derived_cache_path(source_path:Path | str) -> Path:
+    source_path = Path(source_path)
+    return source_path.with_name(f"{source_path.stem}_derived.parquet")
+
+
+# Helper for the content hash of one feature column (row order included)
+def _column_hash(values:np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+# Function to calculate the national percentile (0-100) of one metric
+def national_percentile(values:np.ndarray) -> np.ndarray:
+    # rank True for 0-100 scale
+    return np.round(pd.Series(values).rank(pct=True).to_numpy() * 100, 2)
+
+
+# Function to read the derived sidecar; returns (frame aligned with store, manifest) or (None, None)
+def read_derived_features(cache_path:Path | str, store:FeatureStore, source_version:str) -> tuple[pd.DataFrame | None, dict | None]:
+    '''
+    The sidecar is validated with its manifest only, never with the values it holds:
+        - layout version and row count must match
+        - same source version: the rows were written in store order from this very file, so they are used as is
+        - other source version: its columns are only reused if its places are those of store, in the same order
+    The columns present are returned; load_national_percentiles checks them against the metrics.
+    '''
+    if not Path(cache_path).exists():
+        return None, None
+    schema = pq.read_schema(cache_path)
+    schema_meta = schema.metadata or {}
+    if b'derived_features' not in schema_meta:
+        return None, None
+    manifest = json.loads(schema_meta[b'derived_features'])
+    if manifest.get('version') != DERIVED_CACHE_VERSION or manifest.get('rows') != len(store):
+        return None, None
+    if manifest.get('source_version') != source_version:
+        geoidfq = pq.read_table(cache_path, columns=['geoidfq']).column('geoidfq').to_numpy(zero_copy_only=False)
+        if not np.array_equal(np.asarray(geoidfq, dtype=str), np.asarray(store.geoidfq, dtype=str)):
+            return None, None
+    derived = pq.read_table(cache_path, columns=[c for c in schema.names if c != 'geoidfq']).to_pandas()
+    return derived, manifest
+
+
+# Function to get the national percentiles of every metric, recomputing only what is missing or stale
+def load_national_percentiles(store:FeatureStore, source_path:Path | str | None=None, source_version:str | None=None,
+                              cache_path:Path | str | None=None) -> pd.DataFrame:
+    '''
+    Returns a frame row-aligned with store with one '<metric>_pct' column (0-100) per metric.
+    The manifest (parquet metadata of the sidecar) records the source file version (utils.file_version, size and
+    modification time), the row count, METRIC_GROUPS and, per metric, a hash of its feature column:
+        - same source version and METRIC_GROUPS: the sidecar is read as is
+        - otherwise only metrics whose column hash changed (or that are new) are recomputed
+    Pass source_version if the caller already has it.
+    '''
+    source_path = source_path or store.source_path
+    if source_path is None:
+        raise ValueError("source_path is needed to locate the derived feature cache")
+    cache_path = cache_path or derived_cache_path(source_path)
+    source_version = source_version or file_version(source_path)
+    pct_cols = [f'{m}_pct' for m in store.metrics]
+
+    derived, manifest = read_derived_features(cache_path, store, source_version)
+    if (derived is not None and manifest.get('source_version') == source_version
+            and manifest.get('metric_groups') == METRIC_GROUPS and all(c in derived.columns for c in pct_cols)):
+        return derived[pct_cols]
+
+    # Per-metric check: only recompute columns whose values changed or that are not in the sidecar yet
+    old_hashes = manifest.get('column_hashes', {}) if manifest else {}
+    derived = derived if derived is not None else pd.DataFrame(index=pd.RangeIndex(len(store)))
+    column_hashes = {}
+    stale = []
+    values = store.rank_values()
+    for j, m in enumerate(store.metrics):
+        column_hashes[m] = _column_hash(values[:, j])
+        if f'{m}_pct' not in derived.columns or old_hashes.get(m) != column_hashes[m]:
+            derived[f'{m}_pct'] = national_percentile(values[:, j])
+            stale.append(m)
+    derived = derived[pct_cols]
+    print(f'National percentiles recomputed for {len(stale)} of {len(pct_cols)} metrics')
+
+    manifest = {
+        'version': DERIVED_CACHE_VERSION,
+        'source_version': source_version,
+        'rows': len(store),
+        'metric_groups': METRIC_GROUPS,
+        'column_hashes': column_hashes,
+    }
+    table = pa.Table.from_pandas(derived.assign(geoidfq=store.geoidfq), preserve_index=False)
+    table = table.replace_schema_metadata({b'derived_features': json.dumps(manifest).encode('utf-8')})
+    pq.write_table(table, cache_path)
+    print(f'Derived features saved to: {cache_path}!')
+    return derived
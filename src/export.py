@@ -0,0 +1,197 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.analytics import RankedResults
+from src.tracing import trace_stage
+
+
+# Lazily generated, streamed exports of ranked results (CSV, Parquet, GeoJSON, GeoParquet)
+# Nothing is built until an export is requested; iter_export then yields the encoded file chunk by chunk:
+#     for chunk in iter_export(results, 'geojson', top_n=500, geometry_tiers=tiers):
+#         out.write(chunk)
+# Every chunk of EXPORT_CHUNK_ROWS ranked rows is gathered straight from the result arrays (RankedResults.iter_frames),
+# encoded and released, so a full tract / block group export never holds the whole ranking as one frame or string.
+# Geometry comes from the pre-simplified tiers of the map (src.visualizer.GeometryTiers); polygons are never re-read.
+
+EXPORT_CHUNK_ROWS = 50_000
+# Tier attached to geometry exports: the most detailed of the pre-simplified tiers
+EXPORT_GEOMETRY_TIER = 'fine'
+
+
+# One export file type
+@dataclass(frozen=True)
+class ExportFormat:
+    key: str
+    label: str
+    extension: str
+    mime: str
+    geometry: bool = False
+
+
+EXPORT_FORMATS = {
+    fmt.key: fmt for fmt in [
+        ExportFormat('csv', 'CSV', 'csv', 'text/csv'),
+        ExportFormat('parquet', 'Parquet', 'parquet', 'application/vnd.apache.parquet'),
+        ExportFormat('geojson', 'GeoJSON', 'geojson', 'application/geo+json', geometry=True),
+        ExportFormat('geoparquet', 'GeoParquet', 'parquet', 'application/vnd.apache.parquet', geometry=True),
+    ]
+}
+
+
+# Helper for the download name of an export
+def export_file_name(name:str, fmt:str) -> str:
+    return f"{name}.{EXPORT_FORMATS[fmt].extension}"
+
+
+# Write-only file object for the parquet writer that hands out the bytes written since the last drain
+class _ChunkSink:
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Helper for the shapes of a chunk (frames are indexed by row position in the store)
+def _chunk_geometry(results:RankedResults, frame:pd.DataFrame, geometry_tiers, tier:str, crs:str | None=None):
+    geometry = geometry_tiers.get(results.store.geoidfq[frame.index.to_numpy()], tier)
+    if crs is not None and geometry.crs is not None and not geometry.crs.equals(crs):
+        geometry = geometry.to_crs(crs)
+    return geometry.values
+
+
+def _iter_csv(results, frames, columns, geometry_tiers, tier) -> Iterator[bytes]:
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header).encode('utf-8')
+        header = False
+    if header:
+        # No rows: the header line only
+        yield results._frame(np.empty(0, dtype=np.intp), 1, columns).to_csv(index=False).encode('utf-8')
+
+
+def _iter_parquet(results, frames, columns, geometry_tiers, tier, geometry:bool=False) -> Iterator[bytes]:
+    '''
+    One row group per chunk and the footer after the last one; later chunks are cast to the schema of the first.
+    geometry=True adds a WKB 'geometry' column and the GeoParquet metadata.
+    '''
+    import shapely
+    sink = _ChunkSink()
+    writer = None
+    schema = None
+    for frame in frames:
+        table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+        schema = table.schema
+        if geometry:
+            shapes = np.asarray(_chunk_geometry(results, frame, geometry_tiers, tier), dtype=object)
+            table = table.append_column('geometry', pa.array(shapely.to_wkb(shapes), type=pa.binary()))
+        if writer is None:
+            writer = pq.ParquetWriter(sink, _parquet_schema(table.schema, geometry_tiers if geometry else None))
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        # No rows: a valid file with the columns and no row groups
+        table = pa.Table.from_pandas(results._frame(np.empty(0, dtype=np.intp), 1, columns), preserve_index=False)
+        if geometry:
+            table = table.append_column('geometry', pa.array([], type=pa.binary()))
+        writer = pq.ParquetWriter(sink, _parquet_schema(table.schema, geometry_tiers if geometry else None))
+    writer.close()
+    yield sink.drain()
+
+
+# Helper for the file schema of a parquet export (GeoParquet metadata when geometry_tiers is given)
+def _parquet_schema(schema:pa.Schema, geometry_tiers=None) -> pa.Schema:
+    if geometry_tiers is None:
+        return schema
+    from src.data_loader import _geoparquet_metadata
+    geo = _geoparquet_metadata('geometry', geometry_tiers.crs or "EPSG:4326")
+    return schema.with_metadata({**(schema.metadata or {}), b'geo': geo})
+
+
+def _iter_geojson(results, frames, columns, geometry_tiers, tier) -> Iterator[bytes]:
+    '''
+    A FeatureCollection in EPSG:4326 (RFC 7946); properties are the frame columns, NaN written as null
+    '''
+    import shapely
+    yield b'{"type": "FeatureCollection", "features": [\n'
+    first = True
+    for frame in frames:
+        shapes = _chunk_geometry(results, frame, geometry_tiers, tier, crs="EPSG:4326")
+        geometries = shapely.to_geojson(np.asarray(shapes, dtype=object))
+        properties = frame.to_json(orient='records', lines=True).splitlines() if len(frame) else []
+        features = ',\n'.join(
+            f'{{"type": "Feature", "properties": {props}, "geometry": {geom if geom is not None else "null"}}}'
+            for props, geom in zip(properties, geometries)
+        )
+        if features:
+            yield ((',\n' if not first else '') + features).encode('utf-8')
+            first = False
+    yield b'\n]}\n'
+
+
+# Function to stream one export of a result set as encoded chunks
+def iter_export(results:RankedResults, fmt:str, columns:list[str] | None=None, top_n:int | None=None,
+                geometry_tiers=None, tier:str=EXPORT_GEOMETRY_TIER, chunk_rows:int=EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    '''
+    - fmt: key of EXPORT_FORMATS
+    - columns: result columns to keep, in order (default: every column of RankedResults.columns())
+    - top_n: only the top_n best candidates (default: every candidate)
+    - geometry_tiers / tier: GeometryTiers to take the shapes from; required by the geometry formats
+    Arguments are checked right away; nothing is computed until the first chunk is requested.
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}. Options: {list(EXPORT_FORMATS)}")
+    if EXPORT_FORMATS[fmt].geometry and geometry_tiers is None:
+        raise ValueError(f"The {EXPORT_FORMATS[fmt].label} export needs geometry_tiers")
+    columns = results.columns() if columns is None else list(columns)
+    frames = results.iter_frames(columns, top_n, chunk_rows)
+    if fmt == 'csv':
+        return _iter_csv(results, frames, columns, geometry_tiers, tier)
+    if fmt == 'geojson':
+        return _iter_geojson(results, frames, columns, geometry_tiers, tier)
+    return _iter_parquet(results, frames, columns, geometry_tiers, tier, geometry=fmt == 'geoparquet')
+
+
+# Function to write an export to a file (written next to it and renamed, so a failed export leaves no partial file)
+def write_export(results:RankedResults, file_path:Path | str, fmt:str, **kwargs) -> Path:
+    '''
+    kwargs are passed to iter_export. Returns file_path.
+    '''
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(file_path.name + '.tmp')
+    chunks = iter_export(results, fmt, **kwargs)
+    try:
+        with open(tmp_path, 'wb') as f, trace_stage('export.write', fmt=fmt) as span:
+            for chunk in chunks:
+                f.write(chunk)
+            span.info['bytes'] = f.tell()
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return file_path
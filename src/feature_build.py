@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.data_loader import DATA_DIR, DATASETS
+from src.utils import file_hash, find_project_root
+
+
+# Local, incremental rebuild of the ACS 5-yr feature tables, without BigQuery
+# Reproduces notebooks/01_feature_engg/02_create_input_features_acs_5yr.sql (six-way LEFT JOIN + SAFE_DIVIDE densities)
+# and 02_create_input_pcntile_features_acs_5yr.sql (national and state PERCENT_RANK columns).
+# Inputs are the per-source feature tables exported as Parquet, one file per BigQuery table, in SOURCES_DIR:
+#   {geo}_acs_5yr_2024_geo_features.parquet      base: ACS columns + polygons (GeoParquet, WKB)
+#   acs_5yr_{geo}_{source}_features.parquet      parcel / address / property / growth_v2 / firmographics (keyed by geoidfq)
+# Outputs, in DATA_DIR next to the other feature tables:
+#   {table}.parquet                              the features table the app loads (DatasetSpec.table)
+#   acs_5yr_{geo}_features_for_pctile_scoring_v1.parquet   percentile table (no geometry)
+# Every feature group (columns computed from the same inputs) is cached in {table}_build/{group}.parquet with the hashes
+# of its inputs, so after a source export changes only the groups reading it are recomputed, and the outputs are
+# only rewritten when something changed (which keeps the derived / mapped sidecars of the features table valid).
+# Usage:
+#   python -m src.feature_build --level place_5yr
+#   python -m src.feature_build --level block_group_5yr --sources-dir /path/to/exports --force
+
+# Per-source Parquet exports should be stored in root folder / data / intermediate / sources
+SOURCES_DIR = find_project_root() / "data" / "intermediate" / "sources"
+# Bump when the group cache layout or a group computation changes so cached groups are rebuilt
+FEATURE_BUILD_VERSION = 1
+# Radius of the spherical earth BigQuery uses for ST_AREA (meters)
+EARTH_RADIUS_M = 6371008.8
+# Rows of the percentile table (WHERE clause of the pcntile SQL, on top of the features table filter)
+PCTILE_POP_MIN = 500
+
+# Source key -> table name part and the columns the SQL selects from it
+SOURCE_TABLES = {
+    'parcel': 'parcel',
+    'address': 'address',
+    'property': 'property',
+    'growth': 'growth_v2',
+    'firmographics': 'firmographics',
+}
+SOURCE_COLUMNS = {
+    'parcel': ['unq_parcel_count', 'median_parcel_area_sq_mtr'],
+    'address': ['unq_addr_count', 'condo_address_counts'],
+    'property': ['unq_clips', 'median_assessed_value', 'median_tax_amount'],
+    'growth': ['unq_growth_clips'],
+    'firmographics': ['business_count'],
+}
+# Columns taken as is from the base table
+BASE_COLUMNS = ['geoidfq', 'state_fips', 'state_name', 'stusps', 'namelsad']
+# Feature columns in the SELECT order of the SQL
+FEATURE_COLUMNS = [
+    'pop_2024', 'households_2024', 'median_income_2024', 'median_home_value_2024',
+    'unq_parcel_count', 'median_parcel_area_sq_mtr', 'parcel_density',
+    'unq_clips', 'unq_addr_count', 'condo_address_counts', 'median_assessed_value', 'median_tax_amount',
+    'unq_growth_clips', 'growth_clip_share', 'business_count',
+]
+# Percentile column prefixes that differ from the feature name in the SQL
+PCT_PREFIX = {'median_parcel_area_sq_mtr': 'median_parcel_area'}
+
+
+# Helper for the percentile column names of a feature
+def pct_columns(column:str) -> tuple[str, str]:
+    prefix = PCT_PREFIX.get(column, column)
+    return f'{prefix}_pct', f'{prefix}_state_pct'
+
+
+# Function to round half away from zero, as BigQuery ROUND does (numpy rounds half to even)
+def sql_round(values:np.ndarray, decimals:int=2) -> np.ndarray:
+    scale = 10.0 ** decimals
+    values = np.asarray(values, dtype=np.float64)
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+# Function for SAFE_DIVIDE: NULL when the denominator is 0 or either side is NULL
+def safe_divide(num:np.ndarray, den:np.ndarray) -> np.ndarray:
+    num = np.asarray(num, dtype=np.float64)
+    den = np.asarray(den, dtype=np.float64)
+    out = np.full(num.shape, np.nan)
+    ok = ~np.isnan(num) & ~np.isnan(den) & (den != 0)
+    out[ok] = num[ok] / den[ok]
+    return out
+
+
+# Function for ROUND(PERCENT_RANK() OVER ([PARTITION BY partition] ORDER BY values) * 100, 2)
+def percent_rank(values:pd.Series, partition:pd.Series | None=None) -> np.ndarray:
+    '''
+    (rank - 1) / (rows - 1) with ties sharing their lowest rank. NULLs sort first in BigQuery's ascending order,
+    so they get 0 and push the other rows up; a partition with a single row gets 0.
+    '''
+    values = pd.Series(np.asarray(values, dtype=np.float64))
+    if partition is None:
+        rank = values.rank(method='min', na_option='top').to_numpy()
+        n = np.full(len(values), len(values), dtype=np.float64)
+    else:
+        keys = pd.Series(np.asarray(partition))
+        grouped = values.groupby(keys, dropna=False)
+        rank = grouped.rank(method='min', na_option='top').to_numpy()
+        n = grouped.transform('size').to_numpy(dtype=np.float64)
+    pct = np.zeros(len(values))
+    many = n > 1
+    pct[many] = (rank[many] - 1) / (n[many] - 1)
+    return sql_round(pct * 100, 2)
+
+
+# Function for ST_AREA (square meters) of WKB polygons in EPSG:4326
+def spherical_area_m2(geometry_wkb:np.ndarray) -> np.ndarray:
+    '''
+    BigQuery measures geographies on a sphere of radius EARTH_RADIUS_M. The polygons are projected to the
+    cylindrical equal-area projection of that sphere (x = R * lon, y = R * sin(lat)) and measured with one
+    vectorized planar area call. Edges are straight in the projection instead of geodesic, which is well below
+    the 2-decimal rounding of the densities for census polygons.
+    '''
+    import shapely
+    geometry = shapely.from_wkb(geometry_wkb)
+
+    def to_equal_area(coords):
+        return np.column_stack([EARTH_RADIUS_M * np.radians(coords[:, 0]), EARTH_RADIUS_M * np.sin(np.radians(coords[:, 1]))])
+
+    return shapely.area(shapely.transform(geometry, to_equal_area))
+
+
+# --- FEATURE GROUPS ---
+# Every compute function gets the base columns (filtered rows of the features table) and the joined source columns,
+# both as DataFrames row-aligned with the base, and returns the group's feature columns.
+
+def _acs_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    return base[['pop_2024', 'households_2024', 'median_income_2024', 'median_home_value_2024']]
+
+
+def _parcel_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    # ROUND(SAFE_DIVIDE(b.unq_parcel_count, (ST_AREA(a.geometry) / 1000000)), 2)
+    density = sql_round(safe_divide(joined['unq_parcel_count'], base['area_m2'] / 1_000_000), 2)
+    return joined[['unq_parcel_count', 'median_parcel_area_sq_mtr']].assign(parcel_density=density)
+
+
+def _address_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    return joined[['unq_addr_count', 'condo_address_counts']]
+
+
+def _property_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    return joined[['unq_clips', 'median_assessed_value', 'median_tax_amount']]
+
+
+def _growth_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    # ROUND(SAFE_DIVIDE(e.unq_growth_clips, d.unq_clips) * 100, 2)
+    share = sql_round(safe_divide(joined['unq_growth_clips'], joined['unq_clips']) * 100, 2)
+    return joined[['unq_growth_clips']].assign(growth_clip_share=share)
+
+
+def _firmographics_features(base:pd.DataFrame, joined:pd.DataFrame) -> pd.DataFrame:
+    return joined[['business_count']]
+
+
+# Columns computed from the same inputs; the base table is an input of every group
+@dataclass(frozen=True)
+class FeatureGroup:
+    '''
+    - name: group name (file name in the build directory)
+    - sources: SOURCE_TABLES keys joined to the base on geoidfq
+    - compute: (base, joined) -> feature columns of the group
+    - needs_area: the base gets an 'area_m2' column (ST_AREA of the polygons), so the polygons are decoded
+    '''
+    name: str
+    sources: tuple[str, ...]
+    compute: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame]
+    needs_area: bool = False
+
+
+FEATURE_GROUPS = [
+    FeatureGroup('acs', (), _acs_features),
+    FeatureGroup('parcel', ('parcel',), _parcel_features, needs_area=True),
+    FeatureGroup('address', ('address',), _address_features),
+    FeatureGroup('property', ('property',), _property_features),
+    FeatureGroup('growth', ('growth', 'property'), _growth_features),
+    FeatureGroup('firmographics', ('firmographics',), _firmographics_features),
+]
+
+
+# One local feature build: the input and output tables of a geography level
+@dataclass(frozen=True)
+class FeatureBuild:
+    '''
+    - key: DATASETS key of the features table this build writes
+    - geo: geography part of the BigQuery table names ('place', 'tract', 'bg')
+    The ACS 1-yr place table (02_create_input_features_acs_1yr.sql) has a different schema and is not built here.
+    '''
+    key: str
+    geo: str
+
+    @property
+    def table(self) -> str:
+        return DATASETS[self.key].table
+
+    @property
+    def base_table(self) -> str:
+        return f'{self.geo}_acs_5yr_2024_geo_features'
+
+    @property
+    def pctile_table(self) -> str:
+        return f'acs_5yr_{self.geo}_features_for_pctile_scoring_v1'
+
+    def source_table(self, source:str) -> str:
+        return f'acs_5yr_{self.geo}_{SOURCE_TABLES[source]}_features'
+
+    def input_paths(self, sources_dir:Path=SOURCES_DIR) -> dict[str, Path]:
+        '''
+        Table name -> Parquet path of the base and every source
+        '''
+        tables = [self.base_table] + [self.source_table(source) for source in SOURCE_TABLES]
+        return {table: Path(sources_dir) / f'{table}.parquet' for table in tables}
+
+
+FEATURE_BUILDS = {
+    build.key: build for build in [
+        FeatureBuild('place_5yr', 'place'),
+        FeatureBuild('tract_5yr', 'tract'),
+        FeatureBuild('block_group_5yr', 'bg'),
+    ]
+}
+
+
+# Helper for the group cache directory next to the features table
+def build_cache_dir(out_path:Path | str) -> Path:
+    out_path = Path(out_path)
+    return out_path.with_name(f"{out_path.stem}_build")
+
+
+# Function to LEFT JOIN the columns of a source table onto the base keys (hash lookup in Arrow, base order kept)
+def left_join(keys:pa.Array, source:pa.Table, columns:list[str], name:str='source') -> pd.DataFrame:
+    '''
+    Rows without a match get NULL (NaN). A source with repeated geoidfq is rejected: the SQL join would repeat
+    the base rows, which is never intended for these per-geography tables.
+    '''
+    if pc.count_distinct(source['geoidfq']).as_py() != source.num_rows:
+        raise ValueError(f"{name} has repeated geoidfq values; LEFT JOIN USING (geoidfq) would duplicate base rows")
+    positions = pc.index_in(keys, value_set=source['geoidfq'])
+    return pa.table({c: pc.take(source[c], positions) for c in columns}).to_pandas()
+
+
+# Helper to read the manifest stored in the parquet metadata of a group / output file
+def _read_manifest(path:Path, meta_key:bytes) -> dict | None:
+    if not path.exists():
+        return None
+    schema_meta = pq.read_schema(path).metadata or {}
+    if meta_key not in schema_meta:
+        return None
+    return json.loads(schema_meta[meta_key])
+
+
+# Helper to write a table next to its final path and rename it into place, with a manifest in the metadata
+def _write_table(table:pa.Table, path:Path, meta_key:bytes, manifest:dict) -> None:
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), meta_key: json.dumps(manifest).encode('utf-8')})
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+# Function to compute one feature group with its national and state percentile columns
+def compute_group(group:FeatureGroup, base:pd.DataFrame, keys:pa.Array, sources:dict[str, pa.Table],
+                  pctile_rows:np.ndarray) -> pd.DataFrame:
+    '''
+    Percentiles are ranked over pctile_rows only (the rows of the percentile table) and are NaN elsewhere.
+    '''
+    joined = pd.DataFrame(index=base.index)
+    if group.sources:
+        joined = pd.concat([left_join(keys, sources[source], SOURCE_COLUMNS[source], source)
+                            for source in group.sources], axis=1)
+    features = group.compute(base, joined).reset_index(drop=True)
+
+    out = {'geoidfq': base['geoidfq'].to_numpy()}
+    state_fips = base['state_fips'].to_numpy()[pctile_rows]
+    for c in features.columns:
+        values = features[c].to_numpy(dtype=np.float64)
+        out[c] = features[c].to_numpy()
+        national, state = np.full(len(base), np.nan), np.full(len(base), np.nan)
+        national[pctile_rows] = percent_rank(values[pctile_rows])
+        state[pctile_rows] = percent_rank(values[pctile_rows], state_fips)
+        nat_col, state_col = pct_columns(c)
+        out[nat_col], out[state_col] = national, state
+    return pd.DataFrame(out)
+
+
+# Function to rebuild a level's feature and percentile tables from the local source exports
+def build_features(key:str, sources_dir:Path | str=SOURCES_DIR, out_dir:Path | str=DATA_DIR,
+                   force:bool=False) -> dict:
+    '''
+    Groups whose input hashes (base + its sources) match their cached file are read back instead of recomputed;
+    force=True recomputes every group. Returns a summary with the rebuilt / reused groups and the output paths.
+    '''
+    if key not in FEATURE_BUILDS:
+        raise ValueError(f"No local feature build for {key}. Options: {list(FEATURE_BUILDS)}")
+    build = FEATURE_BUILDS[key]
+    start_time = time.time()
+    input_paths = build.input_paths(Path(sources_dir))
+    missing = [str(path) for path in input_paths.values() if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Source exports not found: {missing}")
+
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = out_dir / f'{build.table}.parquet'
+    pctile_path = out_dir / f'{build.pctile_table}.parquet'
+    cache_dir = build_cache_dir(out_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    hashes = {table: file_hash(path) for table, path in input_paths.items()}
+    # Geometry stays WKB in Arrow; it is only decoded when a group needs ST_AREA
+    base_path = input_paths[build.base_table]
+    base_table = pq.read_table(base_path)
+    # WHERE a.median_income_2024 > 0 AND a.median_home_value_2024 > 0 (NULL fails the test)
+    keep = pc.fill_null(pc.and_(pc.greater(base_table['median_income_2024'], 0),
+                                pc.greater(base_table['median_home_value_2024'], 0)), False)
+    base_table = base_table.filter(keep)
+    keys = base_table['geoidfq'].combine_chunks()
+    base = base_table.drop_columns(['geometry']).to_pandas()
+    # WHERE a.pop_2024 >= 500 on top of the filter above
+    pctile_rows = np.flatnonzero(base['pop_2024'].to_numpy(dtype=np.float64) >= PCTILE_POP_MIN)
+
+    sources = {}
+    rebuilt, reused = [], []
+    group_frames = []
+    for group in FEATURE_GROUPS:
+        group_path = cache_dir / f'{group.name}.parquet'
+        inputs = [build.base_table] + [build.source_table(source) for source in group.sources]
+        manifest = {'version': FEATURE_BUILD_VERSION, 'group': group.name, 'pctile_pop_min': PCTILE_POP_MIN,
+                    'inputs': {table: hashes[table] for table in inputs}}
+        if not force and _read_manifest(group_path, b'feature_group') == manifest:
+            group_frames.append(pd.read_parquet(group_path))
+            reused.append(group.name)
+            continue
+
+        for source in group.sources:
+            if source not in sources:
+                columns = ['geoidfq'] + SOURCE_COLUMNS[source]
+                sources[source] = pq.read_table(input_paths[build.source_table(source)], columns=columns)
+        if group.needs_area and 'area_m2' not in base.columns:
+            base['area_m2'] = spherical_area_m2(base_table['geometry'].to_numpy(zero_copy_only=False))
+        frame = compute_group(group, base, keys, sources, pctile_rows)
+        _write_table(pa.Table.from_pandas(frame, preserve_index=False), group_path, b'feature_group', manifest)
+        group_frames.append(frame)
+        rebuilt.append(group.name)
+
+    # Outputs are only rewritten when a group changed or they are missing / from another build
+    output_manifest = {'version': FEATURE_BUILD_VERSION, 'inputs': hashes}
+    outputs_current = (_read_manifest(out_path, b'feature_build') == output_manifest
+                       and _read_manifest(pctile_path, b'feature_build') == output_manifest)
+    if rebuilt or not outputs_current:
+        groups = pd.concat([frame.drop(columns='geoidfq') for frame in group_frames], axis=1)
+        if any(not np.array_equal(frame['geoidfq'].to_numpy(dtype=str), base['geoidfq'].to_numpy(dtype=str))
+               for frame in group_frames):
+            raise ValueError("Cached feature groups are not aligned with the base table; rerun with force=True")
+        write_feature_tables(base_table, groups, pctile_rows, out_path, pctile_path, output_manifest)
+        print(f'Feature tables saved to: {out_path} and {pctile_path}!')
+
+    elapsed = time.time() - start_time
+    print(f"{DATASETS[key].label}: {len(base):,} rows, rebuilt {rebuilt or 'no'} groups, "
+          f"reused {len(reused)} in {elapsed:.2f}s")
+    return {'rows': len(base), 'rebuilt': rebuilt, 'reused': reused, 'features_path': out_path,
+            'pctile_path': pctile_path, 'seconds': elapsed}
+
+
+# Function to assemble and write the two output tables from the base and the group columns
+def write_feature_tables(base_table:pa.Table, groups:pd.DataFrame, pctile_rows:np.ndarray,
+                         out_path:Path, pctile_path:Path, manifest:dict) -> None:
+    '''
+    The features table keeps the base GeoParquet metadata and its WKB geometry column unchanged (no decoding),
+    so it loads like an export of the BigQuery table.
+    '''
+    features = pa.Table.from_pandas(groups[FEATURE_COLUMNS], preserve_index=False)
+    columns = {c: base_table[c] for c in BASE_COLUMNS}
+    columns.update({c: features[c] for c in FEATURE_COLUMNS})
+    columns['geometry'] = base_table['geometry']
+    table = pa.table(columns)
+    geo_meta = (base_table.schema.metadata or {}).get(b'geo')
+    if geo_meta is not None:
+        table = table.replace_schema_metadata({b'geo': geo_meta})
+    _write_table(table, out_path, b'feature_build', manifest)
+
+    # Percentile table: base_features rows with pop_2024 >= 500, national then state percentiles, no geometry
+    pct_cols = [pct_columns(c)[0] for c in FEATURE_COLUMNS] + [pct_columns(c)[1] for c in FEATURE_COLUMNS]
+    pct = pa.Table.from_pandas(groups[pct_cols].iloc[pctile_rows], preserve_index=False)
+    rows = pa.array(pctile_rows)
+    columns = {c: base_table[c].take(rows) for c in BASE_COLUMNS}
+    columns.update({c: features[c].take(rows) for c in FEATURE_COLUMNS})
+    columns.update({c: pct[c] for c in pct_cols})
+    _write_table(pa.table(columns), pctile_path, b'feature_build', manifest)
+
+
+def main(argv:list[str] | None=None):
+    parser = argparse.ArgumentParser(description="Rebuild the ACS 5-yr feature tables locally from the per-source Parquet exports.")
+    parser.add_argument('--level', default='place_5yr', choices=list(FEATURE_BUILDS), help="Geography level to build")
+    parser.add_argument('--sources-dir', default=SOURCES_DIR, help="Directory with the per-source Parquet exports")
+    parser.add_argument('--out-dir', default=DATA_DIR, help="Directory for the feature tables")
+    parser.add_argument('--force', action='store_true', help="Recompute every feature group")
+    args = parser.parse_args(argv)
+    build_features(args.level, args.sources_dir, args.out_dir, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
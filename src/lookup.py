@@ -0,0 +1,142 @@
+import difflib
+from functools import cached_property
+import numpy as np
+import pandas as pd
+
+
+# Name lookups for the reference picker, built once per dataset level
+# Tab 1 used to filter the whole frame per selector row and per selection; every lookup here is a dict access
+# or a binary search, so the picker also works for tract / block group tables and type-ahead search.
+
+# Trigrams shared by more than this share of all names (e.g. " ci" of "city") are not used to find fuzzy candidates
+COMMON_TRIGRAM_SHARE = 0.1
+# Number of trigram candidates re-scored with difflib per fuzzy query
+FUZZY_CANDIDATES = 200
+
+
+# Helper to normalize names for matching
+def _normalize(text:str) -> str:
+    return " ".join(str(text).casefold().split())
+
+
+# Helper for the character trigrams of a normalized name (padded so short words and word starts count)
+def _trigrams(text:str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Helper for the range of sorted keys starting with prefix
+def _prefix_range(keys:np.ndarray, prefix:str) -> tuple[int, int]:
+    lo = np.searchsorted(keys, prefix, side='left')
+    hi = np.searchsorted(keys, prefix + '￿', side='right')
+    return int(lo), int(hi)
+
+
+class PlaceLookup:
+    '''
+    Built from the attrs frame of a FeatureStore (geoidfq, namelsad, state_name, stusps):
+        - states: sorted state names
+        - names(state): sorted unique names of one state
+        - geoid(state, name): geoidfq of a (state, name) pair
+        - search(query): prefix matches on full names and on words, then fuzzy matches
+    '''
+    def __init__(self, attrs:pd.DataFrame):
+        attrs = attrs[['geoidfq', 'namelsad', 'state_name', 'stusps']].reset_index(drop=True)
+        self.attrs = attrs
+        self.states = sorted(attrs['state_name'].dropna().unique().tolist())
+        self._names = {
+            state: sorted(names.drop_duplicates().tolist())
+            for state, names in attrs.groupby('state_name', sort=True)['namelsad']
+        }
+        # First row wins for duplicated (state, name) pairs, as in the old .iloc[0] lookup
+        first = attrs.drop_duplicates(['state_name', 'namelsad'], keep='first')
+        self._geoids = dict(zip(zip(first['state_name'].tolist(), first['namelsad'].tolist()), first['geoidfq'].tolist()))
+
+        # Indexes work on unique normalized names (tract / block group names repeat a lot); each maps back to its rows
+        codes, unique_names = pd.factorize(pd.Series([_normalize(name) for name in attrs['namelsad'].tolist()]))
+        self._unique_names = unique_names.tolist()
+        self._rows_order = np.argsort(codes, kind='stable')
+        self._rows_bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(self._unique_names)))])
+
+        # Prefix index over full names and over every word of the names
+        name_keys = np.array(self._unique_names, dtype=str)
+        self._name_ids = np.argsort(name_keys, kind='stable')
+        self._name_keys = name_keys[self._name_ids]
+        split = [name.split() for name in self._unique_names]
+        word_ids = np.repeat(np.arange(len(split)), [len(words) for words in split])
+        word_keys = np.array([word for words in split for word in words], dtype=str)
+        order = np.argsort(word_keys, kind='stable')
+        self._word_keys = word_keys[order]
+        self._word_ids = word_ids[order]
+
+    @cached_property
+    def _trigram_ids(self) -> dict[str, np.ndarray]:
+        '''
+        Trigram -> unique name ids, built on the first fuzzy query; very common trigrams are dropped
+        '''
+        postings = {}
+        for name_id, name in enumerate(self._unique_names):
+            for gram in _trigrams(name):
+                postings.setdefault(gram, []).append(name_id)
+        max_postings = max(int(len(self._unique_names) * COMMON_TRIGRAM_SHARE), 1)
+        return {gram: np.asarray(ids, dtype=np.intp) for gram, ids in postings.items() if len(ids) <= max_postings}
+
+    # Helper to expand unique name ids to row positions (name order kept, rows ascending within a name)
+    def _rows(self, name_ids):
+        for name_id in name_ids:
+            yield from self._rows_order[self._rows_bounds[name_id]:self._rows_bounds[name_id + 1]].tolist()
+
+    def names(self, state:str) -> list[str]:
+        return self._names.get(state, [])
+
+    def geoid(self, state:str, name:str) -> str | None:
+        return self._geoids.get((state, name))
+
+    def search(self, query:str, limit:int=20, states:list[str] | None=None) -> pd.DataFrame:
+        '''
+        Returns up to limit rows (geoidfq, namelsad, state_name, stusps, match) best first:
+            - 'prefix': the name starts with the query
+            - 'word': a word of the name starts with the query (e.g. "spring" -> "Colorado Springs city")
+            - 'fuzzy': closest names by trigram overlap and difflib ratio (typos)
+        states optionally restricts the matches.
+        '''
+        query = _normalize(query)
+        if not query:
+            return self.attrs.iloc[:0].assign(match=pd.Series(dtype=str))
+        allowed = None if not states else self.attrs['state_name'].isin(states).to_numpy()
+
+        rows, kinds, seen = [], [], set()
+        def add(candidates, kind):
+            for row in candidates:
+                if len(rows) >= limit:
+                    return
+                if row in seen or (allowed is not None and not allowed[row]):
+                    continue
+                seen.add(row)
+                rows.append(row)
+                kinds.append(kind)
+
+        lo, hi = _prefix_range(self._name_keys, query)
+        add(self._rows(self._name_ids[lo:hi].tolist()), 'prefix')
+        if len(rows) < limit:
+            lo, hi = _prefix_range(self._word_keys, query)
+            add(self._rows(self._word_ids[lo:hi].tolist()), 'word')
+        if len(rows) < limit:
+            add(self._rows(self._fuzzy_ids(query)), 'fuzzy')
+
+        return self.attrs.iloc[rows].assign(match=kinds)
+
+    def _fuzzy_ids(self, query:str) -> list[int]:
+        postings = [self._trigram_ids[g] for g in _trigrams(query) if g in self._trigram_ids]
+        if not postings:
+            return []
+        # Candidates sharing the most trigrams with the query, then re-scored on the full string
+        ids, counts = np.unique(np.concatenate(postings), return_counts=True)
+        if ids.size > FUZZY_CANDIDATES:
+            ids = ids[np.argpartition(-counts, FUZZY_CANDIDATES - 1)[:FUZZY_CANDIDATES]]
+        scored = [
+            (difflib.SequenceMatcher(None, query, self._unique_names[name_id]).ratio(), -name_id)
+            for name_id in ids.tolist()
+        ]
+        scored.sort(reverse=True)
+        return [-name_id for _, name_id in scored]
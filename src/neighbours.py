@@ -0,0 +1,178 @@
+import warnings
+import numpy as np
+from scipy.spatial import cKDTree
+
+from src.config import METRICS, metric_groups_for
+from src.analytics import (
+    Universe, RankedResults, ReferenceOutsideUniverseWarning, OUTSIDE_UNIVERSE_NOTE,
+    build_target_vectors, group_sq_distances, group_sim_col, reference_frame, score_universe, top_k_order,
+)
+from src.tracing import trace_stage
+
+
+# Top-K retrieval of look-alikes for large universes (tracts / block groups)
+# The weighted RMSE used by the engine is
+#   sqrt(sum_g w_g * ||x_g - t_g||^2 / sum(w))
+# which is a plain Euclidean distance once every column of group g is scaled by s_g = sqrt(w_g / sum(w)).
+# The KD-tree holds the unweighted local percentiles, so one tree per universe serves every weighting:
+# a query fetches the nearest rows in the unweighted space and re-ranks them by their weighted distance.
+# Every row left out is at weighted distance >= min(s) * r (r: unweighted distance of the last row fetched),
+# which certifies the re-ranked top-K whenever its K-th distance is below that bound (always when the weights are equal).
+# With uneven weights the bound rarely holds, so the tree only serves the approximate mode (exact=False);
+# the exact mode needs a linear pass over the universe for the score scaling anyway and ranks from that pass.
+
+# Rows fetched from the tree per row kept when the group weights differ (re-ranked by weighted distance)
+INDEX_OVERFETCH = 8
+
+
+# Helper for the per-column scale of the weighted feature space
+def column_scale(weights:dict[str, float], metrics:list[str]=METRICS) -> np.ndarray:
+    total_weight = sum(weights.values())
+    group_of = {m: group for group, group_metrics in metric_groups_for(metrics).items() for m in group_metrics}
+    return np.sqrt(np.array([weights.get(group_of[m], 0.5) for m in metrics]) / total_weight)
+
+
+# KD-tree over one universe, shared by every weighting
+class NeighbourIndex:
+    '''
+    Built once per universe (weights are applied at query time); NaN percentiles are treated as 0,
+    like the brute-force path. Queries cost O(log n) per fetched row instead of a full scan.
+    '''
+    def __init__(self, universe:Universe, metrics:list[str]=METRICS, leafsize:int=32):
+        self.universe = universe
+        self.metrics = list(metrics)
+        self.tree = cKDTree(np.nan_to_num(universe.local_pct, nan=0.0), leafsize=leafsize)
+        # Bounding box of the percentiles, used for the approximate score scaling
+        self.col_min = self.tree.mins
+        self.col_max = self.tree.maxes
+
+    @property
+    def nbytes(self) -> int:
+        return self.tree.data.nbytes + self.tree.indices.nbytes
+
+    def query(self, target:np.ndarray, k:int, weights:dict[str, float], overfetch:int=INDEX_OVERFETCH,
+              eps:float=0.0) -> tuple[np.ndarray, np.ndarray, bool]:
+        '''
+        Returns (weighted RMSE, universe position) of the k nearest rows under weights, nearest first
+        (ties by position, like the brute-force ranking), and whether they are certified to be the exact k nearest.
+        overfetch * k rows are fetched from the tree (k when the weights are equal) and re-ranked.
+        eps > 0 allows approximate tree neighbours (every fetched distance is within (1 + eps) of the true one).
+        '''
+        n = self.tree.n
+        scale = column_scale(weights, self.metrics)
+        uniform = np.ptp(scale) == 0
+        fetch = min(k if uniform else k * overfetch, n)
+        if fetch == 0:
+            return np.empty(0), np.empty(0, dtype=np.intp), True
+        unweighted, pos = self.tree.query(target, k=fetch, eps=eps)
+        unweighted, pos = np.atleast_1d(unweighted), np.atleast_1d(pos)
+        dist = np.sqrt(((self.tree.data[pos] - target) ** 2 * scale ** 2).sum(axis=1))
+        order = np.lexsort((pos, dist))[:k]
+        dist, pos = dist[order], pos[order]
+        certified = eps == 0 and (fetch == n or uniform or dist[-1] < scale.min() * unweighted[-1])
+        return dist, pos, bool(certified)
+
+    def farthest_bound(self, target:np.ndarray, cols:np.ndarray | None=None, scale:np.ndarray | None=None) -> float:
+        '''
+        Upper bound of the distance from target to any row: distance to the farthest bounding-box corner
+        (weighted when the column scale is given)
+        '''
+        cols = np.arange(len(self.metrics)) if cols is None else cols
+        span = np.maximum(np.abs(target[cols] - self.col_min[cols]), np.abs(self.col_max[cols] - target[cols]))
+        if scale is not None:
+            span = span * scale[cols]
+        return float(np.sqrt((span ** 2).sum()))
+
+
+def _scale(dists:np.ndarray, d_min:float, d_max:float) -> np.ndarray:
+    if d_max > d_min:
+        return 100 * (1 - (dists - d_min) / (d_max - d_min))
+    return np.full(dists.shape, 100.0)
+
+
+# Function to score one reference set and keep only the top_k candidates
+def score_universe_indexed(store, universe:Universe, ref_geoids, weights, top_k:int=50,
+                           exact:bool=True, index:NeighbourIndex | None=None, eps:float=0.0,
+                           overfetch:int=INDEX_OVERFETCH, metrics:list[str]=METRICS) -> RankedResults:
+    '''
+    Returns RankedResults holding only the top_k nearest candidates (references excluded).
+    exact controls both the retrieval and the 0-100 scaling:
+        - exact=True: same candidates, order and scores as the brute-force path. One linear pass over the universe
+          gives the weighted distances (for the min/max of the scaling) and the top_k are a partial selection on them;
+          no tree, no full sort and no per-row frame work
+        - exact=False: sub-linear. Candidates come from the KD-tree (index, or one built here), re-ranked by weighted
+          distance; exact when the group weights are equal, approximate otherwise (see INDEX_OVERFETCH).
+          Scores: min from the nearest neighbour, max from the bounding box of the universe,
+          so they are only comparable within one query
+    eps is passed to the tree query for approximate neighbours (exact=False only).
+    '''
+    if universe.empty:
+        return score_universe(store, universe, ref_geoids, weights, top_k, metrics)
+
+    with trace_stage('score.targets', rows=len(ref_geoids)):
+        targets, ref_masks, outside, ref_pcts = build_target_vectors(
+            store, universe.rows, universe.local_pct, [ref_geoids], universe.sorted_values)
+    if outside[0]:
+        warnings.warn(ReferenceOutsideUniverseWarning(OUTSIDE_UNIVERSE_NOTE))
+    target = targets[0]
+    ref_mask = ref_masks[0]
+
+    scores = {}
+    if exact:
+        with trace_stage('score.distances', rows=universe.rows.size):
+            all_dists = {group: d[:, 0] for group, d in group_sq_distances(universe.local_pct, target[None, :], metrics).items()}
+            weighted_sq = sum(d * weights.get(group, 0.5) for group, d in all_dists.items())
+            all_rmse = np.sqrt(weighted_sq / sum(weights.values()))
+        with trace_stage('score.scaling', rows=universe.rows.size, exact=exact):
+            # Same min/max and tie order as the brute-force path (over the whole universe, references included)
+            similarity = _scale(all_rmse, all_rmse.min(), all_rmse.max())
+            candidates = np.flatnonzero(~ref_mask)
+            pos = candidates[top_k_order(similarity[candidates], top_k)]
+            scores['overall_similarity'] = similarity[pos]
+            for group, d in all_dists.items():
+                root = np.sqrt(d)
+                scores[group_sim_col(group)] = _scale(root[pos], root.min(), root.max())
+    else:
+        if index is None:
+            with trace_stage('index.build', rows=universe.rows.size):
+                index = NeighbourIndex(universe, metrics)
+        # Ask for enough neighbours to still have top_k after dropping the references
+        with trace_stage('index.query', rows=universe.rows.size, k=top_k) as span:
+            dist, pos, span.info['certified'] = index.query(target, top_k + int(ref_mask.sum()), weights, overfetch, eps)
+        # The nearest fetched row (references included) is the minimum of the scaling
+        nearest = float(dist[0]) if dist.size else 0.0
+        keep = ~ref_mask[pos]
+        dist, pos = dist[keep][:top_k], pos[keep][:top_k]
+
+        # Per-group squared distances of the retrieved rows only
+        group_dists = {group: d[:, 0] for group, d in group_sq_distances(universe.local_pct[pos], target[None, :], metrics).items()}
+        metric_pos = {m: j for j, m in enumerate(metrics)}
+        with trace_stage('score.scaling', rows=pos.size, exact=exact):
+            scale = column_scale(weights, metrics)
+            scores['overall_similarity'] = _scale(dist, nearest, index.farthest_bound(target, scale=scale))
+            for group, group_metrics in metric_groups_for(metrics).items():
+                cols = np.array([metric_pos[m] for m in group_metrics])
+                root = np.sqrt(group_dists[group])
+                g_min = float(root.min()) if root.size else 0.0
+                scores[group_sim_col(group)] = _scale(root, g_min, index.farthest_bound(target, cols))
+
+    # Positions are already in rank order; RankedResults keeps ties in this order
+    return RankedResults(store, universe.rows[pos], np.zeros(pos.size, dtype=bool), scores, top_k,
+                         references_outside=outside[0],
+                         references=reference_frame(store, universe.rows, ref_geoids, ref_pcts[0], metrics))
+
+
+# Function to check the indexed path against the brute-force path
+def compare_with_brute_force(store, universe:Universe, ref_geoids, weights, top_k:int=50, **indexed_kwargs) -> dict:
+    '''
+    Returns the share of the brute-force top_k found by the indexed path (recall) and the largest
+    overall_similarity difference on the shared rows.
+    '''
+    brute = score_universe(store, universe, ref_geoids, weights, top_k, indexed_kwargs.get('metrics', METRICS)).top()
+    indexed = score_universe_indexed(store, universe, ref_geoids, weights, top_k, **indexed_kwargs).top()
+    shared = brute.index.intersection(indexed.index)
+    max_diff = float(np.abs(brute.loc[shared, 'overall_similarity'] - indexed.loc[shared, 'overall_similarity']).max()) if len(shared) else 0.0
+    return {
+        'recall': len(shared) / max(len(brute), 1),
+        'max_similarity_diff': max_diff,
+    }
@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+from src.analytics import RankedResults
+from src.tracing import trace_stage
+
+
+# Weight-sensitivity / rank-stability analysis of one search
+# Only the weights change between the sampled weightings, so every one of them is answered from the per-group
+# squared distances kept on the RankedResults (no filtering, percentiles or distances are recomputed).
+# The overall similarity is a decreasing function of the weighted sum of those distances (the RMSE root and the
+# min-max scaling keep the order), so the ranking under weights w is the ascending order of D @ w, with
+#     D = [candidates * groups] squared group distances
+# and a batch of weightings is a single matrix product D @ W.T. Batches are spread over a process pool
+# when the universe is large.
+#
+# Two passes over the samples:
+#     1. the candidates reaching the top track_k under any weighting (a partial selection per weighting)
+#     2. the exact rank of each of those candidates under every weighting
+# so the full [candidates * samples] rank matrix is never held (240k block groups * 1,000 weightings).
+
+SENSITIVITY_SAMPLES = 1000
+# Weightings scored per matrix product (one process pool task)
+SAMPLE_BATCH = 32
+# Universes smaller than this are scored in-process (the pool start-up costs more than it saves)
+PARALLEL_MIN_ROWS = 50_000
+# Candidates reaching this rank under any weighting get their rank tracked across all weightings
+TRACK_TOP_K = 50
+SAMPLING_METHODS = ['monte_carlo', 'grid']
+
+
+# Result of one sensitivity run
+@dataclass
+class SensitivityReport:
+    '''
+    - frame: one row per tracked candidate, most stable first (by median rank), indexed by row position in store:
+      attributes, base_rank (rank under the chosen weights), median_rank, rank_p<lo> / rank_p<hi> (rank interval),
+      best_rank, worst_rank and top<top_n>_share (share of the weightings that put it in the top top_n)
+    - samples: [weightings * groups] sampled weights
+    - workers: processes used (1 when scored in-process)
+    '''
+    frame: pd.DataFrame
+    samples: pd.DataFrame
+    top_n: int
+    interval: tuple[float, float]
+    workers: int
+    seconds: float
+
+
+# Function to sample weight vectors around the chosen weights
+def sample_weights(weights:dict[str, float], n_samples:int=SENSITIVITY_SAMPLES, method:str='monte_carlo',
+                   spread:float=0.15, grid_levels:int=5, seed:int | None=0) -> pd.DataFrame:
+    '''
+    Returns a [weightings * groups] frame of weights in [0, 1] (the range of the sliders), one column per group of weights:
+        - monte_carlo: n_samples draws of weights + N(0, spread), clipped to [0, 1]
+        - grid: every combination of grid_levels evenly spaced weights in [0, 1] (grid_levels ** groups rows);
+          n_samples and spread are ignored
+    Weightings with all weights at 0 are dropped (they do not define a ranking).
+    '''
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Unknown sampling method: {method}. Options: {SAMPLING_METHODS}")
+    groups = list(weights)
+    base = np.array([weights[g] for g in groups], dtype=np.float64)
+    if method == 'grid':
+        if grid_levels < 2:
+            raise ValueError("grid_levels must be at least 2")
+        levels = np.linspace(0.0, 1.0, grid_levels)
+        samples = np.stack(np.meshgrid(*[levels] * len(groups), indexing='ij'), axis=-1).reshape(-1, len(groups))
+    else:
+        if n_samples < 1:
+            raise ValueError("n_samples must be at least 1")
+        rng = np.random.default_rng(seed)
+        samples = np.clip(base + rng.normal(0.0, spread, size=(n_samples, len(groups))), 0.0, 1.0)
+    samples = samples[samples.sum(axis=1) > 0]
+    return pd.DataFrame(samples, columns=groups)
+
+
+# Helper for the candidates in the top k of every weighting of a batch
+def top_rows(dists:np.ndarray, weight_batch:np.ndarray, k:int) -> np.ndarray:
+    # [weightings * candidates], so each weighting is one contiguous row
+    scores = weight_batch @ dists.T
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    return np.unique(np.argpartition(scores, k - 1, axis=1)[:, :k])
+
+
+# Helper for the rank of some candidates under every weighting of a batch
+def tracked_ranks(dists:np.ndarray, weight_batch:np.ndarray, rows:np.ndarray) -> np.ndarray:
+    '''
+    [rows * weightings] ranks (1 = best); ties share the best rank.
+    Only the scores up to the worst tracked one can come before a tracked candidate, so only those are sorted.
+    '''
+    scores = weight_batch @ dists.T
+    ranks = np.empty((rows.size, scores.shape[0]), dtype=np.int32)
+    for j, row_scores in enumerate(scores):
+        values = row_scores[rows]
+        ahead = np.sort(row_scores[row_scores <= values.max()]) if rows.size else row_scores[:0]
+        ranks[:, j] = np.searchsorted(ahead, values, side='left') + 1
+    return ranks
+
+
+# Distances held by each pool process (sent once, on start-up, instead of with every task)
+_worker_dists = None
+
+
+def _init_worker(dists:np.ndarray) -> None:
+    global _worker_dists
+    _worker_dists = dists
+
+
+def _worker_top_rows(weight_batch:np.ndarray, k:int) -> np.ndarray:
+    return top_rows(_worker_dists, weight_batch, k)
+
+
+def _worker_tracked_ranks(weight_batch:np.ndarray, rows:np.ndarray) -> np.ndarray:
+    return tracked_ranks(_worker_dists, weight_batch, rows)
+
+
+# Function to measure how stable the ranking of a search is under other weights
+def rank_stability(results:RankedResults, weights:dict[str, float], samples:pd.DataFrame | None=None,
+                   top_n:int=10, track_k:int=TRACK_TOP_K, interval:tuple[float, float]=(5, 95),
+                   max_workers:int | None=None, **sample_kwargs) -> SensitivityReport:
+    '''
+    - weights: the chosen weights (the base ranking, and the centre of the sampling)
+    - samples: [weightings * groups] weights to score; default sample_weights(weights, **sample_kwargs).
+      Groups missing from samples get weight 0.5, as in the scoring.
+    - top_n: cut-off of the inclusion share; track_k: depth that makes a candidate tracked (at least top_n)
+    - interval: percentiles of the rank interval
+    - max_workers: processes for large universes (default: one per core; 1 scores in-process)
+    '''
+    if results.group_dists is None:
+        raise ValueError("These results were built without per-group distances and cannot be reweighted")
+    if top_n < 1:
+        raise ValueError("top_n must be at least 1")
+    samples = sample_weights(weights, **sample_kwargs) if samples is None else samples
+    if samples.empty:
+        raise ValueError("No weightings to score")
+
+    started = time.perf_counter()
+    groups = list(results.group_dists)
+    candidates = ~results.ref_mask
+    dists = np.column_stack([results.group_dists[g][candidates] for g in groups]).astype(np.float64)
+    sampled = np.column_stack([samples[g].to_numpy(dtype=np.float64) if g in samples else np.full(len(samples), 0.5)
+                               for g in groups])
+    base = np.array([[weights.get(g, 0.5) for g in groups]], dtype=np.float64)
+    batches = [sampled[start:start + SAMPLE_BATCH] for start in range(0, len(sampled), SAMPLE_BATCH)]
+    track_k = max(track_k, top_n)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    workers = min(max_workers, len(batches)) if len(dists) >= PARALLEL_MIN_ROWS else 1
+    with trace_stage('sensitivity.rank', rows=len(dists), samples=len(sampled), workers=workers):
+        if workers > 1:
+            # spawn, not fork: the app and the service call this from threaded servers
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker, initargs=(dists,)) as pool:
+                reached = list(pool.map(_worker_top_rows, batches, [track_k] * len(batches)))
+                tracked = np.unique(np.concatenate(reached + [top_rows(dists, base, track_k)]))
+                ranks = np.hstack(list(pool.map(_worker_tracked_ranks, batches, [tracked] * len(batches))))
+        else:
+            reached = [top_rows(dists, batch, track_k) for batch in batches]
+            tracked = np.unique(np.concatenate(reached + [top_rows(dists, base, track_k)]))
+            ranks = np.hstack([tracked_ranks(dists, batch, tracked) for batch in batches])
+        base_ranks = tracked_ranks(dists, base, tracked)[:, 0]
+
+    lo, hi = np.percentile(ranks, interval, axis=1)
+    stats = {
+        'base_rank': base_ranks,
+        'median_rank': np.median(ranks, axis=1),
+        f'rank_p{interval[0]:g}': lo,
+        f'rank_p{interval[1]:g}': hi,
+        'best_rank': ranks.min(axis=1),
+        'worst_rank': ranks.max(axis=1),
+        f'top{top_n}_share': (ranks <= top_n).mean(axis=1),
+    }
+    attrs = results.store.attrs
+    columns = [c for c in ['geoidfq', 'namelsad', 'state_name', 'pop_2024'] if c in attrs.columns]
+    frame = attrs.iloc[results.rows[tracked], [attrs.columns.get_loc(c) for c in columns]].assign(**stats)
+    frame = frame.sort_values(['median_rank', 'base_rank'], kind='stable')
+    return SensitivityReport(frame, pd.DataFrame(sampled, columns=groups), top_n, tuple(interval), workers,
+                             time.perf_counter() - started)
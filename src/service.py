@@ -0,0 +1,415 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qs
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.config import METRIC_GROUPS, metric_groups_for
+from src.analytics import OUTSIDE_UNIVERSE_NOTE
+from src.cache import SimilarityCache
+from src.data_loader import DATA_DIR, DATASETS, DEFAULT_DATASET
+from src.export import EXPORT_FORMATS, iter_export
+from src.shared_store import load_shared_dataset
+from src.spatial import load_spatial_index
+from src.spatial_filter import SpatialFilter
+from src.utils import file_version
+
+
+# Headless similarity service: the engine behind a small JSON/Arrow HTTP API (plain ASGI, no web framework)
+# Usage:
+#   python -m src.service serve --level place_5yr --port 8000 --workers 2      (needs uvicorn)
+#   python -m src.service load-test jobs.json --url http://127.0.0.1:8000 --requests 500 --concurrency 16
+# Endpoints:
+#   POST /similar   {"ref_geoids": [...], "states": [...], "pop_min": 5000, "weights": {...}, "top_k": 50}
+#                   optional spatial constraints: "radius_km": 150, "bbox": [w, s, e, n], "exclude_adjacent": true
+#                   JSON by default; Arrow IPC stream with ?format=arrow or Accept: application/vnd.apache.arrow.stream
+#   POST /export    same body plus "format" (csv / parquet / geojson / geoparquet), "columns" and "top_n";
+#                   every candidate by default, streamed in chunks (src.export)
+#   GET  /health    level, rows and dataset version
+#   GET  /stats     cache hit/miss counters
+
+ARROW_MIME = 'application/vnd.apache.arrow.stream'
+DEFAULT_TOP_K = 50
+MAX_TOP_K = 10_000
+# Scoring threads per server process (numpy releases the GIL for the heavy array work)
+MAX_WORKERS = 4
+
+
+# Raised for a bad request; turned into a 400 response
+class QueryError(ValueError):
+    pass
+
+
+# Helper for a flag of a request body; only JSON booleans are accepted ("false" or 0 would be truthy in Python)
+def _bool_param(body:dict, name:str, default:bool) -> bool:
+    value = body.get(name, default)
+    if not isinstance(value, bool):
+        raise QueryError(f"{name} must be true or false")
+    return value
+
+
+# Function to validate a /similar request body and fill in the defaults of the app
+def parse_query(body:dict, store, metric_groups:dict) -> dict:
+    '''
+    - ref_geoids: required, non-empty list
+    - states: defaults to every state of the level
+    - pop_min: defaults to 5000
+    - weights: missing groups default to 0.5 (same as the app sliders); groups without metrics at this level are
+      ignored, unknown groups are rejected
+    - top_k: defaults to DEFAULT_TOP_K, capped at MAX_TOP_K
+    - use_index: only score the top_k (see src.neighbours.score_universe_indexed), defaults to False
+    - exact: with use_index, False answers from the universe's KD-tree (sub-linear, approximate); defaults to True
+    - radius_km / bbox ([min_lon, min_lat, max_lon, max_lat]) / exclude_adjacent: optional spatial constraints
+      around the references (see src.spatial_filter.SpatialFilter), returned as 'spatial'
+    use_index, exact and exclude_adjacent must be JSON booleans.
+    '''
+    if not isinstance(body, dict):
+        raise QueryError("Request body must be a JSON object")
+    ref_geoids = body.get('ref_geoids')
+    if not isinstance(ref_geoids, list) or not ref_geoids:
+        raise QueryError("ref_geoids must be a non-empty list")
+    states = body.get('states') or store.state_names.tolist()
+    if not isinstance(states, list):
+        raise QueryError("states must be a list")
+    weights = body.get('weights') or {}
+    if not isinstance(weights, dict):
+        raise QueryError("weights must be an object of metric group -> weight")
+    unknown = [group for group in weights if group not in METRIC_GROUPS]
+    if unknown:
+        raise QueryError(f"Unknown metric groups in weights: {unknown}. Options: {list(metric_groups)}")
+    use_index = _bool_param(body, 'use_index', False)
+    exact = _bool_param(body, 'exact', True)
+    exclude_adjacent = _bool_param(body, 'exclude_adjacent', False)
+    try:
+        query = {
+            'ref_geoids': [str(g) for g in ref_geoids],
+            'target_states': [str(s) for s in states],
+            'pop_min': float(body.get('pop_min', 5000)),
+            'weights': {group: float(weights.get(group, 0.5)) for group in metric_groups},
+            'top_k': int(body.get('top_k', DEFAULT_TOP_K)),
+            'use_index': use_index,
+            'exact': exact,
+        }
+        radius_km = body.get('radius_km')
+        bbox = body.get('bbox')
+        spatial = SpatialFilter(
+            anchor_geoids=tuple(query['ref_geoids']),
+            radius_km=None if radius_km is None else float(radius_km),
+            bbox=None if bbox is None else tuple(float(v) for v in bbox),
+            exclude_adjacent=exclude_adjacent,
+        )
+    except (TypeError, ValueError) as e:
+        raise QueryError(f"Invalid parameter: {e}")
+    if not 1 <= query['top_k'] <= MAX_TOP_K:
+        raise QueryError(f"top_k must be between 1 and {MAX_TOP_K}")
+    if spatial.radius_km is not None and spatial.radius_km <= 0:
+        raise QueryError("radius_km must be positive")
+    if spatial.bbox is not None and (len(spatial.bbox) != 4 or spatial.bbox[0] > spatial.bbox[2] or spatial.bbox[1] > spatial.bbox[3]):
+        raise QueryError("bbox must be [min_lon, min_lat, max_lon, max_lat]")
+    query['spatial'] = spatial if spatial.active else None
+    if sum(query['weights'].values()) <= 0:
+        raise QueryError("At least one weight must be positive")
+    return query
+
+
+# Helper to serialize a ranked frame
+def _json_body(meta:dict, frame:pd.DataFrame) -> bytes:
+    # to_json writes NaN as null, so the body stays valid JSON
+    records = frame.to_json(orient='records')
+    return (json.dumps(meta)[:-1] + ', "results": ' + records + '}').encode('utf-8')
+
+
+def _arrow_body(meta:dict, frame:pd.DataFrame) -> bytes:
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'similarity': json.dumps(meta).encode('utf-8')})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# ASGI application
+class SimilarityService:
+    '''
+    Loads one dataset level once per process (at ASGI lifespan startup, or on the first request)
+    and answers /similar queries from a thread pool, sharing one SimilarityCache across requests.
+    level and data_dir default to the SIMILARITY_LEVEL / SIMILARITY_DATA_DIR environment variables,
+    so `uvicorn src.service:app --workers N` can be configured without code.
+    '''
+    def __init__(self, level:str | None=None, data_dir:Path | str | None=None, max_workers:int=MAX_WORKERS):
+        self.level = level or os.environ.get('SIMILARITY_LEVEL', DEFAULT_DATASET)
+        self.data_dir = Path(data_dir or os.environ.get('SIMILARITY_DATA_DIR', DATA_DIR))
+        self.max_workers = max_workers
+        self.cache = None
+        self.pool = None
+        self.dataset_version = None
+        self.geometry_tiers = None
+        self._load_lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._load_lock:
+            if self.cache is None:
+                self._load()
+
+    # Helper to load from the event loop: the parquet / mmap reads run in a thread, so other requests
+    # (and the server's own tasks) are not blocked; concurrent callers wait on the same lock in their threads
+    async def load_async(self) -> None:
+        if self.cache is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
+
+    def _load(self) -> None:
+        start_time = time.time()
+        # Mapped from the shared sidecar, so server processes of one machine share the feature pages
+        store, rank_index = load_shared_dataset(self.level, self.data_dir)
+        self.dataset_version = file_version(DATASETS[self.level].path(self.data_dir))
+        source_path = DATASETS[self.level].path(self.data_dir)
+        # Centroid index built on the first spatial query only
+        self.cache = SimilarityCache(store, rank_index, self.dataset_version,
+                                     spatial_index=lambda: load_spatial_index(store, source_path, self.dataset_version))
+        self.metric_groups = metric_groups_for(store.metrics)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        print(f"Loaded {DATASETS[self.level].label}: {len(store):,} rows in {time.time() - start_time:.2f}s")
+
+    def get_geometry_tiers(self):
+        '''
+        Pre-simplified shapes for the geometry exports, loaded on the first such request
+        '''
+        with self._load_lock:
+            if self.geometry_tiers is None:
+                from src.visualizer import load_geometry_tiers
+                store = self.cache.store
+                self.geometry_tiers = load_geometry_tiers(DATASETS[self.level].path(self.data_dir), store.geoidfq,
+                                                          store.load_geometry, source_version=self.dataset_version)
+        return self.geometry_tiers
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    # Synchronous work of one /similar request (runs in the pool)
+    def similar(self, body:dict, fmt:str='json') -> tuple[bytes, str]:
+        query = parse_query(body, self.cache.store, self.metric_groups)
+        start_time = time.perf_counter()
+        res = self.cache.score(query['ref_geoids'], query['target_states'], query['pop_min'], query['weights'],
+                               query['top_k'], use_index=query['use_index'], exact=query['exact'],
+                               spatial=query['spatial'])
+        frame = res.top(query['top_k'])
+        meta = {
+            'level': self.level,
+            'dataset_version': self.dataset_version,
+            'n_candidates': len(res),
+            'references_outside': res.references_outside,
+            'notes': [OUTSIDE_UNIVERSE_NOTE] if res.references_outside else [],
+            'elapsed_ms': round((time.perf_counter() - start_time) * 1000, 2),
+        }
+        if fmt == 'arrow':
+            return _arrow_body(meta, frame), ARROW_MIME
+        return _json_body(meta, frame), 'application/json'
+
+    # Synchronous part of one /export request (runs in the pool): validates and scores;
+    # the returned chunks are only encoded while the response is sent
+    def export(self, body:dict) -> tuple:
+        query = parse_query(body, self.cache.store, self.metric_groups)
+        fmt = body.get('format', 'csv')
+        if fmt not in EXPORT_FORMATS:
+            raise QueryError(f"Unknown format: {fmt}. Options: {list(EXPORT_FORMATS)}")
+        columns = body.get('columns')
+        if columns is not None and (not isinstance(columns, list) or not columns):
+            raise QueryError("columns must be a non-empty list")
+        top_n = body.get('top_n')
+        if top_n is not None and (not isinstance(top_n, int) or top_n < 1):
+            raise QueryError("top_n must be a positive integer")
+        res = self.cache.score(query['ref_geoids'], query['target_states'], query['pop_min'], query['weights'],
+                               spatial=query['spatial'])
+        if columns is not None and any(c not in res.columns() for c in columns):
+            raise QueryError(f"Unknown columns: {[c for c in columns if c not in res.columns()]}. Options: {res.columns()}")
+        tiers = self.get_geometry_tiers() if EXPORT_FORMATS[fmt].geometry else None
+        return iter_export(res, fmt, columns, top_n, geometry_tiers=tiers), EXPORT_FORMATS[fmt]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        path, method = scope['path'].rstrip('/') or '/', scope['method']
+        stream = None
+        try:
+            # Without a lifespan startup, the first requests load the level
+            await self.load_async()
+            if path == '/health' and method == 'GET':
+                status, body, content_type = 200, self._json({
+                    'status': 'ok', 'level': self.level, 'rows': len(self.cache.store),
+                    'dataset_version': self.dataset_version,
+                }), 'application/json'
+            elif path == '/stats' and method == 'GET':
+                status, body, content_type = 200, self._json(self.cache.stats()), 'application/json'
+            elif path == '/similar' and method == 'POST':
+                raw = await self._read_body(receive)
+                try:
+                    payload = json.loads(raw or b'{}')
+                except json.JSONDecodeError as e:
+                    raise QueryError(f"Invalid JSON: {e}")
+                loop = asyncio.get_running_loop()
+                body, content_type = await loop.run_in_executor(self.pool, self.similar, payload, self._format(scope))
+                status = 200
+            elif path == '/export' and method == 'POST':
+                raw = await self._read_body(receive)
+                try:
+                    payload = json.loads(raw or b'{}')
+                except json.JSONDecodeError as e:
+                    raise QueryError(f"Invalid JSON: {e}")
+                loop = asyncio.get_running_loop()
+                stream, fmt = await loop.run_in_executor(self.pool, self.export, payload)
+            else:
+                status, body, content_type = 404, self._json({'error': f"Not found: {method} {path}"}), 'application/json'
+        except QueryError as e:
+            status, body, content_type = 400, self._json({'error': str(e)}), 'application/json'
+        except Exception as e:
+            status, body, content_type = 500, self._json({'error': f"{type(e).__name__}: {e}"}), 'application/json'
+
+        if stream is not None:
+            await self._send_stream(send, stream, fmt)
+            return
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.load_async()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Helper to send an export as a chunked response; every chunk is encoded in the pool when it is due
+    async def _send_stream(self, send, stream, fmt) -> None:
+        loop = asyncio.get_running_loop()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', fmt.mime.encode()),
+                                (b'content-disposition', f'attachment; filename="similar.{fmt.extension}"'.encode())]})
+        while True:
+            chunk = await loop.run_in_executor(self.pool, next, stream, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def _format(scope) -> str:
+        params = parse_qs(scope.get('query_string', b'').decode())
+        if params.get('format', [''])[0] == 'arrow':
+            return 'arrow'
+        accept = dict(scope.get('headers', [])).get(b'accept', b'').decode()
+        return 'arrow' if ARROW_MIME in accept else 'json'
+
+    @staticmethod
+    def _json(payload) -> bytes:
+        return json.dumps(payload).encode('utf-8')
+
+
+# Module-level app for ASGI servers; nothing is loaded until startup
+app = SimilarityService()
+
+
+# Function to measure request latency of a running service with a local client
+def load_test(url:str, payloads:list[dict], n_requests:int=200, concurrency:int=8, fmt:str='json',
+              timeout:float=60) -> dict:
+    '''
+    Sends n_requests POST /similar requests (cycling through payloads) from `concurrency` threads.
+    Returns latency percentiles in ms, throughput and the number of failed requests.
+    '''
+    endpoint = url.rstrip('/') + '/similar' + ('?format=arrow' if fmt == 'arrow' else '')
+
+    def send_one(i:int) -> float | None:
+        data = json.dumps(payloads[i % len(payloads)]).encode('utf-8')
+        request = urllib.request.Request(endpoint, data=data, headers={'Content-Type': 'application/json'})
+        start_time = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+        except Exception:
+            return None
+        return (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(send_one, range(n_requests)))
+    elapsed = time.perf_counter() - start_time
+    ok = np.array([ms for ms in latencies if ms is not None])
+    stats = {
+        'requests': n_requests,
+        'errors': n_requests - ok.size,
+        'concurrency': concurrency,
+        'requests_per_s': n_requests / max(elapsed, 1e-9),
+    }
+    if ok.size:
+        stats.update({f'p{q}_ms': float(np.percentile(ok, q)) for q in (50, 90, 99)})
+        stats['mean_ms'] = float(ok.mean())
+    return stats
+
+
+def main(argv:list[str] | None=None):
+    parser = argparse.ArgumentParser(description="Headless similarity service.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help="Run the service with uvicorn")
+    serve.add_argument('--level', default=DEFAULT_DATASET, choices=list(DATASETS))
+    serve.add_argument('--data-dir', default=str(DATA_DIR))
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--workers', type=int, default=1, help="Server processes")
+
+    bench = commands.add_parser('load-test', help="Measure p50/p99 latency of a running service")
+    bench.add_argument('jobs', help="Job file with the queries to send (.json, .jsonl or .csv, see src.batch)")
+    bench.add_argument('--url', default='http://127.0.0.1:8000')
+    bench.add_argument('--requests', type=int, default=200)
+    bench.add_argument('--concurrency', type=int, default=8)
+    bench.add_argument('--top-k', type=int, default=DEFAULT_TOP_K)
+    bench.add_argument('--format', default='json', choices=['json', 'arrow'])
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        import uvicorn
+        # Worker processes import this module and read their configuration from the environment
+        os.environ['SIMILARITY_LEVEL'] = args.level
+        os.environ['SIMILARITY_DATA_DIR'] = args.data_dir
+        uvicorn.run('src.service:app', host=args.host, port=args.port, workers=args.workers, lifespan='on')
+    else:
+        from src.batch import load_jobs
+        payloads = [
+            {'ref_geoids': job.ref_geoids, 'states': job.states, 'pop_min': job.pop_min,
+             'weights': job.weights, 'top_k': args.top_k}
+            for job in load_jobs(args.jobs)
+        ]
+        stats = load_test(args.url, payloads, args.requests, args.concurrency, args.format)
+        print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    main()
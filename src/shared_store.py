@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from src.analytics import RankIndex
+from src.data_loader import DATA_DIR, DATASETS, FeatureStore, load_dataset
+from src.utils import source_signature
+
+
+# Memory-mapped copy of a level's FeatureStore and RankIndex, shared by every process on the machine
+# The arrays are written once, uncompressed, to a sidecar directory next to the source parquet:
+#   - features / order / sorted_values / state and stusps codes / geoidfq as .npy files opened with mmap_mode='r'
+#   - the attrs frame as an Arrow IPC file opened with pa.memory_map
+# Every worker (streamlit server process, uvicorn worker) maps the same files, so the pages live once in the OS
+# page cache and the resident memory of an added worker stays roughly flat. The arrays are read-only views.
+#
+# The sidecar directory holds one subdirectory per build, named after the layout version and the source signature,
+# and a CURRENT pointer file naming the live one. A rebuild writes a new subdirectory and then atomically replaces
+# CURRENT, so a live store is never modified or deleted in place (processes keep mapping the build they opened).
+# Builds of other data versions are removed afterwards on a best-effort basis (files still mapped on Windows stay
+# until a later rebuild).
+
+# Bump when the sidecar layout changes so old directories are rebuilt
+SHARED_STORE_VERSION = 3  # 3: rank index on the float64 source values
+# Pointer file naming the live build inside the sidecar directory
+CURRENT_FILE = 'CURRENT'
+# Unfinished builds (dot-prefixed) of crashed writers older than this are removed by the next rebuild
+STALE_BUILD_SECONDS = 3600
+ARRAY_FIELDS = ['features', 'geoidfq', 'state_codes', 'stusps_codes', 'order', 'sorted_values', 'geoid_sorted', 'geoid_sorted_rows']
+
+
+# Helper for the default sidecar location next to the source parquet
+def shared_store_dir(source_path:Path | str) -> Path:
+    source_path = Path(source_path)
+    return source_path.with_name(f"{source_path.stem}_mmap")
+
+
+# Helper for the name prefix of the builds of one data version (layout version + source signature)
+def _build_prefix(signature:dict) -> str:
+    return f"v{SHARED_STORE_VERSION}-{signature['size']}-{signature['mtime_ns']}-"
+
+
+# Helper to point CURRENT at a build (write a new file and rename it over the old pointer)
+def _switch_current(out_dir:Path, build_name:str, retries:int=20) -> None:
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{CURRENT_FILE}.', dir=out_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(build_name)
+    for attempt in range(retries):
+        try:
+            os.replace(tmp_path, out_dir / CURRENT_FILE)
+            return
+        except PermissionError:
+            # Windows refuses the rename while another process is reading CURRENT
+            if attempt == retries - 1:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+            time.sleep(0.05)
+
+
+# Helper to remove the builds of other data versions (best effort; the live build and its version are kept)
+def _remove_stale_builds(out_dir:Path, build_name:str, signature:dict) -> None:
+    keep = _build_prefix(signature)
+    for entry in out_dir.iterdir():
+        if entry.name == CURRENT_FILE or entry.name.startswith(keep):
+            continue
+        # Dot-prefixed entries are builds (or pointers) still being written by another process
+        if entry.name.startswith('.') and time.time() - entry.stat().st_mtime < STALE_BUILD_SECONDS:
+            continue
+        try:
+            if entry.is_dir():
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink()
+        except OSError:
+            pass
+
+
+# Function to write a FeatureStore and its RankIndex as memory-mappable files
+def write_shared_store(store:FeatureStore, rank_index:RankIndex, out_dir:Path | str, signature:dict) -> Path:
+    '''
+    Writes a new build into out_dir (under a temporary name, renamed once complete) and then points CURRENT at it,
+    so concurrent workers never map a partial store and a store other processes have mapped is never touched.
+    Returns the directory of the new build.
+    '''
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix='.' + _build_prefix(signature), dir=out_dir))
+    build_dir = out_dir / tmp_dir.name[1:]
+    try:
+        # Fixed-width unicode, so the ids can be mapped as a plain numpy array
+        geoidfq = np.asarray(store.geoidfq, dtype=str)
+        geoid_order = np.argsort(geoidfq, kind='stable')
+        arrays = {
+            'features': store.features,
+            'geoidfq': geoidfq,
+            'state_codes': store.state_codes,
+            'stusps_codes': store.stusps_codes,
+            'order': rank_index.order,
+            'sorted_values': rank_index.sorted_values,
+            # Sorted ids for rows_for_geoids, so no process builds a geoidfq -> row dict
+            'geoid_sorted': geoidfq[geoid_order],
+            'geoid_sorted_rows': geoid_order,
+        }
+        for name, values in arrays.items():
+            np.save(tmp_dir / f'{name}.npy', np.ascontiguousarray(values))
+
+        # One record batch: columns split over several batches would be concatenated (copied) on every open
+        attrs = pa.Table.from_pandas(store.attrs, preserve_index=False).combine_chunks()
+        with ipc.new_file(tmp_dir / 'attrs.arrow', attrs.schema) as writer:
+            writer.write_table(attrs)
+
+        manifest = {
+            'version': SHARED_STORE_VERSION,
+            'source': signature,
+            'metrics': store.metrics,
+            'state_names': np.asarray(store.state_names).tolist(),
+            'stusps_values': np.asarray(store.stusps_values).tolist(),
+        }
+        # Manifest last: a directory without it is never opened
+        (tmp_dir / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+        # The name is unique (mkdtemp), so the rename never replaces another build
+        os.replace(tmp_dir, build_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    _switch_current(out_dir, build_dir.name)
+    _remove_stale_builds(out_dir, build_dir.name, signature)
+    return build_dir
+
+
+# Function to map the live build of a shared store; returns (store, rank_index) or None when it is missing or stale
+def open_shared_store(store_dir:Path | str, signature:dict | None=None,
+                      source_path:Path | None=None) -> tuple[FeatureStore, RankIndex] | None:
+    store_dir = Path(store_dir)
+    try:
+        build_dir = store_dir / (store_dir / CURRENT_FILE).read_text().strip()
+        manifest = json.loads((build_dir / 'manifest.json').read_text())
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != SHARED_STORE_VERSION:
+        return None
+    if signature is not None and manifest.get('source') != signature:
+        return None
+
+    try:
+        # np.asarray drops the memmap subclass; the data stays mapped (read-only, no copy)
+        arrays = {name: np.asarray(np.load(build_dir / f'{name}.npy', mmap_mode='r')) for name in ARRAY_FIELDS}
+        # split_blocks keeps one array per column instead of consolidating the floats into a new block, so float
+        # columns without nulls stay views of the mapped file. Float columns with nulls are copied (NaN filled).
+        # String columns only stay in the mapped buffers with pandas >= 3 (Arrow-backed 'str' dtype); older pandas
+        # converts them to Python objects in every process
+        attrs = ipc.open_file(pa.memory_map(str(build_dir / 'attrs.arrow'))).read_all().to_pandas(split_blocks=True)
+    except (OSError, ValueError):
+        # A superseded build removed while it was being opened
+        return None
+
+    metrics = manifest['metrics']
+    store = FeatureStore(
+        features=arrays['features'],
+        metrics=metrics,
+        geoidfq=arrays['geoidfq'],
+        state_codes=arrays['state_codes'],
+        state_names=np.asarray(manifest['state_names'], dtype=object),
+        stusps_codes=arrays['stusps_codes'],
+        stusps_values=np.asarray(manifest['stusps_values'], dtype=object),
+        attrs=attrs,
+        source_path=Path(source_path) if source_path is not None else None,
+        geoid_sorted=arrays['geoid_sorted'],
+        geoid_sorted_rows=arrays['geoid_sorted_rows'],
+    )
+    return store, RankIndex.from_arrays(arrays['order'], arrays['sorted_values'], metrics)
+
+
+# Function to load one geography level through its shared store, building the store on first use
+def load_shared_dataset(key:str, data_dir:Path=DATA_DIR, store_dir:Path | str | None=None) -> tuple[FeatureStore, RankIndex]:
+    '''
+    Drop-in for load_dataset + RankIndex for multi-process servers.
+    The store is rebuilt when the source parquet changes (size or modification time) or the layout version changes.
+    '''
+    if key not in DATASETS:
+        raise ValueError(f"Unknown dataset: {key}. Options: {list(DATASETS)}")
+    source_path = DATASETS[key].path(data_dir)
+    if not source_path.exists():
+        raise FileNotFoundError(f"Feature table for {DATASETS[key].label} not found: {source_path}")
+    store_dir = Path(store_dir or shared_store_dir(source_path))
+    signature = source_signature(source_path)
+
+    shared = open_shared_store(store_dir, signature, source_path)
+    if shared is not None:
+        return shared
+
+    start_time = time.time()
+    store = load_dataset(key, data_dir)
+    rank_index = RankIndex(store.rank_values(), store.metrics)
+    try:
+        build_dir = write_shared_store(store, rank_index, store_dir, signature)
+    except OSError as e:
+        print(f"Note: shared store for {DATASETS[key].label} not written ({e}); using an in-memory copy")
+        return store, rank_index
+    print(f"Shared store for {DATASETS[key].label} written to {build_dir} in {time.time() - start_time:.2f}s")
+    # Reopen so this process also uses the mapped pages instead of its private copy
+    shared = open_shared_store(store_dir, signature, source_path)
+    if shared is None:
+        # Another worker switched CURRENT to a build of other data in the meantime
+        print(f"Note: shared store for {DATASETS[key].label} could not be reopened; using an in-memory copy")
+        return store, rank_index
+    return shared
@@ -0,0 +1,162 @@
+from __future__ import annotations
+import json
+from functools import cached_property
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+import numpy as np
+import pandas as pd
+
+from src.spatial_filter import SpatialFilter
+from src.tracing import trace_stage
+from src.utils import file_version
+
+# geopandas / shapely / pyproj / pyarrow.parquet are imported by the functions that build the trees, project the
+# centroids or read the sidecar, so importing this module does not load the geometry stack
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import shapely
+
+
+# Spatial constraints for the search universe ("within 150 km of the references", "inside this box",
+# "not adjacent to the references"), answered as bulk STRtree queries instead of per-row distance scans.
+# Centroids are computed once per data version and kept in a sidecar parquet next to the source file;
+# polygons are only read (and indexed) when an adjacency constraint is first used.
+# The constraint of a search (SpatialFilter) lives in the light src.spatial_filter module and is re-exported here.
+
+# Projected CRS for distances: CONUS Albers (meters); distances stay within ~1-2% over the lower 48
+SPATIAL_CRS = "EPSG:5070"
+# Bump when the sidecar layout changes so old files are rebuilt
+SPATIAL_CACHE_VERSION = 2
+
+
+# Centroid points (projected) and, on demand, polygons of one level, row-aligned with its FeatureStore
+class SpatialIndex:
+    '''
+    - lon / lat: centroid in EPSG:4326 (bounding-box queries)
+    - x / y: centroid in SPATIAL_CRS (radius queries)
+    - geometry: polygons as a GeoSeries or a callable returning them (e.g. FeatureStore.load_geometry);
+      only needed for adjacency and loaded on first use
+    '''
+    def __init__(self, lon:np.ndarray, lat:np.ndarray, x:np.ndarray, y:np.ndarray,
+                 geometry:gpd.GeoSeries | Callable[[], gpd.GeoSeries] | None=None):
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self._geometry = geometry
+
+    def __len__(self) -> int:
+        return self.x.size
+
+    @cached_property
+    def point_tree(self) -> shapely.STRtree:
+        import shapely
+        return shapely.STRtree(shapely.points(self.x, self.y))
+
+    @cached_property
+    def polygons(self) -> np.ndarray:
+        if self._geometry is None:
+            raise ValueError("SpatialIndex has no geometry; adjacency constraints need the polygons")
+        geometry = self._geometry() if callable(self._geometry) else self._geometry
+        return np.asarray(geometry.values, dtype=object)
+
+    @cached_property
+    def polygon_tree(self) -> shapely.STRtree:
+        import shapely
+        return shapely.STRtree(self.polygons)
+
+    def within_km(self, rows:np.ndarray, radius_km:float) -> np.ndarray:
+        '''
+        Rows whose centroid is within radius_km of the centroid of any of rows (one bulk dwithin query)
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        rows = np.asarray(rows, dtype=np.intp)
+        if rows.size == 0:
+            return mask
+        import shapely
+        with trace_stage('spatial.radius', rows=len(self)):
+            anchors = shapely.points(self.x[rows], self.y[rows])
+            _, hits = self.point_tree.query(anchors, predicate='dwithin', distance=radius_km * 1000)
+            mask[hits] = True
+        return mask
+
+    def in_bbox(self, bbox:tuple[float, float, float, float]) -> np.ndarray:
+        '''
+        Rows whose centroid is inside (min_lon, min_lat, max_lon, max_lat); four vectorized comparisons
+        on the centroid columns, which is as fast as a tree query for a single box
+        '''
+        min_lon, min_lat, max_lon, max_lat = bbox
+        with trace_stage('spatial.bbox', rows=len(self)):
+            return (self.lon >= min_lon) & (self.lon <= max_lon) & (self.lat >= min_lat) & (self.lat <= max_lat)
+
+    def adjacent(self, rows:np.ndarray) -> np.ndarray:
+        '''
+        Rows whose polygon touches or overlaps the polygon of any of rows (rows themselves excluded)
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        rows = np.asarray(rows, dtype=np.intp)
+        if rows.size == 0:
+            return mask
+        with trace_stage('spatial.adjacent', rows=len(self)):
+            _, hits = self.polygon_tree.query(self.polygons[rows], predicate='intersects')
+            mask[hits] = True
+            mask[rows] = False
+        return mask
+
+
+# Function to compute the centroid columns of a set of polygons
+def centroid_frame(geoidfq:np.ndarray, geometry:gpd.GeoSeries) -> pd.DataFrame:
+    '''
+    Centroids are taken in EPSG:4326 (small polygons, so the planar error is negligible)
+    and only the points are projected to SPATIAL_CRS, which is much cheaper than projecting every polygon.
+    '''
+    import shapely
+    from pyproj import Transformer
+    if geometry.crs is not None and not geometry.crs.equals("EPSG:4326"):
+        geometry = geometry.to_crs("EPSG:4326")
+    centroids = shapely.centroid(np.asarray(geometry.values, dtype=object))
+    lon, lat = shapely.get_x(centroids), shapely.get_y(centroids)
+    x, y = Transformer.from_crs("EPSG:4326", SPATIAL_CRS, always_xy=True).transform(lon, lat)
+    return pd.DataFrame({'geoidfq': np.asarray(geoidfq), 'lon': lon, 'lat': lat, 'x': x, 'y': y})
+
+
+# Helper for the default sidecar location next to the source parquet
+def spatial_cache_path(source_path:Path | str) -> Path:
+    source_path = Path(source_path)
+    return source_path.with_name(f"{source_path.stem}_spatial.parquet")
+
+
+# Function to get the SpatialIndex of a level, building the centroid sidecar if needed
+def load_spatial_index(store, source_path:Path | str | None=None, source_version:str | None=None,
+                       cache_path:Path | str | None=None) -> SpatialIndex:
+    '''
+    The sidecar (geoidfq, lon, lat, x, y) is keyed by the source file version (utils.file_version), the CRS
+    and the layout version, and its rows are aligned with store (same geoidfq order). The polygons are only read
+    when the sidecar is rebuilt or an adjacency constraint is used. Pass source_version if the caller already has it.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    source_path = source_path or store.source_path
+    if source_path is None:
+        raise ValueError("source_path is needed to locate the spatial cache")
+    cache_path = Path(cache_path or spatial_cache_path(source_path))
+    source_version = source_version or file_version(source_path)
+    manifest = {'version': SPATIAL_CACHE_VERSION, 'source_version': source_version, 'crs': SPATIAL_CRS}
+
+    centroids = None
+    if cache_path.exists():
+        schema_meta = pq.read_schema(cache_path).metadata or {}
+        if json.loads(schema_meta.get(b'spatial', b'{}')) == manifest:
+            cached = pd.read_parquet(cache_path)
+            # Written in store order; any other order or set of places makes it stale
+            if np.array_equal(cached['geoidfq'].to_numpy(dtype=str), np.asarray(store.geoidfq, dtype=str)):
+                centroids = cached
+    if centroids is None:
+        centroids = centroid_frame(store.geoidfq, store.load_geometry())
+        table = pa.Table.from_pandas(centroids, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'spatial': json.dumps(manifest).encode('utf-8')})
+        pq.write_table(table, cache_path)
+        print(f'Spatial centroids saved to: {cache_path}!')
+
+    return SpatialIndex(centroids['lon'].to_numpy(), centroids['lat'].to_numpy(),
+                        centroids['x'].to_numpy(), centroids['y'].to_numpy(), geometry=store.load_geometry)
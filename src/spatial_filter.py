@@ -0,0 +1,49 @@
+from dataclasses import asdict, dataclass
+import numpy as np
+
+
+# Geographic constraint of one search, kept apart from src.spatial so the app and the service can build one
+# (and key caches with it) on every request without importing the geometry stack; only SpatialFilter.mask
+# needs a src.spatial.SpatialIndex, which is loaded on the first search that uses a constraint.
+
+# Geographic constraint of one search
+@dataclass(frozen=True)
+class SpatialFilter:
+    '''
+    All set constraints apply together (and on top of the state / population filters):
+        - radius_km: keep places whose centroid is within radius_km of the centroid of any anchor
+        - bbox: (min_lon, min_lat, max_lon, max_lat); keep places whose centroid is inside the box
+        - exclude_adjacent: drop places whose polygon touches or overlaps an anchor polygon (anchors are kept)
+    anchor_geoids are usually the references of the search.
+    '''
+    anchor_geoids: tuple[str, ...] = ()
+    radius_km: float | None = None
+    bbox: tuple[float, float, float, float] | None = None
+    exclude_adjacent: bool = False
+
+    @property
+    def active(self) -> bool:
+        return self.radius_km is not None or self.bbox is not None or self.exclude_adjacent
+
+    def key(self) -> dict:
+        '''
+        Canonical form for cache keys (anchor order does not matter; the box corners are named
+        so that canonicalizing the key does not reorder them)
+        '''
+        bbox = None if self.bbox is None else dict(zip(['min_lon', 'min_lat', 'max_lon', 'max_lat'], self.bbox))
+        return {**asdict(self), 'anchor_geoids': sorted(self.anchor_geoids), 'bbox': bbox}
+
+    def mask(self, index, store) -> np.ndarray:
+        '''
+        Boolean mask over the rows of store (index is the level's src.spatial.SpatialIndex);
+        anchors that are not in store are ignored
+        '''
+        mask = np.ones(len(store), dtype=bool)
+        anchors = store.rows_for_geoids(list(self.anchor_geoids))
+        if self.radius_km is not None:
+            mask &= index.within_km(anchors, self.radius_km)
+        if self.bbox is not None:
+            mask &= index.in_bbox(self.bbox)
+        if self.exclude_adjacent:
+            mask &= ~index.adjacent(anchors)
+        return mask
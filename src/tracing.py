@@ -0,0 +1,207 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+import pandas as pd
+
+
+# Per-run stage instrumentation for the similarity engine and the map render
+# Code marks its stages with trace_stage(); nothing is recorded unless a trace is active:
+#     with tracing('search') as trace:
+#         res = similarity_cache.score(...)
+#     trace.to_frame()            # one row per stage: seconds, rows, allocated / peak bytes
+#     write_trace(trace)          # one JSON line in the structured log
+# Without an active trace, trace_stage() is one context variable lookup and returns a shared no-op span.
+
+# Structured log (JSON lines) written by write_trace when no path is given; unset means no log
+TRACE_LOG_ENV = 'SIMILARITY_TRACE_LOG'
+
+
+# One timed stage of a trace
+@dataclass
+class Span:
+    '''
+    - name: stage name (e.g. 'universe.local_percentiles')
+    - depth: nesting level (0 for top-level stages)
+    - start: seconds from the start of the trace
+    - seconds: wall time
+    - rows: rows processed by the stage, when the stage reports it
+    - alloc_bytes / peak_bytes: net and peak traced allocation (only for traces with memory=True)
+    - info: free-form details (e.g. cache hits)
+    '''
+    name: str
+    depth: int
+    start: float
+    seconds: float = 0.0
+    rows: int | None = None
+    alloc_bytes: int | None = None
+    peak_bytes: int | None = None
+    info: dict = field(default_factory=dict)
+
+
+# Returned by trace_stage when tracing is disabled; accepts and ignores everything
+class _NoopSpan:
+    __slots__ = ()
+    rows = None
+
+    @property
+    def info(self) -> dict:
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# Collected spans of one run
+@dataclass
+class Trace:
+    name: str
+    memory: bool = False
+    started: str = field(default_factory=lambda: datetime.now(timezone.utc).isoformat(timespec='milliseconds'))
+    spans: list[Span] = field(default_factory=list)
+    seconds: float = 0.0
+    info: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self._t0 = time.perf_counter()
+        # Open spans with the highest traced memory seen while they were open
+        self._open = []
+
+    def to_records(self) -> list[dict]:
+        return [
+            {k: v for k, v in span.__dict__.items() if v is not None and v != {}}
+            for span in self.spans
+        ]
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'started': self.started, 'seconds': self.seconds,
+                'memory': self.memory, 'info': self.info, 'spans': self.to_records()}
+
+    def to_frame(self) -> pd.DataFrame:
+        '''
+        One row per span in start order; names are indented by depth for display
+        '''
+        frame = pd.DataFrame(
+            [{**span.__dict__, 'stage': '  ' * span.depth + span.name} for span in self.spans],
+            columns=['stage', 'name', 'depth', 'start', 'seconds', 'rows', 'alloc_bytes', 'peak_bytes', 'info'],
+        )
+        frame['share'] = frame['seconds'] / self.seconds if self.seconds > 0 else 0.0
+        return frame
+
+    def summary(self) -> dict[str, float]:
+        '''
+        Total seconds per stage name (stages entered several times are summed)
+        '''
+        totals = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.seconds
+        return totals
+
+    # Helper to fold the traced peak since the last call into every open span
+    def _update_peaks(self) -> int:
+        current, peak = tracemalloc.get_traced_memory()
+        for entry in self._open:
+            entry[1] = max(entry[1], peak)
+        tracemalloc.reset_peak()
+        return current
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar('similarity_trace', default=None)
+
+
+# Function to get the active trace of this context (None when tracing is off)
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+# Context manager to time one stage of the active trace
+@contextmanager
+def _record_stage(trace:Trace, name:str, rows:int | None, info:dict):
+    span = Span(name, depth=len(trace._open), start=time.perf_counter() - trace._t0, rows=rows, info=info)
+    trace.spans.append(span)
+    entry = [span, 0]
+    if trace.memory:
+        start_bytes = trace._update_peaks()
+        entry[1] = start_bytes
+    trace._open.append(entry)
+    start_time = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.seconds = time.perf_counter() - start_time
+        if trace.memory:
+            end_bytes = trace._update_peaks()
+            span.alloc_bytes = end_bytes - start_bytes
+            span.peak_bytes = entry[1] - start_bytes
+        trace._open.remove(entry)
+
+
+def trace_stage(name:str, rows:int | None=None, **info):
+    '''
+    Times the enclosed block as a stage of the active trace. The span is yielded so the block can fill in
+    rows / info once they are known (span.rows = n). Without an active trace this is a no-op.
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _record_stage(trace, name, rows, info)
+
+
+# Context manager to collect a trace of the enclosed run
+@contextmanager
+def tracing(name:str, memory:bool=False, enabled:bool=True, **info):
+    '''
+    memory=True also records allocated / peak bytes per stage through tracemalloc (noticeably slower,
+    so it is meant for debugging sessions and benchmarks). enabled=False yields None and records nothing,
+    so call sites can keep one code path for a debug toggle.
+    '''
+    if not enabled:
+        yield None
+        return
+    trace = Trace(name, memory=memory, info=info)
+    started_tracemalloc = memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.seconds = time.perf_counter() - trace._t0
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+
+# Function to append a trace to the structured log (JSON lines)
+def write_trace(trace:Trace | None, path:Path | str | None=None) -> Path | None:
+    '''
+    path defaults to the SIMILARITY_TRACE_LOG environment variable; nothing is written when neither is set
+    '''
+    path = path or os.environ.get(TRACE_LOG_ENV)
+    if trace is None or not path:
+        return None
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(trace.to_dict(), default=str) + '\n')
+    return path
+
+
+# Function to read a structured log back (e.g. in the benchmark harness or a notebook)
+def read_traces(path:Path | str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
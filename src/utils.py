@@ -1,5 +1,7 @@
 # Function to find project root
 from pathlib import Path
+import hashlib
+import os
 
 # Function to find project root
 def find_project_root(start:Path | None=None) -> Path:
@@ -8,4 +10,25 @@ def find_project_root(start:Path | None=None) -> Path:
         # print(p)
         if (p / 'pyproject.toml').exists() or (p / '.git').exists() or (p / 'data').exists():
             return p
-    raise FileNotFoundError('Could not find root directory')
\ No newline at end of file
+    raise FileNotFoundError('Could not find root directory')
+
+# Helper for a cheap identity of a source file: size and modification time, from one stat (no read of the file)
+def source_signature(path:Path | str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# Helper for the same identity as a string (keys the sidecar caches and the result caches of a source file)
+def file_version(path:Path | str) -> str:
+    signature = source_signature(path)
+    return f"{signature['size']}-{signature['mtime_ns']}"
+
+# Function to hash a file's content (used by the feature build to detect changed input tables)
+def file_hash(path:Path | str, chunk_size:int=1 << 20) -> str:
+    '''
+    Returns the sha256 hex digest of the file, read in chunks so large parquet files are not loaded in memory
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
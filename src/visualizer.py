@@ -0,0 +1,265 @@
+import json
+import time
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import folium
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.tracing import trace_stage
+from src.utils import file_version
+
+
+# Simplification tolerances (in degrees, EPSG:4326) for each geometry tier
+# 0.01 is the tolerance the map has always used at the default zoom
+GEOMETRY_TIERS = {
+    "coarse": 0.05,
+    "medium": 0.01,
+    "fine": 0.002,
+}
+# Bump when the cache layout changes so old sidecar files are rebuilt
+GEOMETRY_CACHE_VERSION = 2
+
+
+# Helper to pick a geometry tier for a folium/leaflet zoom level
+def zoom_to_tier(zoom:int) -> str:
+    if zoom <= 4:
+        return "coarse"
+    if zoom <= 8:
+        return "medium"
+    return "fine"
+
+
+# Pre-simplified polygons looked up by geoidfq
+class GeometryTiers:
+    '''
+    Holds every place polygon simplified once per tier (see GEOMETRY_TIERS).
+    Map code looks shapes up by geoidfq instead of calling simplify() on every render.
+    '''
+    def __init__(self, geoidfq:np.ndarray, tiers:dict[str, np.ndarray], crs="EPSG:4326"):
+        self.index = pd.Index(geoidfq)
+        self.tiers = tiers
+        self.crs = crs
+
+    def get(self, geoids, tier:str="medium") -> gpd.GeoSeries:
+        '''
+        Returns a GeoSeries (indexed by geoidfq) with the shapes of the requested tier.
+        Unknown geoids get an empty (None) geometry.
+        '''
+        if tier not in self.tiers:
+            raise ValueError(f"Unknown geometry tier: {tier}. Options: {list(self.tiers)}")
+        geoids = list(geoids)
+        pos = self.index.get_indexer(geoids)
+        shapes = self.tiers[tier][np.where(pos >= 0, pos, 0)]
+        shapes = np.where(pos >= 0, shapes, None)
+        return gpd.GeoSeries(shapes, index=pd.Index(geoids, name='geoidfq'), crs=self.crs)
+
+    def for_zoom(self, geoids, zoom:int) -> gpd.GeoSeries:
+        return self.get(geoids, zoom_to_tier(zoom))
+
+
+# Function to simplify every polygon once per tier
+def build_geometry_tiers(geoidfq:np.ndarray, geometry:gpd.GeoSeries, tolerances:dict[str, float]=GEOMETRY_TIERS) -> GeometryTiers:
+    geoms = np.asarray(geometry.values, dtype=object)
+    tiers = {}
+    for tier, tolerance in tolerances.items():
+        with trace_stage('map.simplify', rows=geoms.size, tier=tier):
+            tiers[tier] = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    return GeometryTiers(np.asarray(geoidfq), tiers, geometry.crs)
+
+
+# Helper for the default sidecar location next to the source parquet
+def geometry_cache_path(source_path:Path | str) -> Path:
+    source_path = Path(source_path)
+    return source_path.with_name(f"{source_path.stem}_geometry_tiers.parquet")
+
+
+# Function to write the tiers as a sidecar parquet (one WKB column per tier)
+def save_geometry_tiers(tiers:GeometryTiers, cache_path:Path | str, source_version:str, tolerances:dict[str, float]=GEOMETRY_TIERS) -> None:
+    columns = {'geoidfq': pa.array(tiers.index.astype(str).tolist())}
+    for tier, shapes in tiers.tiers.items():
+        columns[f'geometry_{tier}'] = pa.array(shapely.to_wkb(shapes).tolist(), type=pa.binary())
+    table = pa.table(columns)
+    meta = {
+        'source_version': source_version,
+        'tolerances': tolerances,
+        'version': GEOMETRY_CACHE_VERSION,
+        'crs': str(tiers.crs) if tiers.crs is not None else None,
+    }
+    table = table.replace_schema_metadata({b'geometry_tiers': json.dumps(meta).encode('utf-8')})
+    pq.write_table(table, cache_path)
+
+
+# Function to read the sidecar back; returns None when it is missing or stale
+def read_geometry_tiers(cache_path:Path | str, source_version:str, tolerances:dict[str, float]=GEOMETRY_TIERS) -> GeometryTiers | None:
+    if not Path(cache_path).exists():
+        return None
+    schema_meta = pq.read_schema(cache_path).metadata or {}
+    if b'geometry_tiers' not in schema_meta:
+        return None
+    meta = json.loads(schema_meta[b'geometry_tiers'])
+    if (meta.get('source_version') != source_version or meta.get('tolerances') != tolerances
+            or meta.get('version') != GEOMETRY_CACHE_VERSION):
+        return None
+    table = pq.read_table(cache_path)
+    tiers = {
+        tier: shapely.from_wkb(np.asarray(table.column(f'geometry_{tier}').to_pylist(), dtype=object))
+        for tier in tolerances
+    }
+    return GeometryTiers(table.column('geoidfq').to_numpy(zero_copy_only=False), tiers, meta.get('crs'))
+
+
+# Function to get the geometry tiers for a source parquet, building the sidecar cache if needed
+def load_geometry_tiers(source_path:Path | str, geoidfq:np.ndarray, geometry:gpd.GeoSeries | Callable[[], gpd.GeoSeries],
+                        cache_path:Path | str | None=None, tolerances:dict[str, float]=GEOMETRY_TIERS,
+                        source_version:str | None=None) -> GeometryTiers:
+    '''
+    The cache is keyed by the source file version (size and modification time, see utils.file_version)
+    and the tolerances, so it is rebuilt automatically whenever the source parquet or GEOMETRY_TIERS change.
+    Pass source_version if the caller already has it.
+    geometry may be a callable (e.g. FeatureStore.load_geometry), so the polygons are only read when the cache is rebuilt.
+    '''
+    cache_path = cache_path or geometry_cache_path(source_path)
+    source_version = source_version or file_version(source_path)
+    tiers = read_geometry_tiers(cache_path, source_version, tolerances)
+    if tiers is None:
+        if callable(geometry):
+            geometry = geometry()
+        tiers = build_geometry_tiers(geoidfq, geometry, tolerances)
+        save_geometry_tiers(tiers, cache_path, source_version, tolerances)
+        print(f'Geometry tiers saved to: {cache_path}!')
+    return tiers
+
+
+# --- MAP RENDERING ---
+# Center of the contiguous US; zoom level 5 is usually the "sweet spot" for US-wide but focused views
+US_CENTER = [39.8283, -98.5795]
+
+# Legend colors per rank bucket
+RANK_BUCKET_COLORS = {
+    "Top 10": "#1a9850",   # Dark Green
+    "11-25": "#91cf60",    # Light Green
+    "26-50": "#fee08b",    # Yellow/Tan
+    "50+": "#d73027",      # Red
+}
+
+REFERENCE_STYLE = {
+    'fillColor': '#00BFFF', # Deep Sky Blue
+    'color': '#00008B',     # Dark Blue Border
+    'weight': 3,            # Thicker border for references
+    'fillOpacity': 0.8,
+}
+
+# Properties shown in the candidate tooltip, with their labels
+CANDIDATE_TOOLTIP = {
+    'place': 'Place',
+    'rank': 'Rank #',
+    'overall_similarity': 'Overall Sim (%)',
+    'acs_base_sim': 'ACS (%)',
+    'acs_income_sim': 'Income (%)',
+    'property_sim': 'Property (%)',
+    'growth_sim': 'Growth (%)',
+}
+
+
+# Helper for the legend colors
+def get_color(rank_bucket:str) -> str:
+    # Return hex color or black if not found to highlight the error
+    return RANK_BUCKET_COLORS.get(rank_bucket, "#000000")
+
+
+# Bucket the ranks based on integer thresholds
+def assign_rank_bucket(ranks) -> np.ndarray:
+    ranks = np.asarray(ranks)
+    return np.select([ranks <= 10, ranks <= 25, ranks <= 50], ["Top 10", "11-25", "26-50"], default="50+")
+
+
+# One style function for the whole candidate layer, driven by the rank_bucket property
+def _candidate_style(feature:dict) -> dict:
+    return {
+        'fillColor': get_color(feature['properties']['rank_bucket']),
+        'color': 'black',
+        'weight': 1.5,
+        'fillOpacity': 0.7,
+    }
+
+
+# Add legend to the rendered map
+def add_map_legend(m:folium.Map) -> None:
+    legend_html = """
+     <div style="
+     position: fixed; 
+     bottom: 50px; left: 50px; width: 150px; height: 160px; 
+     background-color: white; border:2px solid grey; z-index:9999; font-size:14px;
+     padding: 10px;
+     border-radius: 5px;
+     box-shadow: 2px 2px 5px rgba(0,0,0,0.3);
+     ">
+     <b>Market Rank</b><br>
+     <i style="background: #00BFFF; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> Reference<br>
+     <i style="background: #1a9850; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> Top 10<br>
+     <i style="background: #91cf60; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 11-25<br>
+     <i style="background: #fee08b; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 26-50<br>
+     <i style="background: #d73027; width: 12px; height: 12px; float: left; margin-right: 5px; border: 1px solid black;"></i> 50+<br>
+     </div>
+     """
+    m.get_root().html.add_child(folium.Element(legend_html))
+
+
+# Function to build the similarity map with one GeoJSON layer for references and one for candidates
+def build_similarity_map(ref_gdf:gpd.GeoDataFrame, candidates_gdf:gpd.GeoDataFrame, zoom_start:int=5,
+                         measure:bool=False) -> tuple[folium.Map, dict]:
+    '''
+    ref_gdf needs namelsad + geometry; candidates_gdf needs the ranked result columns + geometry.
+    Each layer is a single FeatureCollection styled by one data-driven style function,
+    so the HTML holds one layer per group instead of one GeoJson object per place.
+    Returns the map and a stats dict (feature count, build time and, if measure=True, HTML size and render time).
+    '''
+    start_time = time.perf_counter()
+    with trace_stage('map.build', rows=len(candidates_gdf)):
+        m = folium.Map(location=US_CENTER, zoom_start=zoom_start, tiles='cartodbpositron')
+
+        # A. REFERENCE CITIES (The Anchors)
+        refs = ref_gdf.loc[ref_gdf.geometry.notna(), ['namelsad', 'geometry']]
+        if not refs.empty:
+            folium.GeoJson(
+                refs,
+                name='References',
+                style_function=lambda x: REFERENCE_STYLE,
+                tooltip=folium.GeoJsonTooltip(fields=['namelsad'], aliases=['REFERENCE:']),
+            ).add_to(m)
+
+        # B. CANDIDATES: only the properties used by the style and tooltip go into the payload
+        cands = candidates_gdf.loc[candidates_gdf.geometry.notna()]
+        tooltip_cols = [c for c in CANDIDATE_TOOLTIP if c == 'place' or c in cands.columns]
+        layer = gpd.GeoDataFrame({
+            'place': cands['namelsad'] + ', ' + cands['stusps'],
+            'rank': cands['rank'].astype(int),
+            'rank_bucket': assign_rank_bucket(cands['rank']),
+            **{c: cands[c].round(1) for c in tooltip_cols if c not in ('place', 'rank')},
+        }, geometry=cands.geometry.values, crs=cands.crs)
+        if not layer.empty:
+            folium.GeoJson(
+                layer,
+                name='Candidates',
+                style_function=_candidate_style,
+                tooltip=folium.GeoJsonTooltip(fields=tooltip_cols, aliases=[CANDIDATE_TOOLTIP[c] for c in tooltip_cols]),
+            ).add_to(m)
+
+        add_map_legend(m)
+    stats = {
+        'n_features': len(refs) + len(layer),
+        'build_seconds': time.perf_counter() - start_time,
+    }
+    if measure:
+        render_start = time.perf_counter()
+        with trace_stage('map.render') as span:
+            html = m.get_root().render()
+            span.info['html_bytes'] = len(html)
+        stats['render_seconds'] = time.perf_counter() - render_start
+        stats['html_bytes'] = len(html.encode('utf-8'))
+    return m, stats
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from src.analytics import RankIndex, build_universe
+from src.benchmark import synthetic_features
+from src.config import METRICS
+from src.data_loader import build_feature_store
+
+
+# Small synthetic place table (the benchmark generator: ties, ~2% missing values, circle polygons)
+@pytest.fixture(scope='session')
+def synthetic_gdf():
+    return synthetic_features('place', n_rows=3000, seed=7)
+
+
+@pytest.fixture(scope='session')
+def store(synthetic_gdf):
+    return build_feature_store(synthetic_gdf, METRICS)
+
+
+# Every state, no population floor, so the references are always inside the universe
+@pytest.fixture(scope='session')
+def universe(store):
+    rank_index = RankIndex(store.rank_values(), store.metrics)
+    return build_universe(store, rank_index, list(store.state_names), 0)
+
+
+@pytest.fixture(scope='session')
+def ref_geoids(store):
+    rng = np.random.default_rng(3)
+    return store.geoidfq[rng.choice(len(store), 3, replace=False)].tolist()
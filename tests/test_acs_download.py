@@ -0,0 +1,126 @@
+import hashlib
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import pytest
+
+from src.acs_download import AcsExtract, DownloadCache, download_acs
+
+
+# Pipe-delimited summary file with places (160) of two states and a few tracts (140)
+SUMMARY_FILE = '\n'.join([
+    'GEO_ID|B01003_E001|B01003_M001|B01003_E002|B01003_M002',
+    '1600000US0601234|100|5|10|1',
+    '1400000US06001400100|200|6|20|2',
+    '1600000US0605678|300|7|30|3',
+    '1600000US3600001|400|8|40|4',
+    '1400000US36001000100|500|9|50|5',
+    '1600000US0699999|600|10|60|6',
+    '1600000US3699999|700|11|70|7',
+]) + '\n'
+BASE_URL = 'http://127.0.0.1:{port}/acs/{{year}}/{{dataset}}YRData/acsdt{{dataset}}y{{year}}'
+
+
+# Local stand-in for the Census file server: serves files from a dict with an ETag per content version
+class StandInServer:
+    def __init__(self):
+        self.files = {}
+        self.gets = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _headers(self) -> bytes | None:
+                body = stand_in.files.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return None
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', '"' + hashlib.md5(body).hexdigest() + '"')
+                self.send_header('Last-Modified', 'Tue, 01 Jul 2025 00:00:00 GMT')
+                self.end_headers()
+                return body
+
+            def do_HEAD(self):
+                self._headers()
+
+            def do_GET(self):
+                body = self._headers()
+                if body is not None:
+                    stand_in.gets += 1
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = BASE_URL.format(port=self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def publish(self, year:int, dataset:int, table_id:str, content:str) -> None:
+        self.files[f'/acs/{year}/{dataset}YRData/acsdt{dataset}y{year}-{table_id.lower()}.dat'] = content.encode('utf-8')
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    stand_in.thread.start()
+    yield stand_in
+    stand_in.httpd.shutdown()
+    stand_in.httpd.server_close()
+
+
+# Helper for the rows an extract should hold, from a one-shot read of the whole file
+def expected_rows(content:str, prefix:str, usecols:list[str]) -> pd.DataFrame:
+    frame = pd.read_csv(io.StringIO(content), sep='|', dtype=str)
+    return frame.loc[frame['GEO_ID'].str.startswith(prefix), usecols].reset_index(drop=True)
+
+
+def test_chunked_parse_matches_full_read(server, tmp_path):
+    server.publish(2023, 5, 'B01003', SUMMARY_FILE)
+    places = AcsExtract('B01003', 2023, 5, '160', 'all', ['B01003_001'], tmp_path / 'place')
+    california = AcsExtract('B01003', 2023, 5, '160', '06', None, tmp_path / 'place')
+    cache = DownloadCache(tmp_path / 'manifest.json')
+
+    # chunk_size=2 spreads the rows of every output over several chunks
+    summary = download_acs([places, california], cache, chunk_size=2, base_url=server.base_url, timeout=5)
+
+    assert sorted(summary['downloaded']) == sorted([places.outpath, california.outpath])
+    assert server.gets == 1  # both outputs come from one streamed read
+    pd.testing.assert_frame_equal(pd.read_csv(places.outpath, dtype=str),
+                                  expected_rows(SUMMARY_FILE, '160', places.usecols))
+    all_cols = SUMMARY_FILE.splitlines()[0].split('|')
+    pd.testing.assert_frame_equal(pd.read_csv(california.outpath, dtype=str),
+                                  expected_rows(SUMMARY_FILE, '1600000US06', all_cols))
+    assert not list(tmp_path.glob('place/*.tmp'))
+
+
+def test_unchanged_source_is_skipped_and_changed_source_downloaded(server, tmp_path):
+    server.publish(2023, 5, 'B01003', SUMMARY_FILE)
+    extract = AcsExtract('B01003', 2023, 5, '160', 'all', ['B01003_001'], tmp_path / 'place')
+    manifest = tmp_path / 'manifest.json'
+
+    first = download_acs([extract], DownloadCache(manifest), base_url=server.base_url, timeout=5)
+    assert first['downloaded'] == [extract.outpath]
+
+    # Same ETag / Last-Modified / size: nothing is fetched (a fresh cache reads the manifest back)
+    second = download_acs([extract], DownloadCache(manifest), base_url=server.base_url, timeout=5)
+    assert second['skipped'] == [extract.outpath] and not second['downloaded']
+    assert server.gets == 1
+
+    # A new file version changes the validators, so the output is downloaded again
+    updated = SUMMARY_FILE.replace('|100|5|', '|101|5|')
+    server.publish(2023, 5, 'B01003', updated)
+    third = download_acs([extract], DownloadCache(manifest), base_url=server.base_url, timeout=5)
+    assert third['downloaded'] == [extract.outpath]
+    assert server.gets == 2
+    pd.testing.assert_frame_equal(pd.read_csv(extract.outpath, dtype=str),
+                                  expected_rows(updated, '160', extract.usecols))
+
+
+def test_missing_file_is_reported_as_failed(server, tmp_path):
+    extract = AcsExtract('B99999', 2023, 5, '160', 'all', None, tmp_path / 'place')
+    summary = download_acs([extract], DownloadCache(tmp_path / 'manifest.json'), base_url=server.base_url, timeout=5)
+    assert summary['failed'] == [extract.outpath]
+    assert not extract.outpath.exists()
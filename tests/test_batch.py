@@ -0,0 +1,31 @@
+import pandas as pd
+
+from src.analytics import score_universe
+from src.batch import SimilarityJob, run_batch, write_results
+
+
+def test_batch_matches_single_runs(store, universe, ref_geoids):
+    states = store.state_names.tolist()
+    jobs = [
+        SimilarityJob('even', ref_geoids, states, 0),
+        SimilarityJob('uneven', ref_geoids[:2], states, 0, {'ACS Base': 1.0, 'Property': 0.1}),
+        SimilarityJob('one state', ref_geoids[:1], [states[0]], 0),
+    ]
+    results = run_batch(store, jobs, top_k=30)
+    for job, frame in zip(jobs[:2], results[:2]):
+        expected = score_universe(store, universe, job.ref_geoids, job.weights, 30, store.metrics).top()
+        pd.testing.assert_frame_equal(frame, expected)
+    assert (results[2]['state_name'] == states[0]).all()
+
+
+def test_empty_universe_keeps_the_result_columns(store, ref_geoids, tmp_path):
+    jobs = [SimilarityJob('normal', ref_geoids, pop_min=0), SimilarityJob('nobody', ref_geoids, pop_min=1e12)]
+    normal, empty = run_batch(store, jobs, top_k=10)
+    assert len(normal) == 10 and empty.empty
+    assert list(empty.columns) == list(normal.columns)
+    pd.testing.assert_series_equal(empty.dtypes, normal.dtypes)
+    # Callers can still concatenate and select the score columns
+    assert len(pd.concat([normal, empty])[['overall_similarity', 'rank']]) == 10
+
+    paths = write_results(jobs, [normal, empty], tmp_path, 'parquet')
+    assert list(pd.read_parquet(paths[1]).columns) == list(normal.columns)
@@ -0,0 +1,17 @@
+import pytest
+
+from src.benchmark import benchmark_level, main
+
+
+def test_benchmark_level_needs_a_repeat(tmp_path):
+    with pytest.raises(ValueError):
+        benchmark_level('place', tmp_path, n_rows=100, repeats=0)
+    # Rejected before the synthetic table is written
+    assert not any(tmp_path.iterdir())
+
+
+def test_cli_rejects_zero_repeats(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(['run', '--repeats', '0'])
+    assert exit_info.value.code == 2
+    assert '--repeats must be at least 1' in capsys.readouterr().err
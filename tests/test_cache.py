@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from src.cache import LRUCache
+
+
+def test_lru_eviction_and_stats():
+    cache = LRUCache(max_items=2, sizeof=len)
+    cache.put('a', 'xx')
+    cache.put('b', 'yyy')
+    assert cache.get('a') == 'xx'
+    cache.put('c', 'z')
+    # 'b' was the least recently used
+    assert 'b' not in cache and cache.get('b') is None
+    assert cache.stats() == {'items': 2, 'bytes': 3, 'hits': 1, 'misses': 1}
+
+
+def test_stats_under_concurrent_access():
+    cache = LRUCache(max_items=8, sizeof=len)
+
+    def work(i):
+        cache.put(i % 16, 'v' * (i % 5))
+        cache.get((i * 7) % 16)
+        return cache.stats()
+
+    with ThreadPoolExecutor(8) as pool:
+        snapshots = list(pool.map(work, range(2000)))
+    assert all(s['items'] <= 8 and s['hits'] + s['misses'] <= 2000 for s in snapshots)
+    final = cache.stats()
+    assert final['hits'] + final['misses'] == 2000
@@ -0,0 +1,108 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import shapely
+
+from src.data_loader import load_data_from_bq, write_batches_to_geoparquet
+
+
+# Stand-in for google.cloud.bigquery.Client: query(...).result(page_size=...).to_arrow_iterable()
+class FakeBigQueryClient:
+    def __init__(self, batches:list[pa.RecordBatch], fail_after:int | None=None):
+        self.batches = batches
+        self.fail_after = fail_after
+        self.queries = []
+        self.page_size = None
+
+    def query(self, query:str):
+        self.queries.append(query)
+        return self
+
+    def result(self, page_size:int):
+        self.page_size = page_size
+        return self
+
+    def to_arrow_iterable(self):
+        for i, batch in enumerate(self.batches):
+            if self.fail_after is not None and i == self.fail_after:
+                raise ConnectionError("Stream interrupted")
+            yield batch
+
+
+# Helper for small query pages: string, integer, float (with nulls) and WKB geometry columns
+def make_batches(n_batches:int=3, rows:int=4) -> list[pa.RecordBatch]:
+    rng = np.random.default_rng(0)
+    batches = []
+    for b in range(n_batches):
+        ids = np.arange(b * rows, (b + 1) * rows)
+        value = rng.lognormal(10, 1, rows)
+        value[0] = np.nan
+        shapes = shapely.buffer(shapely.points(rng.uniform(-120, -70, rows), rng.uniform(25, 49, rows)), 0.01, quad_segs=2)
+        batches.append(pa.record_batch({
+            'geoidfq': pa.array([f'1600000US06{i:05d}' for i in ids]),
+            'pop_2024': pa.array(ids * 100, type=pa.int64()),
+            'median_assessed_value': pa.array(value, from_pandas=True),
+            'geometry': pa.array(shapely.to_wkb(shapes).tolist(), type=pa.binary()),
+        }))
+    return batches
+
+
+# Helper for the GeoDataFrame the batches should decode to
+def expected_frame(batches:list[pa.RecordBatch]) -> gpd.GeoDataFrame:
+    table = pa.Table.from_batches(batches)
+    geometry = shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False))
+    return gpd.GeoDataFrame(table.drop_columns(['geometry']).to_pandas(), geometry=geometry, crs="EPSG:4326")
+
+
+def test_write_batches_to_geoparquet(tmp_path):
+    batches = make_batches()
+    path = tmp_path / 'features.parquet'
+    assert write_batches_to_geoparquet(iter(batches), path) == 12
+
+    # One row group per page
+    assert pq.ParquetFile(path).metadata.num_row_groups == 3
+    gdf = gpd.read_parquet(path)
+    expected = expected_frame(batches)
+    pd.testing.assert_frame_equal(pd.DataFrame(gdf.drop(columns='geometry')), pd.DataFrame(expected.drop(columns='geometry')))
+    assert gdf.crs.equals("EPSG:4326")
+    assert shapely.equals_exact(gdf.geometry.values, expected.geometry.values).all()
+
+
+@pytest.mark.parametrize('save', [True, False])
+def test_load_data_from_bq_with_stand_in_client(tmp_path, save):
+    batches = make_batches()
+    client = FakeBigQueryClient(batches)
+    gdf = load_data_from_bq('project', 'dataset', 'features', save=save, data_dir=tmp_path, page_size=4, client=client)
+
+    assert client.page_size == 4
+    assert 'ST_ASBINARY(geometry)' in client.queries[0]
+    assert (tmp_path / 'features.parquet').exists() == save
+    expected = expected_frame(batches)
+    pd.testing.assert_frame_equal(pd.DataFrame(gdf.drop(columns='geometry')), pd.DataFrame(expected.drop(columns='geometry')))
+    assert gdf.crs.equals("EPSG:4326")
+    assert shapely.equals_exact(gdf.geometry.values, expected.geometry.values).all()
+
+
+def test_failed_stream_leaves_no_partial_output(tmp_path):
+    path = tmp_path / 'features.parquet'
+    client = FakeBigQueryClient(make_batches(), fail_after=2)
+    with pytest.raises(ConnectionError):
+        load_data_from_bq('project', 'dataset', 'features', data_dir=tmp_path, client=client)
+    assert list(tmp_path.iterdir()) == []
+
+    # An earlier complete export is kept as is
+    write_batches_to_geoparquet(iter(make_batches(1)), path)
+    before = path.read_bytes()
+    with pytest.raises(ConnectionError):
+        write_batches_to_geoparquet(FakeBigQueryClient(make_batches(), fail_after=1).to_arrow_iterable(), path)
+    assert path.read_bytes() == before
+    assert [p.name for p in tmp_path.iterdir()] == ['features.parquet']
+
+
+def test_empty_result_raises(tmp_path):
+    with pytest.raises(ValueError):
+        write_batches_to_geoparquet(iter([]), tmp_path / 'features.parquet')
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,80 @@
+import io
+import json
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import shapely
+
+from src.analytics import score_universe
+from src.config import metric_groups_for
+from src.export import iter_export, write_export
+from src.visualizer import build_geometry_tiers
+
+
+@pytest.fixture(scope='module')
+def results(store, universe, ref_geoids):
+    weights = {group: 0.5 for group in metric_groups_for(store.metrics)}
+    return score_universe(store, universe, ref_geoids, weights, 50, store.metrics)
+
+
+@pytest.fixture(scope='module')
+def tiers(store, synthetic_gdf):
+    return build_geometry_tiers(store.geoidfq, synthetic_gdf.geometry)
+
+
+# Helper for an export as one byte string, in small chunks so several row groups / chunks are written
+def export_bytes(results, fmt, **kwargs) -> bytes:
+    return b''.join(iter_export(results, fmt, chunk_rows=700, **kwargs))
+
+
+def test_csv_round_trip(results):
+    frame = pd.read_csv(io.BytesIO(export_bytes(results, 'csv')), dtype={'geoidfq': str})
+    pd.testing.assert_frame_equal(frame, results.full().reset_index(drop=True), check_dtype=False)
+
+
+def test_parquet_round_trip(results):
+    frame = pq.read_table(io.BytesIO(export_bytes(results, 'parquet'))).to_pandas()
+    pd.testing.assert_frame_equal(frame, results.full().reset_index(drop=True))
+
+
+def test_parquet_columns_and_top_n(results):
+    columns = ['rank', 'geoidfq', 'overall_similarity']
+    frame = pq.read_table(io.BytesIO(export_bytes(results, 'parquet', columns=columns, top_n=25))).to_pandas()
+    pd.testing.assert_frame_equal(frame, results.top(25)[columns].reset_index(drop=True))
+
+
+def test_geojson_round_trip(results, tiers):
+    collection = json.loads(export_bytes(results, 'geojson', top_n=100, geometry_tiers=tiers))
+    top = results.top(100)
+    assert [f['properties']['geoidfq'] for f in collection['features']] == top['geoidfq'].tolist()
+    assert [f['properties']['rank'] for f in collection['features']] == list(range(1, 101))
+    shapes = shapely.from_geojson([json.dumps(f['geometry']) for f in collection['features']])
+    expected = tiers.get(top['geoidfq'], 'fine').values
+    assert shapely.equals_exact(shapes, np.asarray(expected, dtype=object), tolerance=1e-9).all()
+
+
+def test_geoparquet_round_trip(results, tiers):
+    gdf = gpd.read_parquet(io.BytesIO(export_bytes(results, 'geoparquet', geometry_tiers=tiers)))
+    full = results.full().reset_index(drop=True)
+    pd.testing.assert_frame_equal(pd.DataFrame(gdf.drop(columns='geometry')), full)
+    assert gdf.crs.equals(tiers.crs)
+    expected = tiers.get(full['geoidfq'], 'fine').values
+    assert shapely.equals_exact(np.asarray(gdf.geometry.values, dtype=object), np.asarray(expected, dtype=object)).all()
+
+
+def test_empty_export_keeps_the_columns(results):
+    frame = pq.read_table(io.BytesIO(export_bytes(results, 'parquet', top_n=0))).to_pandas()
+    assert frame.empty and list(frame.columns) == results.columns()
+
+
+def test_write_export(results, tmp_path):
+    path = write_export(results, tmp_path / 'results.parquet', 'parquet')
+    pd.testing.assert_frame_equal(pd.read_parquet(path), results.full().reset_index(drop=True))
+    assert not (tmp_path / 'results.parquet.tmp').exists()
+
+
+def test_geometry_formats_need_tiers(results):
+    with pytest.raises(ValueError):
+        iter_export(results, 'geojson')
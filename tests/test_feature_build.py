@@ -0,0 +1,137 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from src.feature_build import (FEATURE_BUILDS, FEATURE_COLUMNS, SOURCE_COLUMNS, build_features, pct_columns,
+                               percent_rank, safe_divide, spherical_area_m2, sql_round)
+
+
+BUILD = FEATURE_BUILDS['place_5yr']
+GEOIDS = [f'1600000US{s}0000{i}' for s, i in [('06', 1), ('06', 2), ('06', 3), ('06', 4), ('36', 5), ('36', 6)]]
+
+
+# Helper for the base table: two states, one row failing the income filter and one under the percentile population
+def base_frame() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame({
+        'geoidfq': GEOIDS,
+        'state_fips': ['06', '06', '06', '06', '36', '36'],
+        'state_name': ['California'] * 4 + ['New York'] * 2,
+        'stusps': ['CA'] * 4 + ['NY'] * 2,
+        'namelsad': [f'Place {i} city' for i in range(1, 7)],
+        'pop_2024': [1000.0, 2500.0, 300.0, 4000.0, 800.0, 1200.0],
+        'households_2024': [400.0, 900.0, 120.0, 1500.0, 300.0, 450.0],
+        'median_income_2024': [50000.0, 0.0, 61000.0, 72000.0, 45000.0, np.nan],
+        'median_home_value_2024': [300000.0, 250000.0, 410000.0, 520000.0, 180000.0, 220000.0],
+    }, geometry=shapely.box(np.arange(6) - 120.0, 35.0, np.arange(6) - 119.9, 35.1), crs="EPSG:4326")
+
+
+# Helper for the per-source exports; every source leaves one base place unmatched (NULL after the LEFT JOIN)
+def source_frames() -> dict[str, pd.DataFrame]:
+    return {
+        'parcel': pd.DataFrame({'geoidfq': GEOIDS[:5], 'unq_parcel_count': [100.0, 200.0, np.nan, 400.0, 50.0],
+                                'median_parcel_area_sq_mtr': [800.0, 750.0, 900.0, 600.0, 1200.0]}),
+        'address': pd.DataFrame({'geoidfq': GEOIDS[1:], 'unq_addr_count': [500.0, 90.0, 1800.0, 320.0, 700.0],
+                                 'condo_address_counts': [10.0, 0.0, 85.0, 4.0, np.nan]}),
+        'property': pd.DataFrame({'geoidfq': GEOIDS[:4], 'unq_clips': [150.0, 90.0, 0.0, 410.0],
+                                  'median_assessed_value': [2.1e5, 1.9e5, 3.3e5, 4.0e5],
+                                  'median_tax_amount': [2100.0, 1800.0, 3500.0, np.nan]}),
+        'growth': pd.DataFrame({'geoidfq': GEOIDS, 'unq_growth_clips': [15.0, 5.0, 8.0, 41.0, 3.0, 9.0]}),
+        'firmographics': pd.DataFrame({'geoidfq': GEOIDS[::-1], 'business_count': [12.0, 30.0, 7.0, 2.0, 55.0, 3.0]}),
+    }
+
+
+def write_source(sources_dir, source:str, frame:pd.DataFrame) -> None:
+    frame.to_parquet(sources_dir / f'{BUILD.source_table(source)}.parquet', index=False)
+
+
+@pytest.fixture
+def sources_dir(tmp_path):
+    sources_dir = tmp_path / 'sources'
+    sources_dir.mkdir()
+    base_frame().to_parquet(sources_dir / f'{BUILD.base_table}.parquet')
+    for source, frame in source_frames().items():
+        write_source(sources_dir, source, frame)
+    return sources_dir
+
+
+# Helper for the features the SQL gives on the fixture, computed independently with pandas merges
+def expected_features() -> pd.DataFrame:
+    base = base_frame()
+    base = base[(base['median_income_2024'] > 0) & (base['median_home_value_2024'] > 0)].reset_index(drop=True)
+    frame = pd.DataFrame(base.drop(columns='geometry'))
+    for source, columns in SOURCE_COLUMNS.items():
+        frame = frame.merge(source_frames()[source][['geoidfq'] + columns], on='geoidfq', how='left')
+    area_km2 = spherical_area_m2(shapely.to_wkb(base.geometry.values)) / 1e6
+    frame['parcel_density'] = sql_round(frame['unq_parcel_count'].to_numpy() / area_km2, 2)
+    clips = frame['unq_clips'].replace(0, np.nan)
+    frame['growth_clip_share'] = sql_round(frame['unq_growth_clips'] / clips * 100, 2)
+    return frame
+
+
+def test_safe_divide_and_percent_rank():
+    np.testing.assert_array_equal(safe_divide([1.0, 2.0, np.nan, 4.0], [0.0, 4.0, 1.0, np.nan]),
+                                  [np.nan, 0.5, np.nan, np.nan])
+    # NULL sorts first (0), ties share their lowest rank, (rank - 1) / (rows - 1)
+    np.testing.assert_array_equal(percent_rank(pd.Series([np.nan, 1.0, 1.0, 3.0])), [0.0, 33.33, 33.33, 100.0])
+    np.testing.assert_array_equal(percent_rank(pd.Series([5.0, np.nan, 2.0, 7.0]), pd.Series(['a', 'a', 'a', 'b'])),
+                                  [100.0, 0.0, 50.0, 0.0])
+
+
+def test_build_matches_expected_features(sources_dir, tmp_path):
+    summary = build_features('place_5yr', sources_dir, tmp_path / 'features')
+    assert summary['rows'] == 4
+    assert summary['reused'] == []
+
+    features = pd.read_parquet(summary['features_path'])
+    expected = expected_features()
+    assert features['geoidfq'].tolist() == expected['geoidfq'].tolist()
+    pd.testing.assert_frame_equal(features[FEATURE_COLUMNS], expected[FEATURE_COLUMNS], check_dtype=False)
+    # Unmatched places and zero denominators are NULL
+    assert features['growth_clip_share'].isna().tolist() == [False, True, False, True]
+    assert gpd.read_parquet(summary['features_path']).crs.equals("EPSG:4326")
+
+    # Percentile table: rows with pop_2024 >= 500 (drops the 300 place), NULL features ranked first
+    pctile = pd.read_parquet(summary['pctile_path'])
+    kept = expected[expected['pop_2024'] >= 500].reset_index(drop=True)
+    assert pctile['geoidfq'].tolist() == kept['geoidfq'].tolist()
+    for column in FEATURE_COLUMNS:
+        national, state = pct_columns(column)
+        np.testing.assert_array_equal(pctile[national], percent_rank(kept[column]))
+        np.testing.assert_array_equal(pctile[state], percent_rank(kept[column], kept['state_fips']))
+    np.testing.assert_array_equal(pctile['condo_address_counts_pct'], [0.0, 100.0, 50.0])
+
+
+def test_incremental_rebuild(sources_dir, tmp_path):
+    out_dir = tmp_path / 'features'
+    first = build_features('place_5yr', sources_dir, out_dir)
+    features_mtime = os.stat(first['features_path']).st_mtime_ns
+
+    # Unchanged inputs: every group is read back and the outputs are not rewritten
+    rerun = build_features('place_5yr', sources_dir, out_dir)
+    assert rerun['rebuilt'] == []
+    assert os.stat(rerun['features_path']).st_mtime_ns == features_mtime
+
+    # A new property export only rebuilds the groups reading it
+    prop = source_frames()['property']
+    prop.loc[0, 'unq_clips'] = 300.0
+    write_source(sources_dir, 'property', prop)
+    changed = build_features('place_5yr', sources_dir, out_dir)
+    assert changed['rebuilt'] == ['property', 'growth']
+    assert sorted(changed['reused']) == ['acs', 'address', 'firmographics', 'parcel']
+    features = pd.read_parquet(changed['features_path'])
+    assert features.loc[0, 'unq_clips'] == 300.0
+    assert features.loc[0, 'growth_clip_share'] == 5.0
+
+    # force recomputes everything, to the same tables
+    forced = build_features('place_5yr', sources_dir, out_dir, force=True)
+    assert len(forced['rebuilt']) == 6
+    pd.testing.assert_frame_equal(pd.read_parquet(forced['features_path']), features)
+
+
+def test_missing_source_export(sources_dir, tmp_path):
+    (sources_dir / f"{BUILD.source_table('growth')}.parquet").unlink()
+    with pytest.raises(FileNotFoundError):
+        build_features('place_5yr', sources_dir, tmp_path / 'features')
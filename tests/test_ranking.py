@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.analytics import RankIndex, score_universe, top_k_order
+from src.config import METRICS, metric_groups_for
+from src.data_loader import build_feature_store, load_national_percentiles
+from src.neighbours import compare_with_brute_force, score_universe_indexed
+
+
+UNEVEN_WEIGHTS = [0.9, 0.1, 0.6, 0.3, 1.0, 0.0]
+
+
+# Helper for one weight per group of the store metrics
+def group_weights(values:list[float]) -> dict[str, float]:
+    groups = metric_groups_for(METRICS)
+    return {group: values[i % len(values)] for i, group in enumerate(groups)}
+
+
+@pytest.mark.parametrize('k', [None, 0, 1, 7, 50, 999, 1000, 5000])
+def test_top_k_order_matches_full_stable_sort(k):
+    rng = np.random.default_rng(0)
+    # Few distinct values (many ties) and some NaN, which must sort last
+    values = rng.integers(0, 20, 1000).astype(np.float64)
+    values[rng.random(1000) < 0.05] = np.nan
+    full = np.argsort(-np.where(np.isnan(values), -np.inf, values), kind='stable')
+    expected = full if k is None else full[:k]
+    np.testing.assert_array_equal(top_k_order(values, k), expected)
+
+
+def test_reweight_matches_fresh_score(store, universe, ref_geoids):
+    weights = group_weights([0.5])
+    other = group_weights(UNEVEN_WEIGHTS)
+    reweighted = score_universe(store, universe, ref_geoids, weights, 50, store.metrics).reweight(other)
+    fresh = score_universe(store, universe, ref_geoids, other, 50, store.metrics)
+
+    np.testing.assert_allclose(reweighted.scores['overall_similarity'], fresh.scores['overall_similarity'])
+    pd.testing.assert_frame_equal(reweighted.top(50), fresh.top(50))
+    pd.testing.assert_index_equal(reweighted.full().index, fresh.full().index)
+
+
+@pytest.mark.parametrize('weights', [[0.5], UNEVEN_WEIGHTS])
+def test_indexed_exact_matches_brute_force(store, universe, ref_geoids, weights):
+    weights = group_weights(weights)
+    brute = score_universe(store, universe, ref_geoids, weights, 50, store.metrics).top()
+    indexed = score_universe_indexed(store, universe, ref_geoids, weights, 50, exact=True, metrics=store.metrics).top()
+    pd.testing.assert_frame_equal(indexed, brute)
+
+
+def test_indexed_approximate_recall(store, universe, ref_geoids):
+    # Equal weights: the tree order is the weighted order, so the retrieval is exact
+    check = compare_with_brute_force(store, universe, ref_geoids, group_weights([0.5]), 50,
+                                     exact=False, metrics=store.metrics)
+    assert check['recall'] == 1.0
+    # Uneven weights: the over-fetch keeps most of the brute-force top 50
+    check = compare_with_brute_force(store, universe, ref_geoids, group_weights(UNEVEN_WEIGHTS), 50,
+                                     exact=False, metrics=store.metrics)
+    assert check['recall'] >= 0.5
+
+
+def test_percentiles_match_pandas_rank(synthetic_gdf, store, tmp_path):
+    rank_index = RankIndex(store.rank_values(), store.metrics)
+    local = rank_index.local_percentiles(np.ones(len(store), dtype=bool))
+    national = load_national_percentiles(store, tmp_path / 'table.parquet', source_version='v1')
+    for j, m in enumerate(store.metrics):
+        expected = synthetic_gdf[m].rank(pct=True)
+        np.testing.assert_allclose(local[:, j], expected, rtol=1e-12)
+        np.testing.assert_array_equal(national[f'{m}_pct'], np.round(expected * 100, 2))
+
+
+def test_values_above_float32_precision_do_not_tie(synthetic_gdf, tmp_path):
+    # Distinct values 2**24 + i: float32 rounds neighbours to the same number
+    gdf = synthetic_gdf.head(200).copy()
+    gdf['median_assessed_value'] = 2.0**24 + np.arange(200)[::-1]
+    store = build_feature_store(gdf, METRICS)
+    j = store.metric_index('median_assessed_value')
+    assert np.unique(store.features[:, j]).size < 200
+
+    expected = gdf['median_assessed_value'].rank(pct=True)
+    local = RankIndex(store.rank_values(), store.metrics).local_percentiles(np.ones(200, dtype=bool))
+    np.testing.assert_allclose(local[:, j], expected, rtol=1e-12)
+    national = load_national_percentiles(store, tmp_path / 'table.parquet', source_version='v1')
+    np.testing.assert_array_equal(national['median_assessed_value_pct'], np.round(expected * 100, 2))
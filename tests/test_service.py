@@ -0,0 +1,158 @@
+import asyncio
+import io
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src.analytics import score_universe
+from src.config import metric_groups_for
+from src.data_loader import DATASETS
+from src.service import ARROW_MIME, SimilarityService
+
+
+LEVEL = 'place_5yr'
+
+
+# Minimal ASGI client: one request, every sent message collected
+def request(app, method:str, path:str, body=None, query_string:bytes=b'', headers:list | None=None) -> dict:
+    raw = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers or []}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': raw, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start = messages[0]
+    return {
+        'status': start['status'],
+        'headers': {k.decode(): v.decode() for k, v in start['headers']},
+        'chunks': [m['body'] for m in messages[1:]],
+        'body': b''.join(m['body'] for m in messages[1:]),
+    }
+
+
+# The service over the synthetic table of tests/conftest.py, written as the level's parquet
+@pytest.fixture(scope='module')
+def service(synthetic_gdf, tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('service_data')
+    synthetic_gdf.to_parquet(DATASETS[LEVEL].path(data_dir))
+    service = SimilarityService(LEVEL, data_dir, max_workers=2)
+    yield service
+    service.close()
+
+
+@pytest.fixture(scope='module')
+def weights(store):
+    groups = list(metric_groups_for(store.metrics))
+    return {group: [0.9, 0.2, 0.6, 0.4, 1.0][i % 5] for i, group in enumerate(groups)}
+
+
+@pytest.fixture(scope='module')
+def query(store, ref_geoids, weights):
+    return {'ref_geoids': ref_geoids, 'states': store.state_names.tolist(), 'pop_min': 0, 'weights': weights}
+
+
+def test_health_loads_the_level_on_first_request(service, store):
+    response = request(service, 'GET', '/health')
+    assert response['status'] == 200
+    health = json.loads(response['body'])
+    assert health['status'] == 'ok' and health['level'] == LEVEL and health['rows'] == len(store)
+    assert health['dataset_version'] == service.dataset_version
+
+
+def test_similar_matches_score_universe(service, store, universe, ref_geoids, weights, query):
+    response = request(service, 'POST', '/similar', {**query, 'top_k': 25})
+    assert response['status'] == 200
+    payload = json.loads(response['body'])
+    results = pd.DataFrame(payload['results'])
+    expected = score_universe(store, universe, ref_geoids, weights, 25, store.metrics)
+    assert payload['n_candidates'] == len(expected)
+    top = expected.top(25)
+    assert results['geoidfq'].tolist() == top['geoidfq'].tolist()
+    np.testing.assert_allclose(results['overall_similarity'], top['overall_similarity'])
+    assert results['rank'].tolist() == list(range(1, 26))
+
+
+def test_similar_arrow_format(service, query):
+    response = request(service, 'POST', '/similar', {**query, 'top_k': 10}, headers=[(b'accept', ARROW_MIME.encode())])
+    assert response['headers']['content-type'] == ARROW_MIME
+    table = pa.ipc.open_stream(response['body']).read_all()
+    assert table.num_rows == 10
+    assert json.loads(table.schema.metadata[b'similarity'])['level'] == LEVEL
+
+
+@pytest.mark.parametrize('change', [
+    {'weights': {'Not a group': 1.0}},
+    {'weights': 'heavy'},
+    {'weights': {'ACS Base': 0, 'ACS Income': 0, 'Property': 0, 'Parcel': 0, 'Growth': 0}},
+    {'states': 'California'},
+    {'ref_geoids': []},
+    {'top_k': 0},
+    {'use_index': 'false'},
+    {'exact': 0},
+    {'exclude_adjacent': 'true'},
+    {'bbox': [-90, 40, -100, 30]},
+])
+def test_similar_rejects_bad_requests(service, query, change):
+    response = request(service, 'POST', '/similar', {**query, **change})
+    assert response['status'] == 400
+    assert 'error' in json.loads(response['body'])
+
+
+def test_invalid_json_and_unknown_path(service):
+    assert request(service, 'POST', '/similar', b'{not json')['status'] == 400
+    assert request(service, 'GET', '/nowhere')['status'] == 404
+
+
+def test_export_streams_the_full_ranking(service, store, universe, ref_geoids, weights, query):
+    response = request(service, 'POST', '/export', {**query, 'format': 'parquet'})
+    assert response['status'] == 200
+    assert response['headers']['content-type'] == 'application/vnd.apache.parquet'
+    assert 'similar.parquet' in response['headers']['content-disposition']
+    # Streamed: the chunks, then an empty closing message
+    assert len(response['chunks']) >= 2 and response['chunks'][-1] == b''
+    frame = pq.read_table(io.BytesIO(response['body'])).to_pandas()
+    expected = score_universe(store, universe, ref_geoids, weights, None, store.metrics).full()
+    assert frame['geoidfq'].tolist() == expected['geoidfq'].tolist()
+    np.testing.assert_allclose(frame['overall_similarity'], expected['overall_similarity'])
+
+
+def test_export_columns_and_top_n(service, query):
+    response = request(service, 'POST', '/export', {**query, 'format': 'csv', 'columns': ['rank', 'geoidfq'], 'top_n': 40})
+    frame = pd.read_csv(io.BytesIO(response['body']))
+    assert list(frame.columns) == ['rank', 'geoidfq'] and frame['rank'].tolist() == list(range(1, 41))
+    assert request(service, 'POST', '/export', {**query, 'format': 'xlsx'})['status'] == 400
+    assert request(service, 'POST', '/export', {**query, 'columns': ['nope']})['status'] == 400
+
+
+def test_stats_count_cache_hits(service, query):
+    request(service, 'POST', '/similar', {**query, 'top_k': 5})
+    before = json.loads(request(service, 'GET', '/stats')['body'])
+    request(service, 'POST', '/similar', {**query, 'top_k': 5})
+    after = json.loads(request(service, 'GET', '/stats')['body'])
+    assert after['results']['hits'] == before['results']['hits'] + 1
+    assert after['results']['misses'] == before['results']['misses']
+
+
+def test_lifespan_startup_and_shutdown(synthetic_gdf, tmp_path):
+    synthetic_gdf.to_parquet(DATASETS[LEVEL].path(tmp_path))
+    service = SimilarityService(LEVEL, tmp_path)
+    incoming = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(service({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert service.cache is not None
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.shared_store as shared_store
+from src.benchmark import synthetic_features
+from src.data_loader import DATASETS, load_dataset
+from src.shared_store import CURRENT_FILE, load_shared_dataset, shared_store_dir
+
+
+KEY = 'place_5yr'
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    synthetic_features('place', n_rows=500, seed=2).to_parquet(DATASETS[KEY].path(tmp_path))
+    return tmp_path
+
+
+def live_build(data_dir) -> str:
+    return (shared_store_dir(DATASETS[KEY].path(data_dir)) / CURRENT_FILE).read_text()
+
+
+def test_shared_store_matches_the_parquet(data_dir):
+    store, rank_index = load_shared_dataset(KEY, data_dir)
+    expected = load_dataset(KEY, data_dir)
+    np.testing.assert_array_equal(store.features, expected.features)
+    np.testing.assert_array_equal(store.geoidfq.astype(str), expected.geoidfq.astype(str))
+    pd.testing.assert_frame_equal(store.attrs, expected.attrs, check_dtype=False)
+    geoids = expected.geoidfq[[7, 3, 400]].tolist() + ['unknown']
+    np.testing.assert_array_equal(store.rows_for_geoids(geoids), [3, 7, 400])
+    assert rank_index.order.shape == store.features.shape
+
+    # Second load maps the same build
+    build = live_build(data_dir)
+    load_shared_dataset(KEY, data_dir)
+    assert live_build(data_dir) == build
+
+
+def test_rebuild_never_touches_the_mapped_build(data_dir):
+    source_path = DATASETS[KEY].path(data_dir)
+    old_store, _ = load_shared_dataset(KEY, data_dir)
+    old_build = live_build(data_dir)
+    old_features = np.array(old_store.features)
+
+    # New data version: a new build is written and CURRENT switched to it
+    stat = os.stat(source_path)
+    os.utime(source_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    new_store, _ = load_shared_dataset(KEY, data_dir)
+    assert live_build(data_dir) != old_build
+    assert sorted(os.listdir(shared_store_dir(source_path))) == sorted([CURRENT_FILE, live_build(data_dir)])
+    # The arrays mapped before the rebuild stay readable
+    np.testing.assert_array_equal(old_store.features, old_features)
+    np.testing.assert_array_equal(new_store.features, old_features)
+
+
+def test_old_layout_is_replaced(data_dir):
+    store_dir = shared_store_dir(DATASETS[KEY].path(data_dir))
+    store_dir.mkdir()
+    (store_dir / 'manifest.json').write_text('{"version": 1}')
+    (store_dir / 'features.npy').write_bytes(b'')
+    load_shared_dataset(KEY, data_dir)
+    assert sorted(os.listdir(store_dir)) == sorted([CURRENT_FILE, live_build(data_dir)])
+
+
+def test_falls_back_to_memory_when_reopen_fails(data_dir, monkeypatch):
+    monkeypatch.setattr(shared_store, 'open_shared_store', lambda *args, **kwargs: None)
+    store, rank_index = load_shared_dataset(KEY, data_dir)
+    assert len(store) == 500
+    assert rank_index.order.shape == store.features.shape
+
+
+def test_missing_build_is_rebuilt(data_dir):
+    store_dir = shared_store_dir(DATASETS[KEY].path(data_dir))
+    load_shared_dataset(KEY, data_dir)
+    # CURRENT pointing at a removed build
+    (store_dir / CURRENT_FILE).write_text('v2-removed')
+    store, _ = load_shared_dataset(KEY, data_dir)
+    assert len(store) == 500
+    assert (store_dir / live_build(data_dir)).is_dir()
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import shapely
+
+from src.benchmark import synthetic_features
+from src.config import METRICS
+from src.data_loader import build_feature_store
+from src.spatial import SpatialIndex, centroid_frame, load_spatial_index
+from src.spatial_filter import SpatialFilter
+
+
+GRID = 7
+CELL = 0.5
+
+
+# 7 x 7 grid of touching 0.5 degree squares over Kansas, row-major, with the synthetic attributes and metrics
+@pytest.fixture(scope='module')
+def grid_store():
+    gdf = synthetic_features('place', n_rows=GRID * GRID, seed=1)
+    col, row = np.meshgrid(np.arange(GRID), np.arange(GRID))
+    lon, lat = -100.0 + col.ravel() * CELL, 37.0 + row.ravel() * CELL
+    return build_feature_store(gdf.set_geometry(shapely.box(lon, lat, lon + CELL, lat + CELL)), METRICS)
+
+
+@pytest.fixture(scope='module')
+def index(grid_store):
+    centroids = centroid_frame(grid_store.geoidfq, grid_store.geometry)
+    return SpatialIndex(centroids['lon'], centroids['lat'], centroids['x'], centroids['y'], geometry=grid_store.load_geometry)
+
+
+def cell(row:int, col:int) -> int:
+    return row * GRID + col
+
+
+def test_radius_matches_brute_force(grid_store, index):
+    anchors = [cell(3, 3), cell(0, 6)]
+    spatial = SpatialFilter(tuple(grid_store.geoidfq[anchors]), radius_km=80)
+    # Projected centroid distance to the nearest anchor
+    dist_km = np.min([np.hypot(index.x - index.x[a], index.y - index.y[a]) for a in anchors], axis=0) / 1000
+    mask = spatial.mask(index, grid_store)
+    np.testing.assert_array_equal(mask, dist_km <= 80)
+    assert mask[anchors].all() and 1 < mask.sum() < GRID * GRID
+
+
+def test_bbox(grid_store, index):
+    spatial = SpatialFilter(bbox=(-99.1, 37.6, -97.9, 38.4))
+    mask = spatial.mask(index, grid_store)
+    # Centroids at -99.75 + 0.5k lon, 37.25 + 0.5k lat: columns 2-3, rows 1-2
+    expected = np.zeros(GRID * GRID, dtype=bool)
+    expected[[cell(1, 2), cell(1, 3), cell(2, 2), cell(2, 3)]] = True
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_exclude_adjacent(grid_store, index):
+    anchor = cell(3, 3)
+    mask = SpatialFilter((grid_store.geoidfq[anchor],), exclude_adjacent=True).mask(index, grid_store)
+    # The 8 squares sharing an edge or a corner are dropped, the anchor itself is kept
+    dropped = [cell(r, c) for r in (2, 3, 4) for c in (2, 3, 4) if (r, c) != (3, 3)]
+    assert sorted(np.flatnonzero(~mask).tolist()) == sorted(dropped)
+    assert mask[anchor]
+
+
+def test_constraints_combine_and_unknown_anchors_are_ignored(grid_store, index):
+    anchor = cell(3, 3)
+    spatial = SpatialFilter((grid_store.geoidfq[anchor], 'unknown'), radius_km=60, exclude_adjacent=True)
+    mask = spatial.mask(index, grid_store)
+    radius = SpatialFilter((grid_store.geoidfq[anchor],), radius_km=60).mask(index, grid_store)
+    adjacent = SpatialFilter((grid_store.geoidfq[anchor],), exclude_adjacent=True).mask(index, grid_store)
+    np.testing.assert_array_equal(mask, radius & adjacent)
+    assert not SpatialFilter(('unknown',), radius_km=60).mask(index, grid_store).any()
+
+
+def test_filter_key_is_canonical():
+    a = SpatialFilter(('b', 'a'), radius_km=10, bbox=(-100, 30, -90, 40))
+    b = SpatialFilter(('a', 'b'), radius_km=10, bbox=(-100, 30, -90, 40))
+    assert a.key() == b.key()
+    assert a.key()['bbox'] == {'min_lon': -100, 'min_lat': 30, 'max_lon': -90, 'max_lat': 40}
+    assert not SpatialFilter(('a',)).active
+
+
+def test_spatial_sidecar_round_trip(grid_store, index, tmp_path, capsys):
+    source_path = tmp_path / 'grid.parquet'
+    source_path.touch()
+    first = load_spatial_index(grid_store, source_path, source_version='v1')
+    assert 'Spatial centroids saved' in capsys.readouterr().out
+    # Same source version: read back from the sidecar
+    again = load_spatial_index(grid_store, source_path, source_version='v1')
+    assert capsys.readouterr().out == ''
+    np.testing.assert_allclose(again.x, index.x)
+    np.testing.assert_allclose(again.lat, index.lat)
+    np.testing.assert_array_equal(first.in_bbox((-99.1, 37.6, -97.9, 38.4)), again.in_bbox((-99.1, 37.6, -97.9, 38.4)))